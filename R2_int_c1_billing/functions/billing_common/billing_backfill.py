@@ -0,0 +1,213 @@
+"""
+Reprocesses historical raw Landmark files without going through SFTP.
+
+Each file is parsed, validated, transformed and built into TechOne SOAP
+envelopes the same way the Lambdas do it. Envelopes are written to a local
+directory or S3 prefix, or posted to a TechOne endpoint. Part of the shared
+layer so the Lambdas can reprocess a file with backfill_file; the process
+pool CLI over many files is tools/run_backfill.py.
+"""
+
+import csv
+import io
+import json
+import logging
+import os
+import time
+import boto3
+
+from billing_encoding import ENCODING_SAMPLE_SIZE, canonical_headers, detect_encoding
+from billing_rows import soap_envelope, transform_rows, wrap_rows
+from billing_validation import rejected_rows_report
+
+logger = logging.getLogger("billing_common")
+logger.setLevel(logging.INFO)
+
+ROWS_PER_CHUNK = 4999
+
+
+def split_location(location):
+    """
+    Function to split "s3://bucket/prefix" into (bucket, prefix).
+    Returns (None, location) for a local path.
+    """
+    if location.startswith("s3://"):
+        bucket_name, _, prefix = location[len("s3://") :].partition("/")
+        return bucket_name, prefix
+    return None, location
+
+
+def list_sources(location):
+    """
+    Function to list the raw CSV files under an S3 prefix or in a local
+    directory. Returns (path, size) pairs, largest first so the long files
+    start early.
+    """
+    bucket_name, prefix = split_location(location)
+    if bucket_name:
+        s3 = boto3.client("s3")
+        paginator = s3.get_paginator("list_objects_v2")
+        sources = [
+            (f"s3://{bucket_name}/{item['Key']}", item["Size"])
+            for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix)
+            for item in page.get("Contents", [])
+            if item["Key"].lower().endswith(".csv")
+        ]
+    elif os.path.isdir(location):
+        sources = [
+            (
+                os.path.join(location, name),
+                os.path.getsize(os.path.join(location, name)),
+            )
+            for name in os.listdir(location)
+            if name.lower().endswith(".csv")
+        ]
+    else:
+        sources = [(location, os.path.getsize(location))]
+    return sorted(sources, key=lambda source: source[1], reverse=True)
+
+
+def read_source(path):
+    bucket_name, key = split_location(path)
+    if bucket_name:
+        return boto3.client("s3").get_object(Bucket=bucket_name, Key=key)["Body"].read()
+    with open(path, "rb") as source_file:
+        return source_file.read()
+
+
+def build_envelopes(file_name, raw_data, auth, rows_per_chunk=ROWS_PER_CHUNK):
+    """
+    Function to turn one raw Landmark file into TechOne envelopes.
+    Chunks are cut and named exactly as the processor does, so outputs line up
+    with the queue/ keys of a live run.
+    Yields (chunk name, envelope, row count, rejected-rows report or None).
+    """
+    encoding = detect_encoding(raw_data[:ENCODING_SAMPLE_SIZE])
+    csv_rows = list(
+        csv.reader(
+            io.TextIOWrapper(io.BytesIO(raw_data), encoding=encoding, newline="")
+        )
+    )
+    if not csv_rows:
+        return
+    header = canonical_headers(csv_rows[0])
+
+    for idx, start_index in enumerate(range(0, len(csv_rows), rows_per_chunk)):
+        end_index = min(start_index + rows_per_chunk, len(csv_rows))
+        chunk_name = f"{file_name}_{start_index}_{end_index - 1}_{idx + 1}"
+        data_rows = csv_rows[max(start_index, 1) : end_index]
+
+        row_lines, reasons = transform_rows(header, data_rows)
+        report = None
+        if reasons:
+            report = rejected_rows_report(
+                chunk_name, data_rows, reasons, row_offset=max(start_index, 1)
+            )
+        envelope = soap_envelope(
+            auth["user_id"], auth["password"], auth["config"], wrap_rows(row_lines)
+        )
+        yield chunk_name, envelope, len(row_lines), report
+
+
+def write_output(output, name, body, content_type):
+    """
+    Function to write one output to a local directory or an S3 prefix
+    """
+    bucket_name, prefix = split_location(output)
+    if bucket_name:
+        boto3.client("s3").put_object(
+            Body=body.encode("utf-8"),
+            Bucket=bucket_name,
+            Key=f"{prefix.rstrip('/')}/{name}" if prefix else name,
+            ContentType=content_type,
+        )
+    else:
+        with open(os.path.join(output, name), "w", encoding="utf-8") as output_file:
+            output_file.write(body)
+
+
+def post_envelope(endpoint, envelope, options):
+    """
+    Function to post one envelope to a TechOne SOAP endpoint.
+    Returns the HTTP status code.
+    """
+    import requests  # only needed when posting
+
+    headers = {"Accept": "text/xml", "Content-Type": "text/xml"}
+    if options.get("soap_action"):
+        headers["SOAPAction"] = options["soap_action"]
+    if options.get("token"):
+        headers["Authorization"] = options["token"]
+    response = requests.post(  # timeout set below, from the options  # nosec B113
+        endpoint,
+        headers=headers,
+        data=envelope.encode("utf-8"),
+        timeout=options.get("timeout") or 240,
+    )
+    return response.status_code
+
+
+def backfill_file(path, options):
+    """
+    Function to reprocess one raw file. Runs in a worker process.
+    Returns the file's stats.
+    """
+    start_time = time.perf_counter()
+    file_name = path.rstrip("/").split("/")[-1]
+    raw_data = read_source(path)
+    stats = {
+        "file_name": file_name,
+        "bytes": len(raw_data),
+        "chunks": 0,
+        "rows": 0,
+        "rejected": 0,
+        "failed_posts": 0,
+    }
+
+    for chunk_name, envelope, row_count, report in build_envelopes(
+        file_name,
+        raw_data,
+        options["auth"],
+        options.get("rows_per_chunk", ROWS_PER_CHUNK),
+    ):
+        stats["chunks"] += 1
+        stats["rows"] += row_count
+        if report:
+            stats["rejected"] += report["rejected_count"]
+        if options.get("output"):
+            write_output(options["output"], f"{chunk_name}.xml", envelope, "text/xml")
+            if report:
+                write_output(
+                    options["output"],
+                    f"{chunk_name}.rejected.json",
+                    json.dumps(report, separators=(",", ":")),
+                    "application/json",
+                )
+        if options.get("endpoint"):
+            status_code = post_envelope(options["endpoint"], envelope, options)
+            if status_code != 200:
+                logger.error(f"{chunk_name}: TechOne answered {status_code}")
+                stats["failed_posts"] += 1
+
+    stats["seconds"] = time.perf_counter() - start_time
+    return stats
+
+
+def load_auth(secret_name=None):
+    """
+    Function to read the TechOne SOAP credentials for the envelopes.
+    Without a secret the Auth element is left blank, which is fine for
+    outputs that are only inspected.
+    """
+    if not secret_name:
+        return dict.fromkeys(("user_id", "password", "config"), "")
+    secret = json.loads(
+        boto3.client("secretsmanager").get_secret_value(SecretId=secret_name)[
+            "SecretString"
+        ]
+    )
+    return {
+        "user_id": secret["UserId"],
+        "password": secret["Password"],
+        "config": secret["Config"],
+    }
@@ -0,0 +1,113 @@
+import codecs
+import re
+from encodings import cp1252
+
+# Enough of the file to include the header, which holds the en dashes that
+# give a windows-1252 export away
+ENCODING_SAMPLE_SIZE = 64 * 1024
+
+# Dash variants seen in Landmark headers, depending on how the bytes were
+# decoded: windows-1252 en/em dash, or the C1 control characters that latin-1
+# ("charmap") decodes the same bytes to
+HEADER_DASHES = re.compile("[\x96\x97\u2013\u2014]")
+HEADER_SPACES = re.compile(r"\s+")
+
+# The sample only covers the start of the file, so the detected encoding is
+# decoded with one of these, which never fail on a byte later in the file.
+# utf-8-cp1252 decodes UTF-8, taking any byte that is not valid UTF-8 as
+# windows-1252; cp1252-latin1 decodes windows-1252. Both take the five bytes
+# windows-1252 leaves undefined as latin-1, as the old "charmap" decode did
+UTF8_CP1252_ENCODING = "utf-8-cp1252"
+CP1252_LATIN1_ENCODING = "cp1252-latin1"
+CP1252_FALLBACK_ERRORS = "cp1252-fallback"
+
+
+def cp1252_fallback(error):
+    """
+    Codec error handler decoding one undecodable byte as windows-1252
+    """
+    byte = error.object[error.start : error.start + 1]
+    try:
+        return byte.decode("cp1252"), error.start + 1
+    except UnicodeDecodeError:
+        return byte.decode("latin-1"), error.start + 1
+
+
+class Utf8Cp1252IncrementalDecoder(codecs.BufferedIncrementalDecoder):
+    def _buffer_decode(self, input, errors, final):
+        return codecs.utf_8_decode(input, CP1252_FALLBACK_ERRORS, final)
+
+
+class Cp1252Latin1IncrementalDecoder(codecs.IncrementalDecoder):
+    def decode(self, input, final=False):
+        return codecs.charmap_decode(
+            input, CP1252_FALLBACK_ERRORS, cp1252.decoding_table
+        )[0]
+
+
+def search_codec(name):
+    name = name.replace("_", "-")
+    if name == UTF8_CP1252_ENCODING:
+        return codecs.CodecInfo(
+            name=UTF8_CP1252_ENCODING,
+            encode=codecs.utf_8_encode,
+            decode=lambda input, errors="strict": codecs.utf_8_decode(
+                input, CP1252_FALLBACK_ERRORS, True
+            ),
+            incrementalencoder=codecs.getincrementalencoder("utf-8"),
+            incrementaldecoder=Utf8Cp1252IncrementalDecoder,
+        )
+    if name == CP1252_LATIN1_ENCODING:
+        return codecs.CodecInfo(
+            name=CP1252_LATIN1_ENCODING,
+            encode=codecs.getencoder("cp1252"),
+            decode=lambda input, errors="strict": codecs.charmap_decode(
+                input, CP1252_FALLBACK_ERRORS, cp1252.decoding_table
+            ),
+            incrementalencoder=codecs.getincrementalencoder("cp1252"),
+            incrementaldecoder=Cp1252Latin1IncrementalDecoder,
+        )
+    return None
+
+
+codecs.register_error(CP1252_FALLBACK_ERRORS, cp1252_fallback)
+codecs.register(search_codec)
+
+
+def detect_encoding(sample):
+    """
+    Function to detect the encoding of a Landmark file from a sample of its
+    bytes and return the codec to decode the whole file with.
+    A UTF-8 or all-ASCII sample gets utf-8-cp1252 and a windows-1252 sample
+    gets cp1252-latin1, so a stray byte after the sample cannot fail the file.
+    """
+    if sample.startswith(codecs.BOM_UTF8):
+        return "utf-8-sig"
+    if sample.isascii():
+        return UTF8_CP1252_ENCODING
+    try:
+        # Incremental decode so a character cut at the end of the sample is fine
+        codecs.getincrementaldecoder("utf-8")().decode(sample, final=False)
+        return UTF8_CP1252_ENCODING
+    except UnicodeDecodeError:
+        pass
+    try:
+        sample.decode("cp1252")
+        return CP1252_LATIN1_ENCODING
+    except UnicodeDecodeError:
+        return "latin-1"
+
+
+def canonical_header(name):
+    """
+    Function to canonicalise a header name, e.g.
+    "Subtotal \\x96 Sales Area Code" -> "Subtotal - Sales Area Code"
+    """
+    if name is None:
+        return None
+    name = HEADER_DASHES.sub("-", name.lstrip("\ufeff"))
+    return HEADER_SPACES.sub(" ", name).strip()
+
+
+def canonical_headers(names):
+    return [canonical_header(name) for name in names]
@@ -0,0 +1,259 @@
+import json
+import logging
+import math
+import random
+import re
+import threading
+import time
+import uuid
+import boto3
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger("billing_common")
+logger.setLevel(logging.INFO)
+
+SUCCESS = "success"
+TIMEOUT = "timeout"
+THROTTLED = "throttled"
+SERVER_ERROR = "server_error"
+CLIENT_ERROR = "client_error"
+# The call never reached TechOne, e.g. the chunk could not be read
+NOT_CALLED = "not_called"
+
+# Outcomes that mean TechOne is overloaded or degraded
+CONGESTION_OUTCOMES = (TIMEOUT, THROTTLED, SERVER_ERROR)
+
+SAVE_ATTEMPTS = 5
+# Base of the jittered exponential backoff between conflicting saves
+SAVE_BACKOFF_SECONDS = 0.05
+
+# A SOAP fault is TechOne rejecting the request, whatever the HTTP status
+SOAP_FAULT_PATTERN = re.compile(r"<(?:[\w.-]+:)?Fault[\s>]")
+
+
+class LocalStateBackend:
+    """
+    Keeps limiter state in memory, shared by everything in one process
+    (one warm Lambda container, or a local tool)
+    """
+
+    def __init__(self):
+        self.state = None
+        self.version = 0
+        self.lock = threading.Lock()
+
+    def load(self):
+        return (json.loads(self.state) if self.state else None), self.version
+
+    def save(self, state, version):
+        with self.lock:
+            if version != self.version:
+                return False
+            self.state = json.dumps(state)
+            self.version += 1
+            return True
+
+
+class S3StateBackend:
+    """
+    Keeps limiter state in one small S3 object shared by every consumer.
+    Updates use the object's ETag as an optimistic lock. Every call writes
+    the object, so keep it in a bucket without versioning or replication.
+    """
+
+    def __init__(self, bucket_name, key):
+        self.bucket_name = bucket_name
+        self.key = key
+        self.s3 = boto3.client("s3")
+
+    def load(self):
+        try:
+            response = self.s3.get_object(Bucket=self.bucket_name, Key=self.key)
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+                return None, None
+            raise e
+        return json.loads(response["Body"].read()), response["ETag"]
+
+    def save(self, state, version):
+        condition = {"IfMatch": version} if version else {"IfNoneMatch": "*"}
+        try:
+            self.s3.put_object(
+                Body=json.dumps(state).encode("utf-8"),
+                Bucket=self.bucket_name,
+                Key=self.key,
+                ContentType="application/json",
+                **condition,
+            )
+            return True
+        except ClientError as e:
+            if e.response["Error"]["Code"] in (
+                "PreconditionFailed",
+                "ConditionalRequestConflict",
+                "412",
+                "409",
+            ):
+                return False
+            raise e
+
+
+class AdaptiveLimiter:
+    """
+    AIMD concurrency limiter with a circuit breaker for calls to TechOne.
+    The limit grows by about `increase` per limit's worth of fast successes
+    and is multiplied by `decrease_factor` on timeouts, 429s and 5xx.
+    After `failure_threshold` congestion failures in a row the breaker opens
+    and callers are refused for `open_seconds`; then a single probe call is
+    let through and its outcome closes or re-opens the breaker.
+    In-flight calls are held as leases that expire, so a crashed caller
+    cannot hold a slot forever.
+    """
+
+    def __init__(
+        self,
+        backend,
+        min_limit=1,
+        max_limit=10,
+        initial_limit=2,
+        increase=1.0,
+        decrease_factor=0.5,
+        target_latency=30.0,
+        failure_threshold=3,
+        open_seconds=120,
+        lease_seconds=900,
+    ):
+        self.backend = backend
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.initial_limit = initial_limit
+        self.increase = increase
+        self.decrease_factor = decrease_factor
+        self.target_latency = target_latency
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.lease_seconds = lease_seconds
+
+    def new_state(self):
+        return {
+            "limit": float(self.initial_limit),
+            "leases": {},
+            "consecutive_failures": 0,
+            "opened_at": None,
+            "probe_lease": None,
+        }
+
+    def update(self, change):
+        """
+        Function to apply change(state, now) under the backend's optimistic
+        lock, retrying on conflicting writes with jittered backoff.
+        Returns what change returned.
+        """
+        for attempt in range(SAVE_ATTEMPTS):
+            if attempt:
+                # Jitter only, so the standard generator is fine
+                backoff = SAVE_BACKOFF_SECONDS * 2**attempt
+                time.sleep(random.uniform(0, backoff))  # nosec B311
+            state, version = self.backend.load()
+            state = state or self.new_state()
+            before = json.dumps(state, sort_keys=True)
+            now = time.time()
+            state["leases"] = {
+                lease: expires
+                for lease, expires in state["leases"].items()
+                if expires > now
+            }
+            result = change(state, now)
+            if version is not None and json.dumps(state, sort_keys=True) == before:
+                return result
+            if self.backend.save(state, version):
+                return result
+        raise RuntimeError(
+            "Could not update limiter state, too many conflicting writers"
+        )
+
+    def try_acquire(self):
+        """
+        Function to ask for a slot. Returns (lease, reason); lease is None when
+        the call must not go ahead and reason says why.
+        """
+
+        def change(state, now):
+            if state["opened_at"] is not None:
+                if now - state["opened_at"] < self.open_seconds:
+                    return None, "circuit open"
+                if state["probe_lease"] in state["leases"]:
+                    return None, "circuit half-open, probe in flight"
+                lease = uuid.uuid4().hex
+                state["leases"][lease] = now + self.lease_seconds
+                state["probe_lease"] = lease
+                return lease, "circuit half-open, probing"
+            if len(state["leases"]) >= math.floor(state["limit"]):
+                return None, f"concurrency limit {math.floor(state['limit'])} reached"
+            lease = uuid.uuid4().hex
+            state["leases"][lease] = now + self.lease_seconds
+            return lease, "admitted"
+
+        return self.update(change)
+
+    def release(self, lease, latency, outcome):
+        """
+        Function to return a slot and feed the call's latency and outcome
+        back into the limit and the circuit breaker
+        """
+
+        def change(state, now):
+            state["leases"].pop(lease, None)
+            probe = state["probe_lease"] == lease
+            if probe:
+                state["probe_lease"] = None
+
+            if outcome in CONGESTION_OUTCOMES:
+                state["limit"] = max(
+                    self.min_limit, state["limit"] * self.decrease_factor
+                )
+                state["consecutive_failures"] += 1
+                if probe or state["consecutive_failures"] >= self.failure_threshold:
+                    state["opened_at"] = now
+            elif outcome == SUCCESS:
+                state["consecutive_failures"] = 0
+                state["opened_at"] = None
+                if latency <= self.target_latency:
+                    state["limit"] = min(
+                        self.max_limit,
+                        state["limit"] + self.increase / max(state["limit"], 1.0),
+                    )
+            elif probe and outcome == CLIENT_ERROR:
+                # TechOne answered, it just did not like the request
+                state["opened_at"] = None
+            return state["limit"], state["opened_at"] is not None
+
+        limit, is_open = self.update(change)
+        logger.info(
+            f"Limiter: outcome {outcome} in {latency:.1f}s, limit {limit:.2f}"
+            + (", circuit open" if is_open else "")
+        )
+        return limit
+
+
+def is_soap_fault(body):
+    return isinstance(body, str) and SOAP_FAULT_PATTERN.search(body) is not None
+
+
+def classify_status_code(status_code, body=None):
+    """
+    Function to map a TechOne HTTP status code, and the response body when
+    there is one, to a limiter outcome. SOAP faults come back as HTTP 500
+    but mean the request was rejected (bad data), not that TechOne is
+    degraded.
+    """
+    if status_code >= 400 and is_soap_fault(body):
+        return CLIENT_ERROR
+    if status_code == 429:
+        return THROTTLED
+    if status_code == 504 or status_code == 408:
+        return TIMEOUT
+    if status_code >= 500:
+        return SERVER_ERROR
+    if status_code >= 400:
+        return CLIENT_ERROR
+    return SUCCESS
@@ -0,0 +1,220 @@
+import cProfile
+import datetime
+import functools
+import io
+import json
+import logging
+import os
+import pstats
+import random
+import tempfile
+import time
+import tracemalloc
+import boto3
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger("billing_common")
+logger.setLevel(logging.INFO)
+
+PROFILE_PREFIX = "profiles"
+# How long a warm container keeps the SSM setting before reading it again
+PARAMETER_CACHE_SECONDS = 60
+TOP_ENTRIES = 30
+TRACEMALLOC_FRAMES = 5
+
+parameter_cache = {"value": None, "expires": 0.0}
+
+
+def parse_settings(value):
+    """
+    Function to read profiling settings given as true/false, a sample rate
+    ("0.1") or JSON ({"sample_rate": 0.1, "top": 50}).
+    Returns {"sample_rate", "top"}, or None when profiling is off.
+    """
+    if isinstance(value, str):
+        try:
+            value = json.loads(value)
+        except ValueError:
+            return None
+    if value is True:
+        value = {"sample_rate": 1.0}
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        value = {"sample_rate": value}
+    if not isinstance(value, dict):
+        return None
+    try:
+        sample_rate = min(float(value.get("sample_rate", 1.0)), 1.0)
+        top = int(value.get("top", TOP_ENTRIES))
+    except (TypeError, ValueError):
+        return None
+    if sample_rate <= 0:
+        return None
+    return {"sample_rate": sample_rate, "top": top}
+
+
+def read_parameter_settings():
+    """
+    Function to read the settings from the SSM parameter named by
+    PROFILING_PARAMETER, cached for PARAMETER_CACHE_SECONDS. Any error
+    reading it leaves profiling off rather than failing the handler.
+    """
+    parameter_name = os.environ.get("PROFILING_PARAMETER")
+    if not parameter_name:
+        return None
+    if time.monotonic() < parameter_cache["expires"]:
+        return parameter_cache["value"]
+    try:
+        value = boto3.client("ssm").get_parameter(Name=parameter_name)["Parameter"][
+            "Value"
+        ]
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "ParameterNotFound":
+            logger.error(f"Could not read profiling parameter {parameter_name}: {e}")
+        value = None
+    except Exception as e:
+        # e.g. BotoCoreError when SSM cannot be reached
+        logger.error(f"Could not read profiling parameter {parameter_name}: {e}")
+        value = None
+    parameter_cache["value"] = parse_settings(value)
+    parameter_cache["expires"] = time.monotonic() + PARAMETER_CACHE_SECONDS
+    return parameter_cache["value"]
+
+
+def profiling_settings(event):
+    """
+    Function to decide whether to profile an invocation. A "profile" key in
+    the event takes precedence over the SSM parameter.
+    """
+    if isinstance(event, dict) and "profile" in event:
+        return parse_settings(event["profile"])
+    return read_parameter_settings()
+
+
+def top_functions(profiler, top):
+    stats = pstats.Stats(profiler, stream=io.StringIO()).sort_stats("cumulative")
+    functions = []
+    for file_name, line, name in stats.fcn_list[:top]:
+        calls, primitive_calls, total_time, cumulative_time, _ = stats.stats[
+            (file_name, line, name)
+        ]
+        functions.append(
+            {
+                "function": f"{file_name}:{line}({name})",
+                "calls": calls,
+                "total_seconds": round(total_time, 4),
+                "cumulative_seconds": round(cumulative_time, 4),
+            }
+        )
+    return functions
+
+
+def top_allocations(snapshot, top):
+    return [
+        {
+            "site": str(statistic.traceback[0]),
+            "traceback": [str(frame) for frame in statistic.traceback],
+            "size_kb": round(statistic.size / 1024, 1),
+            "count": statistic.count,
+        }
+        for statistic in snapshot.statistics("traceback")[:top]
+    ]
+
+
+def write_profile(bucket_name, key_prefix, profiler, report):
+    """
+    Function to write the pstats dump and the report under key_prefix
+    """
+    s3 = boto3.client("s3")
+    with tempfile.NamedTemporaryFile(
+        suffix=".pstats", dir=tempfile.gettempdir()
+    ) as stats_file:
+        profiler.dump_stats(stats_file.name)
+        stats_file.seek(0)
+        s3.put_object(
+            Body=stats_file.read(),
+            Bucket=bucket_name,
+            Key=f"{key_prefix}.pstats",
+            ContentType="application/octet-stream",
+        )
+    s3.put_object(
+        Body=json.dumps(report, indent=1).encode("utf-8"),
+        Bucket=bucket_name,
+        Key=f"{key_prefix}.json",
+        ContentType="application/json",
+    )
+    logger.info(f"Profile written to s3://{bucket_name}/{key_prefix}.pstats")
+
+
+def run_profiled(handler, event, context, settings):
+    """
+    Function to run one handler invocation under cProfile and tracemalloc and
+    write the results to PROFILE_PREFIX in PROFILING_BUCKET
+    """
+    function_name = getattr(context, "function_name", None) or os.environ.get(
+        "AWS_LAMBDA_FUNCTION_NAME", handler.__module__
+    )
+    request_id = getattr(context, "aws_request_id", None)
+    if not request_id:
+        # Only correlates the log lines, so the standard generator is fine
+        request_id = f"{random.getrandbits(32):08x}"  # nosec B311
+    started_at = datetime.datetime.now(datetime.timezone.utc)
+
+    already_tracing = tracemalloc.is_tracing()
+    if not already_tracing:
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+    tracemalloc.reset_peak()
+    profiler = cProfile.Profile()
+    start_time = time.perf_counter()
+    profiler.enable()
+    try:
+        return handler(event, context)
+    finally:
+        profiler.disable()
+        seconds = time.perf_counter() - start_time
+        snapshot = tracemalloc.take_snapshot()
+        current_bytes, peak_bytes = tracemalloc.get_traced_memory()
+        if not already_tracing:
+            tracemalloc.stop()
+
+        bucket_name = os.environ.get("PROFILING_BUCKET")
+        if not bucket_name:
+            logger.error("Profiling is on but PROFILING_BUCKET is not set")
+        else:
+            key_prefix = (
+                f"{PROFILE_PREFIX}/{function_name}/"
+                f"{started_at.strftime('%Y%m%dT%H%M%SZ')}_{request_id}"
+            )
+            try:
+                report = {
+                    "function_name": function_name,
+                    "request_id": request_id,
+                    "started_at": started_at.isoformat(),
+                    "seconds": round(seconds, 3),
+                    "peak_traced_mb": round(peak_bytes / (1024 * 1024), 2),
+                    "retained_traced_mb": round(current_bytes / (1024 * 1024), 2),
+                    "top_functions": top_functions(profiler, settings["top"]),
+                    "top_allocations": top_allocations(snapshot, settings["top"]),
+                }
+                write_profile(bucket_name, key_prefix, profiler, report)
+            except Exception as e:
+                # Never fail the invocation over its profile
+                logger.error(f"Could not write profile {key_prefix}: {e}")
+
+
+def profiled(handler):
+    """
+    Decorator for Lambda handlers. A sampled share of invocations is run
+    under cProfile and tracemalloc when the event has a "profile" key, or
+    the PROFILING_PARAMETER SSM parameter, is set.
+    """
+
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        settings = profiling_settings(event)
+        # Sampling only, so the standard generator is fine
+        roll = random.random()  # nosec B311
+        if settings is None or roll >= settings["sample_rate"]:
+            return handler(event, context)
+        return run_profiled(handler, event, context, settings)
+
+    return wrapper
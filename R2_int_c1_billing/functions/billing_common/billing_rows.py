@@ -0,0 +1,279 @@
+import datetime
+import logging
+
+# Only escapes the envelope text, nothing is parsed
+from xml.sax.saxutils import escape  # nosec B406
+from billing_validation import validate_list_rows
+
+logger = logging.getLogger("billing_common")
+logger.setLevel(logging.INFO)
+
+# Chunk objects written in this format hold one ready-to-embed <ns1:Row>
+# payload per line instead of CSV
+TECHONE_ROWS_FORMAT = "techone-rows"
+
+# Newlines inside a field are written as character references so each row
+# stays on a single line of the chunk object
+ROW_LINE_ENTITIES = {"\n": "&#10;", "\r": "&#13;"}
+
+
+def strip_embedded_quotes(row_billing):
+    """
+    Function to remove double quotes from inside field values, which would
+    otherwise break the quoted TechOne row text
+    """
+    cleaned_row = {}
+    for key, value in row_billing.items():
+        if isinstance(value, str) and '"' in value:
+            logger.info(
+                f'Double quotes found in key "{key}", value: "{value}", row: "{row_billing}"'
+            )
+            value = value.replace('"', "")  # remove the quotes.
+        cleaned_row[key] = value
+    return cleaned_row
+
+
+def change_date_format(row_billing):
+    """
+    Function to change date to dd/mm/yyyy format
+    """
+    try:
+        source_format = "%d%m%Y"
+        target_format = "%d/%m/%Y"
+        # row_billing_str_split = row_billing_str.split(",")
+        i_start_date = row_billing["Start Date"]
+        i_start_date_len = len(row_billing["Start Date"])
+        # logger.info(f"i_start_date_len :{i_start_date_len}")
+        if i_start_date_len == 7:
+            i_start_date = "0" + str(i_start_date)
+        i_end_date = row_billing["End Date"]
+        i_end_date_len = len(row_billing["End Date"])
+
+        # logger.info(f"i_end_date_len :{i_end_date_len}")
+        if i_end_date_len == 7:
+            i_end_date = "0" + str(i_end_date)
+        i_campaign_start_date = row_billing["Campaign Billing Start Date"]
+        i_campaign_start_date_len = len(i_campaign_start_date)
+        # logger.info(f"i_campaign_start_date_len: {i_campaign_start_date_len}")
+        i_campaign_end_date = row_billing["Campaign Billing End Date"]
+        i_campaign_end_date_len = len(i_campaign_end_date)
+        # logger.info(f"i_campaign_end_date_len: {i_campaign_end_date_len}")
+        if i_campaign_start_date_len == 7:
+            i_campaign_start_date = "0" + str(i_campaign_start_date)
+        if i_campaign_end_date_len == 7:
+            i_campaign_end_date = "0" + str(i_campaign_end_date)
+        start_date = datetime.datetime.strptime(i_start_date, source_format).strftime(
+            target_format
+        )
+        end_date = datetime.datetime.strptime(i_end_date, source_format).strftime(
+            target_format
+        )
+        campaign_start_date = datetime.datetime.strptime(
+            i_campaign_start_date, source_format
+        ).strftime(target_format)
+        campaign_end_date = datetime.datetime.strptime(
+            i_campaign_end_date, source_format
+        ).strftime(target_format)
+        # replace_dic = {
+        #    i_start_date: start_date,
+        #    i_end_date: end_date,
+        #    i_campaign_start_date: campaign_start_date,
+        #    i_campaign_end_date: campaign_end_date,
+        # }
+        # row_billing_str = replace_all(row_billing_str, replace_dic)
+        row_billing["Start Date"] = start_date
+        row_billing["End Date"] = end_date
+        row_billing["Campaign Billing Start Date"] = campaign_start_date
+        row_billing["Campaign Billing End Date"] = campaign_end_date
+
+        return row_billing
+    except Exception as e:
+        logger.error(f"Error converting in row: {row_billing}. Error: {e}")
+
+
+def str_field_handling(row_billing):
+    """
+    Function to add double quotes to the string fields.
+    Numeric and Date fields will be ignored
+    """
+    # row_billing_str_split = row_billing_str.split(",")
+    # Double quote will be added to belowString field
+    business_area_code = row_billing["Business Area"]
+    sales_rep = row_billing["Sales Rep"]
+    sales_group = row_billing["Sales Group"]
+    sales_office = row_billing["Sales Office"]
+    transaction_type = row_billing["Transaction Type"]
+    goods_received = row_billing["Goods Received"]
+    campaign_type = row_billing["Campaign Type"]
+    crmid = row_billing["CRMID"]
+    billing_account_name = row_billing["Billing Account Name"]
+    primary_advertiser = row_billing["Primary Advertiser"]
+    campaign_name = row_billing["Campaign Name"]
+    revenue_type = row_billing["Revenue Type"]
+    invoice_currency = row_billing["Invoice Currency"]
+    external_po_number = row_billing["PO Number"]
+    subtotal_salesarea_code = row_billing["Subtotal - Sales Area Code"]
+    subtotal_salesarea = row_billing["Subtotal - Sales Area"]
+    tax = row_billing["Tax"]
+
+    # Double quotes should not be added to Numeric and Date fields.
+    # Numeric fields
+    general_ledger_code = row_billing["General Ledger Code"]
+    campaign_reference = row_billing["Campaign Reference"]
+    invoice_number = row_billing["Invoice Number"]
+    line_number = row_billing["Line Number"]
+    subtotal_line = row_billing["Subtotal Line"]
+    agency_commision = row_billing["Agency Commission"]
+
+    # Date Column
+    i_start_date = row_billing["Start Date"]
+    i_end_date = row_billing["End Date"]
+    i_campaign_start_date = row_billing["Campaign Billing Start Date"]
+    i_campaign_end_date = row_billing["Campaign Billing End Date"]
+
+    journal_comments = row_billing["Journal Comments"]
+    journal_type = row_billing["Journal Type"]
+    product_code = row_billing["Product Code"]
+    product_name = row_billing["Product Name"]
+
+    field_list = [
+        general_ledger_code,
+        business_area_code,
+        sales_rep,
+        sales_group,
+        sales_office,
+        transaction_type,
+        goods_received,
+        campaign_type,
+        crmid,
+        billing_account_name,
+        primary_advertiser,
+        i_start_date,
+        i_end_date,
+        campaign_reference,
+        campaign_name,
+        revenue_type,
+        invoice_currency,
+        invoice_number,
+        line_number,
+        external_po_number,
+        subtotal_salesarea_code,
+        subtotal_salesarea,
+        tax,
+        subtotal_line,
+        agency_commision,
+        i_campaign_start_date,
+        i_campaign_end_date,
+        journal_comments,
+        journal_type,
+        product_code,
+        product_name,
+    ]
+    modified_row_billing_str = ""
+
+    for index, field in enumerate(field_list):
+        # Double quotes will not be added for below fields
+        if index in [0, 11, 12, 13, 17, 18, 23, 24, 25, 26, 28, 29]:
+            modified_row_billing_str += field + ","
+        else:
+            field_quote = f'"{field}"'
+            modified_row_billing_str += field_quote + ","
+
+    modified_row_billing_str = modified_row_billing_str[:-1]
+    return modified_row_billing_str
+
+
+def soap_envelope(user_id, password, config, rows_xml=""):
+    """
+    Function to build the TechOne Warehouse_DoImport SOAP envelope.
+    rows_xml is embedded as-is inside <ns1:Rows>.
+    """
+    soap_request = (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        + "<soapenv:Envelope"
+        + ' xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/" '
+        + ' xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+        + ' xmlns:ns1="http://TechnologyOneCorp.com/Public/Services"> '
+        + "   <soapenv:Header/> "
+        + "   <soapenv:Body> "
+        + "     <ns1:Warehouse_DoImport> "
+        + '         <ns1:request WarehouseName="SALESFORCE" WarehouseTableName="BILLINGDATA" ImportMode="MixedMode"> '
+        + '            <ns1:Auth UserId="'
+        + user_id
+        + '" Password="'
+        + password
+        + '" Config="'
+        + config
+        + '" FunctionName="$E1.BI.WHT.DOIMP.WS"/> '
+        + "            <ns1:Columns> "
+        + '               <ns1:ColumnInfo Name="GENERALLEDGERCODE"/>'
+        + '               <ns1:ColumnInfo Name="BUSINESSAREACODE"/>'
+        + '               <ns1:ColumnInfo Name="SALESREP"/>'
+        + '               <ns1:ColumnInfo Name="SALESGROUP"/> '
+        + '               <ns1:ColumnInfo Name="SALESOFFICE"/> '
+        + '               <ns1:ColumnInfo Name="TRANSACTIONTYPE"/> '
+        + '               <ns1:ColumnInfo Name="GOODSRECEIVED"/>'
+        + '               <ns1:ColumnInfo Name="CAMPAIGNTYPE"/>'
+        + '               <ns1:ColumnInfo Name="CRMID"/>'
+        + '               <ns1:ColumnInfo Name="BILLINGACCOUNTNAME"/>'
+        + '               <ns1:ColumnInfo Name="PRIMARYADVERTISER"/>'
+        + '               <ns1:ColumnInfo Name="STARTDATE"/> '
+        + '               <ns1:ColumnInfo Name="ENDDATE"/> '
+        + '               <ns1:ColumnInfo Name="CAMPAIGNREFERENCE"/>'
+        + '               <ns1:ColumnInfo Name="CAMPAIGNNAME"/>'
+        + '               <ns1:ColumnInfo Name="REVENUETYPE"/>'
+        + '               <ns1:ColumnInfo Name="INVOICECURRENCY"/>'
+        + '               <ns1:ColumnInfo Name="INVOICENUMBER"/>'
+        + '               <ns1:ColumnInfo Name="LINENUMBER"/>'
+        + '               <ns1:ColumnInfo Name="EXTERNALPONUMBER"/>'
+        + '               <ns1:ColumnInfo Name="SUBTOTALSALESAREACODE"/>'
+        + '               <ns1:ColumnInfo Name="SUBTOTALSALESAREA"/>'
+        + '               <ns1:ColumnInfo Name="TAX"/>'
+        + '               <ns1:ColumnInfo Name="SUBTOTALLINE"/>'
+        + '               <ns1:ColumnInfo Name="AGENCYCOMMISSION"/>'
+        + '               <ns1:ColumnInfo Name="CAMPAIGNBILLINGSTARTDATE"/> '
+        + '               <ns1:ColumnInfo Name="CAMPAIGNBILLINGENDDATE"/> '
+        + '               <ns1:ColumnInfo Name="JOURNALCOMMENTS"/> '
+        + '               <ns1:ColumnInfo Name="JOURNALTYPE"/> '
+        + '               <ns1:ColumnInfo Name="PRODUCTCODE"/> '
+        + '               <ns1:ColumnInfo Name="PRODUCTNAME"/> '
+        + "            </ns1:Columns> "
+        + "            <ns1:Rows> "
+        + rows_xml
+        + "            </ns1:Rows> "
+        + "         </ns1:request> "
+        + "      </ns1:Warehouse_DoImport> "
+        + "   </soapenv:Body> "
+        + "</soapenv:Envelope> "
+    )
+
+    return soap_request
+
+
+def row_to_techone_line(row_billing):
+    """
+    Function to convert a billing row dict into the XML-escaped text of a
+    single <ns1:Row> element
+    """
+    row_billing = change_date_format(strip_embedded_quotes(row_billing))
+    return escape(str_field_handling(row_billing), ROW_LINE_ENTITIES)
+
+
+def wrap_rows(row_lines):
+    """
+    Function to wrap pre-transformed row lines in <ns1:Row> elements
+    """
+    return "".join(f"<ns1:Row>{row_line}</ns1:Row>" for row_line in row_lines)
+
+
+def transform_rows(header, rows):
+    """
+    Function to validate parsed CSV rows and transform the good ones into
+    TechOne row lines.
+    Returns (row_lines, reasons), reasons maps rejected row index to failures.
+    """
+    mask, reasons = validate_list_rows(header, rows)
+    row_lines = [
+        row_to_techone_line(dict(zip(header, row))) for row, ok in zip(rows, mask) if ok
+    ]
+    return row_lines, reasons
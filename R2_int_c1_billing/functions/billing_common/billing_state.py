@@ -0,0 +1,154 @@
+import json
+import logging
+import boto3
+from botocore.exceptions import ClientError
+
+from billing_tracker import now_iso
+
+logger = logging.getLogger("billing_common")
+logger.setLevel(logging.INFO)
+
+# Queued is recorded by the processor (and the redrive tool) before a chunk's
+# message is sent, delivered and error by the consumer
+QUEUED = "queued"
+DELIVERED = "delivered"
+ERROR = "error"
+STATES = (QUEUED, DELIVERED, ERROR)
+
+STATE_PREFIX = "state"
+STATE_TAG = "delivery-state"
+
+# "ledger": tag the chunk and keep one small marker per chunk under
+# state/<state>/, the chunk itself never moves.
+# "prefix": the old behaviour, copy the chunk to <state>/ and delete it.
+LEDGER_MODE = "ledger"
+PREFIX_MODE = "prefix"
+
+
+def chunk_name(chunk_key):
+    return chunk_key.split("/")[-1]
+
+
+def state_marker_key(state, chunk_key):
+    return f"{STATE_PREFIX}/{state}/{chunk_name(chunk_key)}.json"
+
+
+def get_chunk_tags(s3, bucket_name, chunk_key):
+    """
+    Function to read a chunk's tag set, None when there is no chunk object
+    (byte-range chunks)
+    """
+    try:
+        return s3.get_object_tagging(Bucket=bucket_name, Key=chunk_key)["TagSet"]
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+            return None
+        raise e
+
+
+def tag_chunk_state(s3, bucket_name, chunk_key, state, tag_set):
+    """
+    Function to set the delivery-state tag on a chunk, keeping its other tags
+    """
+    tag_set = [tag for tag in tag_set if tag["Key"] != STATE_TAG]
+    tag_set.append({"Key": STATE_TAG, "Value": state})
+    s3.put_object_tagging(
+        Bucket=bucket_name, Key=chunk_key, Tagging={"TagSet": tag_set}
+    )
+
+
+def move_chunk(s3, bucket_name, chunk_key, destination_folder):
+    """
+    Function to move a chunk to another folder with copy and delete.
+    Compatibility mode only: it rewrites the whole object.
+    """
+    destination_key = f"{destination_folder}/{chunk_name(chunk_key)}"
+    try:
+        s3.copy_object(
+            CopySource={"Bucket": bucket_name, "Key": chunk_key},
+            Bucket=bucket_name,
+            Key=destination_key,
+        )
+        s3.delete_object(Bucket=bucket_name, Key=chunk_key)
+    except ClientError as e:
+        logger.error(f"Error moving file {chunk_key} to {destination_folder}: {e}")
+        return None
+    return destination_key
+
+
+def record_chunk_state(bucket_name, chunk_key, state, details=None, mode=LEDGER_MODE):
+    """
+    Function to record the delivery state of a chunk.
+    In ledger mode no chunk bytes are copied: the chunk is tagged and a small
+    marker is written under state/<state>/. Only the previous state's marker
+    is deleted, found from the chunk's tag (or its markers when untagged),
+    since every delete adds a delete marker to the versioned bucket.
+    Chunks without an object (byte-range) only get the marker.
+    """
+    if state not in STATES:
+        raise ValueError(f"Unknown delivery state: {state}")
+    s3 = boto3.client("s3")
+    if mode == PREFIX_MODE:
+        return move_chunk(s3, bucket_name, chunk_key, state)
+
+    tag_set = get_chunk_tags(s3, bucket_name, chunk_key)
+    previous = next(
+        (tag["Value"] for tag in tag_set or [] if tag["Key"] == STATE_TAG), None
+    ) or get_chunk_state(bucket_name, chunk_key)
+
+    document = {"chunk_key": chunk_key, "state": state, "updated_at": now_iso()}
+    document.update(details or {})
+    marker_key = state_marker_key(state, chunk_key)
+    s3.put_object(
+        Body=json.dumps(document).encode("utf-8"),
+        Bucket=bucket_name,
+        Key=marker_key,
+        ContentType="application/json",
+    )
+    if previous in STATES and previous != state:
+        s3.delete_object(Bucket=bucket_name, Key=state_marker_key(previous, chunk_key))
+
+    if tag_set is not None and previous != state:
+        tag_chunk_state(s3, bucket_name, chunk_key, state, tag_set)
+    logger.info(f"{chunk_key} is {state}")
+    return marker_key
+
+
+def get_chunk_state(bucket_name, chunk_key):
+    """
+    Function to look up the delivery state of one chunk, None if unknown
+    """
+    s3 = boto3.client("s3")
+    for state in STATES:
+        try:
+            s3.head_object(Bucket=bucket_name, Key=state_marker_key(state, chunk_key))
+            return state
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in ("NoSuchKey", "404", "NotFound"):
+                raise e
+    return None
+
+
+def list_chunks_in_state(bucket_name, state, file_name="", page_size=1000):
+    """
+    Function to list the chunks in a state, optionally for one source file.
+    Yields one batch (list) per listing page; each item has the chunk key and
+    when it entered the state, read from the listing without fetching markers.
+    """
+    s3 = boto3.client("s3")
+    prefix = f"{STATE_PREFIX}/{state}/{file_name}"
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(
+        Bucket=bucket_name, Prefix=prefix, PaginationConfig={"PageSize": page_size}
+    ):
+        batch = [
+            {
+                "chunk_key": "queue/"
+                + item["Key"][len(f"{STATE_PREFIX}/{state}/") : -len(".json")],
+                "state": state,
+                "updated_at": item.get("LastModified"),
+            }
+            for item in page.get("Contents", [])
+        ]
+        if batch:
+            yield batch
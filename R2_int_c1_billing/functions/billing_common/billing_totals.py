@@ -0,0 +1,301 @@
+import csv
+import json
+import logging
+from decimal import Decimal, InvalidOperation
+
+# Only unescapes our own transformed rows, nothing is parsed
+from xml.sax.saxutils import unescape  # nosec B406
+import boto3
+
+from billing_tracker import get_document, now_iso
+from billing_validation import EXPECTED_COLUMNS, validate_list_rows
+
+logger = logging.getLogger("billing_common")
+logger.setLevel(logging.INFO)
+
+RECONCILIATION_PREFIX = "reconciliation"
+
+CURRENCY_FIELD = "Invoice Currency"
+INVOICE_FIELD = "Invoice Number"
+# Summed per currency and per invoice
+SUM_FIELDS = ("Subtotal Line", "Agency Commission")
+# Landmark sends a tax code (e.g. "Y") here, so rows are counted per code
+TAX_FIELD = "Tax"
+
+# Row lines (techone-rows chunks) hold the columns in EXPECTED_COLUMNS order,
+# see str_field_handling
+ROW_LINE_ENTITIES = {"&#10;": "\n", "&#13;": "\r"}
+
+
+def to_decimal(value):
+    try:
+        return Decimal((value or "").strip() or "0")
+    except InvalidOperation:
+        return None
+
+
+class ControlTotals:
+    """
+    Running control totals for a set of billing rows: row count, sums and
+    tax code counts per currency, and sums per invoice number
+    """
+
+    def __init__(self):
+        self.row_count = 0
+        self.currencies = {}
+        self.invoices = {}
+
+    def add(self, row):
+        """
+        Function to add one row, a dict keyed by canonical header names
+        """
+        self.row_count += 1
+        currency = row.get(CURRENCY_FIELD) or ""
+        invoice = row.get(INVOICE_FIELD) or ""
+        currency_totals = self.currencies.setdefault(
+            currency,
+            {"rows": 0, "tax": {}, **{name: Decimal(0) for name in SUM_FIELDS}},
+        )
+        invoice_totals = self.invoices.setdefault(
+            invoice, {"rows": 0, **{name: Decimal(0) for name in SUM_FIELDS}}
+        )
+        currency_totals["rows"] += 1
+        invoice_totals["rows"] += 1
+        tax_code = row.get(TAX_FIELD) or ""
+        currency_totals["tax"][tax_code] = currency_totals["tax"].get(tax_code, 0) + 1
+        for name in SUM_FIELDS:
+            amount = to_decimal(row.get(name))
+            if amount is not None:
+                currency_totals[name] += amount
+                invoice_totals[name] += amount
+        return self
+
+    def add_list_rows(self, header, rows, mask=None):
+        positions = {name: header.index(name) for name in header}
+        for index, row in enumerate(rows):
+            if mask is None or mask[index]:
+                self.add(
+                    {
+                        name: row[position] if position < len(row) else ""
+                        for name, position in positions.items()
+                    }
+                )
+        return self
+
+    def add_dict_rows(self, rows):
+        for row in rows:
+            self.add(row)
+        return self
+
+    def add_row_lines(self, row_lines):
+        """
+        Function to add pre-transformed TechOne row lines. They parse as CSV
+        because transform_rows strips embedded double quotes from every field
+        and quotes the string fields, so commas stay inside their column.
+        """
+        for row in csv.reader(unescape(line, ROW_LINE_ENTITIES) for line in row_lines):
+            self.add(dict(zip(EXPECTED_COLUMNS, row)))
+        return self
+
+    def merge(self, other):
+        self.row_count += other.row_count
+        for target, source in (
+            (self.currencies, other.currencies),
+            (self.invoices, other.invoices),
+        ):
+            for key, totals in source.items():
+                merged = target.setdefault(
+                    key, {"rows": 0, **{name: Decimal(0) for name in SUM_FIELDS}}
+                )
+                merged["rows"] += totals["rows"]
+                for name in SUM_FIELDS:
+                    merged[name] += totals[name]
+                if "tax" in totals:
+                    tax = merged.setdefault("tax", {})
+                    for code, count in totals["tax"].items():
+                        tax[code] = tax.get(code, 0) + count
+        return self
+
+    def compact(self):
+        """
+        Function to return the totals without the per-invoice breakdown
+        """
+        return {
+            "row_count": self.row_count,
+            "invoice_count": len(self.invoices),
+            "currencies": {
+                currency: {
+                    key: str(value) if isinstance(value, Decimal) else value
+                    for key, value in totals.items()
+                }
+                for currency, totals in self.currencies.items()
+            },
+        }
+
+    def to_dict(self):
+        document = self.compact()
+        document["invoices"] = {
+            invoice: {
+                key: str(value) if isinstance(value, Decimal) else value
+                for key, value in totals.items()
+            }
+            for invoice, totals in self.invoices.items()
+        }
+        return document
+
+    @classmethod
+    def from_dict(cls, document):
+        totals = cls()
+        totals.row_count = document["row_count"]
+        for target, source in (
+            (totals.currencies, document.get("currencies", {})),
+            (totals.invoices, document.get("invoices", {})),
+        ):
+            for key, values in source.items():
+                target[key] = {
+                    name: Decimal(value) if name in SUM_FIELDS else value
+                    for name, value in values.items()
+                }
+        return totals
+
+
+def compare_totals(expected, actual):
+    """
+    Function to compare two totals documents (compact or full).
+    Invoices are compared only when both sides have them.
+    Returns the list of differences, empty when they agree.
+    """
+    differences = []
+    for key in ("row_count", "invoice_count"):
+        if expected.get(key) != actual.get(key):
+            differences.append(
+                f"{key}: expected {expected.get(key)}, got {actual.get(key)}"
+            )
+
+    for group in ("currencies", "invoices"):
+        if group not in expected or group not in actual:
+            continue
+        for key in sorted(set(expected[group]) | set(actual[group])):
+            want = expected[group].get(key, {})
+            got = actual[group].get(key, {})
+            for name in ("rows",) + SUM_FIELDS:
+                if Decimal(str(want.get(name, 0))) != Decimal(str(got.get(name, 0))):
+                    differences.append(
+                        f"{group[:-1]} {key} {name}: expected {want.get(name, 0)}, got {got.get(name, 0)}"
+                    )
+    return differences
+
+
+class ReconciliationBuilder:
+    """
+    Builds a file's reconciliation manifest one chunk at a time, so control
+    totals can be computed while the file is streamed instead of from all of
+    its parsed rows. Chunks are cut and keyed like the processor's chunks.
+    "accepted" totals cover the rows that pass validation, which is what the
+    consumer imports; "all" covers every row.
+    """
+
+    def __init__(self, file_name, records_per_chunk):
+        self.file_name = file_name
+        self.records_per_chunk = records_per_chunk
+        self.header = None
+        self.record_count = 0
+        self.file_all = ControlTotals()
+        self.file_accepted = ControlTotals()
+        self.chunks = {}
+
+    def add_rows(self, rows):
+        """
+        Function to add the next chunk's records; the first chunk starts with
+        the (canonical) header row
+        """
+        start_index = self.record_count
+        self.record_count += len(rows)
+        if self.header is None:
+            self.header, data_rows = (rows[0] if rows else []), rows[1:]
+        else:
+            data_rows = rows
+        mask, _ = validate_list_rows(self.header, data_rows)
+        chunk_all = ControlTotals().add_list_rows(self.header, data_rows)
+        chunk_accepted = ControlTotals().add_list_rows(self.header, data_rows, mask)
+        self.file_all.merge(chunk_all)
+        self.file_accepted.merge(chunk_accepted)
+        chunk_key = (
+            f"queue/{self.file_name}_{start_index}_{self.record_count - 1}"
+            f"_{len(self.chunks) + 1}.csv"
+        )
+        self.chunks[chunk_key] = {
+            "all": chunk_all.compact(),
+            "accepted": chunk_accepted.compact(),
+        }
+        return chunk_key
+
+    def manifest(self):
+        return {
+            "file_name": self.file_name,
+            "records_per_chunk": self.records_per_chunk,
+            "created_at": now_iso(),
+            "file": {
+                "all": self.file_all.to_dict(),
+                "accepted": self.file_accepted.to_dict(),
+            },
+            "chunks": self.chunks,
+        }
+
+
+def build_reconciliation_manifest(file_name, csv_rows, records_per_chunk):
+    """
+    Function to compute control totals for a parsed file (header first) in one
+    pass, per chunk and for the whole file
+    """
+    builder = ReconciliationBuilder(file_name, records_per_chunk)
+    for start_index in range(0, len(csv_rows), records_per_chunk):
+        builder.add_rows(csv_rows[start_index : start_index + records_per_chunk])
+    return builder.manifest()
+
+
+def write_reconciliation_manifest(bucket_name, manifest):
+    key = f"{RECONCILIATION_PREFIX}/{manifest['file_name']}.json"
+    boto3.client("s3").put_object(
+        Body=json.dumps(manifest, separators=(",", ":")).encode("utf-8"),
+        Bucket=bucket_name,
+        Key=key,
+        ContentType="application/json",
+    )
+    logger.info(
+        f"Control totals for {manifest['file_name']}: "
+        f"{manifest['file']['accepted']['row_count']} accepted row(s), written to {key}"
+    )
+    return key
+
+
+def read_reconciliation_manifest(bucket_name, file_name):
+    return get_document(
+        boto3.client("s3"), bucket_name, f"{RECONCILIATION_PREFIX}/{file_name}.json"
+    )
+
+
+def reconcile_file(bucket_name, file_name, chunks):
+    """
+    Function to compare the accepted totals the consumers recorded for each
+    chunk with the file's reconciliation manifest.
+    Returns None when the file has no manifest.
+    """
+    manifest = read_reconciliation_manifest(bucket_name, file_name)
+    if manifest is None:
+        return None
+    accepted = ControlTotals()
+    for chunk in chunks:
+        if "totals" in chunk:
+            accepted.merge(ControlTotals.from_dict(chunk["totals"]))
+    differences = compare_totals(manifest["file"]["accepted"], accepted.to_dict())
+    if differences:
+        logger.error(f"{file_name} does not reconcile: {'; '.join(differences[:10])}")
+    return {
+        "matched": not differences,
+        "differences": differences[:100],
+        "expected": {
+            k: v for k, v in manifest["file"]["accepted"].items() if k != "invoices"
+        },
+        "accepted": accepted.compact(),
+    }
@@ -0,0 +1,328 @@
+import datetime
+import json
+import logging
+import re
+import boto3
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger("billing_common")
+logger.setLevel(logging.INFO)
+
+TRACKING_PREFIX = "tracking"
+SUMMARY_PREFIX = "summary"
+
+# queue/<file name>_<first record>_<last record>_<chunk number>.csv
+CHUNK_KEY_PATTERN = re.compile(r"^queue/(?P<file_name>.+)_\d+_\d+_(?P<index>\d+)\.csv$")
+
+
+def parse_chunk_key(chunk_key):
+    """
+    Function to split a chunk key into (file name, chunk number)
+    """
+    match = CHUNK_KEY_PATTERN.match(chunk_key)
+    if match is None:
+        raise ValueError(f"Not a chunk key: {chunk_key}")
+    return match.group("file_name"), int(match.group("index"))
+
+
+def now_iso():
+    return datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+
+def put_if_absent(s3, bucket_name, key, document):
+    """
+    Function to create an object only if it does not exist yet.
+    Returns False when another writer got there first.
+    """
+    try:
+        s3.put_object(
+            Body=json.dumps(document).encode("utf-8"),
+            Bucket=bucket_name,
+            Key=key,
+            ContentType="application/json",
+            IfNoneMatch="*",
+        )
+        return True
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("PreconditionFailed", "412"):
+            return False
+        raise e
+
+
+def get_document(s3, bucket_name, key):
+    try:
+        response = s3.get_object(Bucket=bucket_name, Key=key)
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+            return None
+        raise e
+    return json.loads(response["Body"].read())
+
+
+FINALISING = "finalising"
+FINALISED = "finalised"
+FAILED = "failed"
+# A finalisation claimed longer ago than this without finishing is taken to
+# have crashed and may be retried
+FINALISE_STALE_SECONDS = 900
+
+
+def tracking_prefix(file_name, file_id=None):
+    """
+    Function to return the tracking prefix of one delivery of a file.
+    file_id is the archived file's sha256, so a file dropped again under the
+    same name is tracked apart from the earlier one. Chunks published
+    without one use the file name alone.
+    """
+    if file_id:
+        return f"{TRACKING_PREFIX}/{file_name}/{file_id}"
+    return f"{TRACKING_PREFIX}/{file_name}"
+
+
+def register_file(bucket_name, file_name, expected_chunks, details=None, file_id=None):
+    """
+    Function to record how many chunks a file was split into.
+    Called by the processor before the chunks are sent to SQS.
+    """
+    s3 = boto3.client("s3")
+    document = {
+        "file_name": file_name,
+        "file_id": file_id,
+        "expected_chunks": expected_chunks,
+        "registered_at": now_iso(),
+    }
+    document.update(details or {})
+    s3.put_object(
+        Body=json.dumps(document).encode("utf-8"),
+        Bucket=bucket_name,
+        Key=f"{tracking_prefix(file_name, file_id)}/expected.json",
+        ContentType="application/json",
+    )
+    logger.info(f"Registered {file_name} with {expected_chunks} chunk(s)")
+
+
+def count_completed_chunks(s3, bucket_name, prefix):
+    paginator = s3.get_paginator("list_objects_v2")
+    completed = 0
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=f"{prefix}/chunks/"):
+        completed += page.get("KeyCount", len(page.get("Contents", [])))
+    return completed
+
+
+def record_chunk_complete(bucket_name, chunk_key, details=None, file_id=None):
+    """
+    Function to record a chunk as imported, called by the consumer.
+    Each chunk marker is written at most once, so redelivered messages do not
+    double count. Returns the file's tracking document when this call
+    completed the file and won the right to finalise it, otherwise None.
+    """
+    s3 = boto3.client("s3")
+    file_name, chunk_index = parse_chunk_key(chunk_key)
+    prefix = tracking_prefix(file_name, file_id)
+    document = {"chunk_key": chunk_key, "completed_at": now_iso()}
+    document.update(details or {})
+    if not put_if_absent(
+        s3, bucket_name, f"{prefix}/chunks/{chunk_index:06d}.json", document
+    ):
+        logger.info(f"Chunk {chunk_key} was already recorded as complete")
+
+    expected = get_document(s3, bucket_name, f"{prefix}/expected.json")
+    if expected is None:
+        logger.info(f"{file_name} is not registered for completion tracking")
+        return None
+
+    completed = count_completed_chunks(s3, bucket_name, prefix)
+    logger.info(
+        f"{file_name}: {completed} of {expected['expected_chunks']} chunk(s) complete"
+    )
+    if completed < expected["expected_chunks"]:
+        return None
+
+    # Exactly one consumer claims the file and finalises it; the claim is
+    # turned into finalised (or failed) by finalise_tracked_file
+    if not put_if_absent(
+        s3,
+        bucket_name,
+        f"{prefix}/final.json",
+        {
+            "file_name": file_name,
+            "file_id": file_id,
+            "status": FINALISING,
+            "claimed_at": now_iso(),
+        },
+    ):
+        return None
+    return expected
+
+
+def get_finalisation(s3, bucket_name, file_name, file_id=None):
+    """
+    Function to read a file's final.json. Returns (document, ETag), or
+    (None, None) when the file has not completed
+    """
+    try:
+        response = s3.get_object(
+            Bucket=bucket_name, Key=f"{tracking_prefix(file_name, file_id)}/final.json"
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+            return None, None
+        raise e
+    return json.loads(response["Body"].read()), response["ETag"]
+
+
+def is_file_complete(bucket_name, file_name, file_id=None):
+    """
+    Function to check whether a file has been finalised
+    """
+    document, _ = get_finalisation(boto3.client("s3"), bucket_name, file_name, file_id)
+    # final.json written before finalisation had a status means finalised
+    return document is not None and document.get("status", FINALISED) == FINALISED
+
+
+def claim_finalisation_retry(
+    bucket_name, file_name, file_id=None, stale_seconds=FINALISE_STALE_SECONDS
+):
+    """
+    Function to take over the finalisation of a completed file whose last
+    attempt failed, or was claimed more than stale_seconds ago and never
+    finished. Returns (tracking document, final document) when the caller
+    won the retry, otherwise None.
+    """
+    s3 = boto3.client("s3")
+    document, etag = get_finalisation(s3, bucket_name, file_name, file_id)
+    if document is None or document.get("status", FINALISED) == FINALISED:
+        return None
+    if document["status"] == FINALISING:
+        claimed_at = datetime.datetime.fromisoformat(document["claimed_at"])
+        age = datetime.datetime.now(datetime.timezone.utc) - claimed_at
+        if age.total_seconds() < stale_seconds:
+            return None
+
+    prefix = tracking_prefix(file_name, file_id)
+    document.update({"status": FINALISING, "claimed_at": now_iso()})
+    try:
+        s3.put_object(
+            Body=json.dumps(document).encode("utf-8"),
+            Bucket=bucket_name,
+            Key=f"{prefix}/final.json",
+            ContentType="application/json",
+            IfMatch=etag,
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("PreconditionFailed", "412"):
+            return None
+        raise e
+    logger.info(f"Retrying finalisation of {file_name}")
+    return get_document(s3, bucket_name, f"{prefix}/expected.json"), document
+
+
+def finalise_tracked_file(bucket_name, expected, actions, final=None):
+    """
+    Function to run the file-level actions of a completed file: write its
+    summary, then call each (name, action(summary)) in turn. Failures are
+    logged, never raised, and recorded in final.json with the steps that
+    succeeded, so a retry (claim_finalisation_retry) only redoes the rest.
+    Returns the names of the failed steps.
+    """
+    done = list((final or {}).get("completed_steps", []))
+    failed = []
+    summary = None
+    try:
+        summary = write_file_summary(bucket_name, expected)
+        done.append("summary")
+    except Exception as e:
+        logger.exception(f"Could not write the summary of {expected['file_name']}: {e}")
+        failed.append("summary")
+    if summary is not None:
+        for name, action in actions:
+            if name in done:
+                continue
+            try:
+                action(summary)
+                done.append(name)
+            except Exception as e:
+                logger.exception(
+                    f"Finalisation step {name} failed for {expected['file_name']}: {e}"
+                )
+                failed.append(name)
+
+    document = {
+        "file_name": expected["file_name"],
+        "file_id": expected.get("file_id"),
+        "status": FAILED if failed else FINALISED,
+        "completed_steps": done,
+        "failed_steps": failed,
+        "updated_at": now_iso(),
+    }
+    try:
+        boto3.client("s3").put_object(
+            Body=json.dumps(document).encode("utf-8"),
+            Bucket=bucket_name,
+            Key=f"{tracking_prefix(expected['file_name'], expected.get('file_id'))}/final.json",
+            ContentType="application/json",
+        )
+    except Exception as e:
+        logger.exception(
+            f"Could not record the finalisation of {expected['file_name']}: {e}"
+        )
+    return failed
+
+
+def notify_file_complete(topic_arn, summary):
+    """
+    Function to publish a completed file's summary, without its chunks
+    """
+    notification = {k: v for k, v in summary.items() if k != "chunks"}
+    boto3.client("sns").publish(
+        TopicArn=topic_arn,
+        Subject=f"C1 billing file imported: {summary['file_name']}"[:100],
+        Message=json.dumps(notification),
+    )
+
+
+def write_file_summary(bucket_name, expected):
+    """
+    Function to write the per-file summary object from the chunk markers,
+    reconciled against the file's control totals when it has them.
+    Returns the summary.
+    """
+    s3 = boto3.client("s3")
+    file_name = expected["file_name"]
+    paginator = s3.get_paginator("list_objects_v2")
+    chunks = []
+    for page in paginator.paginate(
+        Bucket=bucket_name,
+        Prefix=f"{tracking_prefix(file_name, expected.get('file_id'))}/chunks/",
+    ):
+        for item in page.get("Contents", []):
+            chunks.append(get_document(s3, bucket_name, item["Key"]))
+
+    # Imported here, billing_totals itself builds on this module
+    from billing_totals import reconcile_file
+
+    reconciliation = reconcile_file(bucket_name, file_name, chunks)
+    for chunk in chunks:
+        chunk.pop("totals", None)
+
+    summary = {
+        "file_name": file_name,
+        "file_id": expected.get("file_id"),
+        "expected_chunks": expected["expected_chunks"],
+        "completed_chunks": len(chunks),
+        "registered_at": expected["registered_at"],
+        "finalised_at": now_iso(),
+        "row_count": sum(chunk.get("row_count", 0) for chunk in chunks),
+        "rejected_count": sum(chunk.get("rejected_count", 0) for chunk in chunks),
+        "chunks": chunks,
+    }
+    if reconciliation is not None:
+        summary["reconciliation"] = reconciliation
+    s3.put_object(
+        Body=json.dumps(summary).encode("utf-8"),
+        Bucket=bucket_name,
+        Key=f"{SUMMARY_PREFIX}/{file_name}.json",
+        ContentType="application/json",
+    )
+    logger.info(f"Summary for {file_name} written to {SUMMARY_PREFIX}/{file_name}.json")
+    return summary
@@ -0,0 +1,196 @@
+import datetime
+import json
+import logging
+import re
+import boto3
+
+logger = logging.getLogger("billing_common")
+logger.setLevel(logging.INFO)
+
+# Rows without these values are rejected
+REQUIRED_FIELDS = ("CRMID",)
+
+# ddmmyyyy, Landmark drops the leading zero of the day
+DATE_FIELDS = (
+    "Start Date",
+    "End Date",
+    "Campaign Billing Start Date",
+    "Campaign Billing End Date",
+)
+
+# Checked only when a value is present
+AMOUNT_FIELDS = ("Subtotal Line", "Agency Commission")
+
+# Columns read by str_field_handling, a missing one fails the whole chunk
+EXPECTED_COLUMNS = (
+    "General Ledger Code",
+    "Business Area",
+    "Sales Rep",
+    "Sales Group",
+    "Sales Office",
+    "Transaction Type",
+    "Goods Received",
+    "Campaign Type",
+    "CRMID",
+    "Billing Account Name",
+    "Primary Advertiser",
+    "Start Date",
+    "End Date",
+    "Campaign Reference",
+    "Campaign Name",
+    "Revenue Type",
+    "Invoice Currency",
+    "Invoice Number",
+    "Line Number",
+    "PO Number",
+    "Subtotal - Sales Area Code",
+    "Subtotal - Sales Area",
+    "Tax",
+    "Subtotal Line",
+    "Agency Commission",
+    "Campaign Billing Start Date",
+    "Campaign Billing End Date",
+    "Journal Comments",
+    "Journal Type",
+    "Product Code",
+    "Product Name",
+)
+
+DATE_PATTERN = re.compile(r"\d{7,8}")
+AMOUNT_PATTERN = re.compile(r"-?\d+(\.\d+)?")
+
+
+def is_valid_date(value):
+    if not DATE_PATTERN.fullmatch(value):
+        return False
+    try:
+        datetime.datetime.strptime(value.zfill(8), "%d%m%Y")
+    except ValueError:
+        return False
+    return True
+
+
+def is_valid_amount(value):
+    value = value.strip()
+    return value == "" or AMOUNT_PATTERN.fullmatch(value) is not None
+
+
+def check_column(column, check):
+    """
+    Function to apply check once per distinct value of a column and map the
+    result back to every row. Billing columns repeat heavily (dates, GL codes),
+    so this is far cheaper than checking row by row.
+    """
+    results = {value: check(value) for value in set(column)}
+    return [results[value] for value in column]
+
+
+def check_expected_columns(names):
+    """
+    Function to raise ValueError when a chunk is missing expected columns.
+    That is a structural error rather than a bad row, so the chunk fails and
+    is retried and dead-lettered instead of having every row rejected.
+    """
+    missing_columns = [name for name in EXPECTED_COLUMNS if name not in names]
+    if missing_columns:
+        raise ValueError(f"Chunk is missing columns: {', '.join(missing_columns)}")
+
+
+def validate_columns(columns, row_count):
+    """
+    Function to validate a chunk held as columns (name -> list of values).
+    Returns (mask, reasons): mask[i] is True for a good row and reasons maps
+    each rejected row index to the list of its failures.
+    Raises ValueError when an expected column is missing.
+    """
+    reasons = {}
+
+    def reject(index, reason):
+        reasons.setdefault(index, []).append(reason)
+
+    if row_count:
+        check_expected_columns(columns)
+
+    for name in REQUIRED_FIELDS:
+        if name in columns:
+            for index, ok in enumerate(
+                check_column(columns[name], lambda v: v.strip() != "")
+            ):
+                if not ok:
+                    reject(index, f"{name} is empty")
+
+    for name in DATE_FIELDS:
+        if name in columns:
+            for index, ok in enumerate(check_column(columns[name], is_valid_date)):
+                if not ok:
+                    reject(index, f"{name} is not a ddmmyyyy date")
+
+    for name in AMOUNT_FIELDS:
+        if name in columns:
+            for index, ok in enumerate(check_column(columns[name], is_valid_amount)):
+                if not ok:
+                    reject(index, f"{name} is not numeric")
+
+    mask = [index not in reasons for index in range(row_count)]
+    return mask, reasons
+
+
+def validate_dict_rows(rows):
+    """
+    Function to validate rows read with csv.DictReader
+    """
+    names = rows[0].keys() if rows else ()
+    columns = {
+        name: [row.get(name) or "" for row in rows]
+        for name in names
+        if name is not None
+    }
+    return validate_columns(columns, len(rows))
+
+
+def validate_list_rows(header, rows):
+    """
+    Function to validate rows read with csv.reader against their header row
+    """
+    columns = {
+        name: [row[position] if position < len(row) else "" for row in rows]
+        for position, name in enumerate(header)
+    }
+    return validate_columns(columns, len(rows))
+
+
+def rejected_rows_report(source_key, rows, reasons, row_offset=0):
+    """
+    Function to build the compact rejected-rows report for a chunk.
+    rows may be dicts or lists; row numbers are offset by row_offset.
+    """
+    return {
+        "source": source_key,
+        "rejected_count": len(reasons),
+        "rows": [
+            {
+                "row": index + row_offset,
+                "reasons": reasons[index],
+                "values": rows[index],
+            }
+            for index in sorted(reasons)
+        ],
+    }
+
+
+def write_rejected_report(bucket_name, source_key, report):
+    """
+    Function to write a rejected-rows report under the 'rejected' folder in S3
+    """
+    report_key = f"rejected/{source_key.split('/')[-1]}.json"
+    s3 = boto3.client("s3")
+    s3.put_object(
+        Body=json.dumps(report, separators=(",", ":")).encode("utf-8"),
+        Bucket=bucket_name,
+        Key=report_key,
+        ContentType="application/json",
+    )
+    logger.info(
+        f"{report['rejected_count']} rejected row(s) from {source_key} written to {report_key}"
+    )
+    return report_key
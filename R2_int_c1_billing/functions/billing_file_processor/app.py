@@ -1,5 +1,5 @@
 import json
-from io import StringIO
+from io import StringIO, BytesIO, TextIOWrapper
 import logging
 import os
 import csv
@@ -8,7 +8,46 @@ import datetime
 import pytz
 import boto3
 import time
+import tempfile
+from contextlib import ExitStack
 from ga_sftp import push_file_to_ga
+from sftp_scanner import (
+    load_manifest,
+    save_manifest,
+    scan_for_new_files,
+    find_published_hash,
+    is_published,
+    record_published,
+)
+from s3_archive import archive_raw_file
+from sftp_download import open_sftp_client, open_remote_file
+from chunk_codec import resolve_chunk_encoding, encode_chunk
+from billing_rows import TECHONE_ROWS_FORMAT, transform_rows
+from chunk_manifest import (
+    BYTE_RANGE_FORMAT,
+    build_range_messages,
+    send_range_messages,
+)
+from billing_validation import (
+    check_expected_columns,
+    rejected_rows_report,
+    write_rejected_report,
+)
+from billing_tracker import (
+    claim_finalisation_retry,
+    finalise_tracked_file,
+    is_file_complete,
+    notify_file_complete,
+    register_file,
+)
+from billing_encoding import ENCODING_SAMPLE_SIZE, detect_encoding, canonical_headers
+from billing_state import LEDGER_MODE, QUEUED, record_chunk_state
+from billing_totals import (
+    ReconciliationBuilder,
+    build_reconciliation_manifest,
+    write_reconciliation_manifest,
+)
+from billing_profiling import profiled
 
 logger = logging.getLogger("d2_landmark_sftp")
 logger.setLevel(logging.INFO)
@@ -24,9 +63,37 @@ LANDMARK_SECRET_NAME = os.environ["LANDMARK_SFTP_SECRET_NAME"]
 LANDMARK_DELETE_SECRET_NAME = os.environ["LANDMARK_SFTP_SECRET_NAME_DELETE"]
 GA_SFTP_SECRET_NAME = os.environ["GA_SFTP_SECRET_NAME"]
 GA_FTP_PATH = os.environ["GA_FTP_PATH"]
+GA_PUSH_DELAY_SECONDS = int(os.environ.get("GA_PUSH_DELAY_SECONDS", "20"))
 sqs_queue_url = os.environ[
     "SQS_QUEUE_URL"
 ]  # Add this line with your actual SQS queue URL
+SFTP_MANIFEST_KEY = os.environ.get("SFTP_MANIFEST_KEY", "manifest/processed_files.json")
+SFTP_SCAN_POLL_SECONDS = int(os.environ.get("SFTP_SCAN_POLL_SECONDS", "5"))
+MANIFEST_RETENTION_DAYS = int(os.environ.get("MANIFEST_RETENTION_DAYS", "90"))
+RAW_ARCHIVE_PART_SIZE = (
+    int(os.environ.get("RAW_ARCHIVE_PART_SIZE_MB", "8")) * 1024 * 1024
+)
+RAW_ARCHIVE_MAX_WORKERS = int(os.environ.get("RAW_ARCHIVE_MAX_WORKERS", "4"))
+SPOOL_MAX_BYTES = 64 * 1024 * 1024  # larger files spill to /tmp
+CHUNK_ENCODING = resolve_chunk_encoding(os.environ.get("CHUNK_ENCODING"))
+CHUNK_FORMAT = os.environ.get("CHUNK_FORMAT", "csv")
+ROWS_PER_CHUNK = 4999
+SFTP_WINDOW_SIZE = int(os.environ.get("SFTP_WINDOW_SIZE_MB", "0")) * 1024 * 1024 or None
+SFTP_MAX_PACKET_SIZE = (
+    int(os.environ.get("SFTP_MAX_PACKET_SIZE_KB", "0")) * 1024 or None
+)
+SFTP_PREFETCH_REQUESTS = int(os.environ.get("SFTP_PREFETCH_REQUESTS", "0")) or None
+SFTP_PARALLEL_THRESHOLD = (
+    int(os.environ.get("SFTP_PARALLEL_THRESHOLD_MB", "0")) * 1024 * 1024 or None
+)
+SFTP_PARALLEL_WORKERS = int(os.environ.get("SFTP_PARALLEL_WORKERS", "4"))
+COMPLETION_TRACKING = os.environ.get("COMPLETION_TRACKING", "false").lower() == "true"
+CONTROL_TOTALS = os.environ.get("CONTROL_TOTALS", "false").lower() == "true"
+FILE_COMPLETE_TOPIC_ARN = os.environ.get("FILE_COMPLETE_TOPIC_ARN")
+STATE_TRACKING = os.environ.get("STATE_TRACKING", "off").lower()
+# Chunk control totals larger than this are left out of the object metadata
+# (2 KB limit) and read from the reconciliation manifest instead
+CONTROL_TOTALS_METADATA_MAX = 1500
 
 
 def get_secret_credentials(secret_name):
@@ -43,6 +110,7 @@ def get_secret_credentials(secret_name):
             "username": secret["user_id"],
             "password": secret["password"],
             "key_value": secret.get("key_value", None),
+            "port": int(secret.get("port", 22)),
         }
     except Exception as e:
         logger.error(f"Error retrieving SFTP credentials from Secret Manager: {str(e)}")
@@ -53,31 +121,225 @@ s3 = boto3.client("s3")
 sqs = boto3.client("sqs")
 
 
-def parse_csv(csv_data):
-    # Decode binary data to string
-    csv_data_str = csv_data.decode("charmap")
+def parse_csv(csv_data, encoding="charmap"):
+    # Decode binary data incrementally while parsing
+    csv_data_str = TextIOWrapper(BytesIO(csv_data), encoding=encoding, newline="")
 
     # Parse CSV data and return list of rows
     rows = []
-    csv_reader = csv.reader(StringIO(csv_data_str))
+    csv_reader = csv.reader(csv_data_str)
     for row in csv_reader:
         rows.append(row)
+
+    # Canonicalise header names, e.g. the windows-1252 en dash in
+    # "Subtotal - Sales Area Code"
+    if rows:
+        rows[0] = canonical_headers(rows[0])
     return rows
 
 
-def connect_to_sftp(hostname, username, password, ssh_key):
+def connect_to_sftp(hostname, username, password, ssh_key, port=22):
     """
     Function to fetch secret value for file transfer1
     """
     logger.info("Entering connect_to_sftp()")
-    transport = paramiko.Transport((hostname, 22))
+    transport = paramiko.Transport((hostname, port))
     transport.connect(username=username, password=password, pkey=ssh_key)
     sftp = paramiko.SFTPClient.from_transport(transport)
     logger.info("Exiting connect_to_sftp()")
     return sftp
 
 
+def publish_control_totals(csv_file_name, csv_rows):
+    """
+    Function to compute the control totals of a parsed file and write its
+    reconciliation manifest. Returns the per-chunk totals keyed by chunk key.
+    """
+    manifest = build_reconciliation_manifest(csv_file_name, csv_rows, ROWS_PER_CHUNK)
+    write_reconciliation_manifest(SEIL_S3_BUCKET, manifest)
+    return manifest["chunks"]
+
+
+def mark_chunk_queued(chunk_key):
+    """
+    Function to record a chunk as queued before its message is sent, so the
+    ledger lists pending chunks alongside delivered and failed ones.
+    In prefix mode the chunk sitting in queue/ already says so.
+    Errors are logged only; the import does not depend on the marker.
+    """
+    if STATE_TRACKING != LEDGER_MODE:
+        return
+    try:
+        record_chunk_state(SEIL_S3_BUCKET, chunk_key, QUEUED)
+    except Exception as e:
+        logger.error(f"Could not record {chunk_key} as {QUEUED}: {e}")
+
+
+def publish_chunks(
+    csv_file_name, csv_rows, source_encoding, control_totals=None, file_id=None
+):
+    """
+    Function to split parsed CSV rows into chunks (4999 rows each), upload each
+    chunk to the 'queue' folder in S3 and send its key to SQS.
+    In csv format every chunk after the first repeats the header row; in
+    techone-rows format each chunk holds transformed row lines only.
+    Chunks are always written as UTF-8 and tagged with the source encoding,
+    the file's sha256 (file_id) and their expected control totals when given.
+    """
+    row1 = csv_rows[0]
+    chunk_keys = []
+    rows_per_chunk = ROWS_PER_CHUNK
+    if CHUNK_FORMAT == TECHONE_ROWS_FORMAT:
+        # Fail the file before anything is published, as the consumer would
+        check_expected_columns(row1)
+    if COMPLETION_TRACKING:
+        # Register before sending so no chunk can complete ahead of it
+        register_file(
+            SEIL_S3_BUCKET,
+            csv_file_name,
+            -(-len(csv_rows) // rows_per_chunk),
+            {"raw_key": f"raw/{csv_file_name}"},
+            file_id,
+        )
+    for idx, start_index in enumerate(range(0, len(csv_rows), rows_per_chunk)):
+        end_index = start_index + rows_per_chunk
+        chunk_rows = csv_rows[start_index:end_index]
+
+        # Calculate record count range
+        record_count_start = start_index
+        record_count_end = min(end_index - 1, len(csv_rows) - 1)
+        record_count_range = f"{record_count_start}_{record_count_end}"
+        csv_key = f"queue/{csv_file_name}_{record_count_range}_{idx + 1}.csv"
+
+        put_kwargs = {
+            "ContentType": "text/csv; charset=utf-8",
+            "Metadata": {"source-encoding": source_encoding},
+        }
+        if file_id:
+            put_kwargs["Metadata"]["file-sha256"] = file_id
+        if control_totals and csv_key in control_totals:
+            totals_json = json.dumps(
+                control_totals[csv_key]["accepted"], separators=(",", ":")
+            )
+            if len(totals_json) <= CONTROL_TOTALS_METADATA_MAX:
+                put_kwargs["Metadata"]["control-totals"] = totals_json
+        if CHUNK_FORMAT == TECHONE_ROWS_FORMAT:
+            # Transform rows into TechOne row text, one row per line
+            data_rows = chunk_rows[1:] if idx == 0 else chunk_rows
+            row_lines, reasons = transform_rows(row1, data_rows)
+            if reasons:
+                write_rejected_report(
+                    SEIL_S3_BUCKET,
+                    csv_key,
+                    rejected_rows_report(
+                        csv_key,
+                        data_rows,
+                        reasons,
+                        row_offset=start_index + (1 if idx == 0 else 0),
+                    ),
+                )
+            chunk_text = "".join(row_line + "\n" for row_line in row_lines)
+            put_kwargs["ContentType"] = "text/plain; charset=utf-8"
+            put_kwargs["Metadata"]["chunk-format"] = TECHONE_ROWS_FORMAT
+            put_kwargs["Metadata"]["row-count"] = str(len(row_lines))
+        else:
+            # Convert chunk rows back to CSV data
+            csv_chunk_data = StringIO()
+            csv_writer = csv.writer(csv_chunk_data)
+            if idx > 0:
+                csv_writer.writerow(row1)
+            csv_writer.writerows(chunk_rows)
+            chunk_text = csv_chunk_data.getvalue()
+
+        # Compress the chunk when a chunk encoding is configured
+        body, content_encoding = encode_chunk(
+            chunk_text.encode("utf-8"), CHUNK_ENCODING
+        )
+        if content_encoding:
+            put_kwargs["ContentEncoding"] = content_encoding
+
+        # Upload CSV chunk to S3 with record count range in the filename
+        s3_client.put_object(
+            Body=body, Bucket=SEIL_S3_BUCKET, Key=csv_key, **put_kwargs
+        )
+        # Send CSV key to SQS
+        mark_chunk_queued(csv_key)
+        sqs.send_message(QueueUrl=sqs_queue_url, MessageBody=csv_key)
+        chunk_keys.append(csv_key)
+    return chunk_keys
+
+
+def delete_landmark_file(delete_ftp_client, sftp_path, csv_file_name):
+    """
+    Function to delete a processed file from the Landmark SFTP server.
+    Errors are logged only; the manifest stops the file being reprocessed
+    and the delete is retried on the next run.
+    """
+    file_with_path = sftp_path + "/" + csv_file_name
+    delete_file_path = file_with_path.replace("/ftp.out", "")
+    try:
+        logger.info(f"Deleting file: {delete_file_path}")
+        delete_ftp_client.remove(delete_file_path)
+    except Exception as delete_error:
+        logger.error(
+            f"Error deleting file '{delete_file_path}' from SFTP: {str(delete_error)}"
+        )
+
+
+def finalise_file(csv_file_name, file_id=None):
+    """
+    Function to delete a Landmark file once the consumer has reported that
+    all of its chunks were imported. file_id is the sha256 the file was
+    published with; a file dropped again under the same name since then is
+    left alone, its own chunks will finalise it.
+    """
+    logger.info(f"Finalising {csv_file_name}")
+    manifest = load_manifest(SEIL_S3_BUCKET, SFTP_MANIFEST_KEY)
+    entry = manifest["files"].get(csv_file_name)
+    if file_id and (entry is None or entry.get("sha256") != file_id):
+        logger.info(
+            f"{csv_file_name} was replaced by a newer delivery, not deleting it"
+        )
+        return
+    delete_ftp_dict = get_secret_credentials(LANDMARK_DELETE_SECRET_NAME)
+    delete_private_key_file = StringIO(delete_ftp_dict["key_value"])
+    delete_ssh_key = paramiko.RSAKey.from_private_key(delete_private_key_file)
+    sftp_path = (
+        ssm_client.get_parameter(Name=LANDMARK_SFTP_PATH).get("Parameter").get("Value")
+    )
+    delete_ftp_client = connect_to_sftp(
+        delete_ftp_dict["host"],
+        delete_ftp_dict["username"],
+        delete_ftp_dict["password"],
+        delete_ssh_key,
+        delete_ftp_dict["port"],
+    )
+    try:
+        try:
+            file_attr = delete_ftp_client.stat(
+                f"{sftp_path}/{csv_file_name}".replace("/ftp.out", "")
+            )
+        except IOError:
+            logger.info(f"{csv_file_name} is no longer on the SFTP server")
+            return
+        file_attr.filename = csv_file_name
+        if file_id and not is_published(manifest, file_attr):
+            logger.info(
+                f"{csv_file_name} changed since it was published, not deleting it"
+            )
+            return
+        delete_landmark_file(delete_ftp_client, sftp_path, csv_file_name)
+    finally:
+        delete_ftp_client.close()
+
+
+@profiled
 def lambda_handler(event, context):
+    if event.get("action") == "finalise":
+        # Sent by the consumer when the last chunk of a file is imported
+        finalise_file(event["file_name"], event.get("file_sha256"))
+        return
+
     try:
         try:
             allowed_schedule_range = os.environ["ALLOWED_SCHEDULE_RANGE"]
@@ -116,14 +378,16 @@ def lambda_handler(event, context):
                         hostname=landmark_credentials["host"],
                         username=landmark_credentials["username"],
                         password=landmark_credentials["password"],
-                        port=22,
+                        port=landmark_credentials["port"],
                         allow_agent=False,
                         pkey=paramiko.RSAKey(
                             file_obj=StringIO(landmark_credentials["key_value"])
                         ),
                     )
 
-                    with ssh_client.open_sftp() as sftp:
+                    with open_sftp_client(
+                        ssh_client, SFTP_WINDOW_SIZE, SFTP_MAX_PACKET_SIZE
+                    ) as sftp:
                         sftp_path = (
                             ssm_client.get_parameter(Name=LANDMARK_SFTP_PATH)
                             .get("Parameter")
@@ -132,86 +396,233 @@ def lambda_handler(event, context):
                         sftp.chdir(sftp_path)
                         logger.info("Landmark SFTP Connection Established")
 
-                        # List files in the SFTP directory
-                        files_on_sftp = sftp.listdir()
+                        # Scan the SFTP directory against the processed-file manifest
+                        manifest = load_manifest(SEIL_S3_BUCKET, SFTP_MANIFEST_KEY)
+                        ready_files, published_files = scan_for_new_files(
+                            sftp, manifest, SFTP_SCAN_POLL_SECONDS
+                        )
 
                         delete_ftp_client = connect_to_sftp(
                             delete_ftp_dict["host"],
                             delete_ftp_dict["username"],
                             delete_ftp_dict["password"],
                             delete_ssh_key,
+                            delete_ftp_dict["port"],
                         )
 
-                        # Process each CSV file on the SFTP server
-                        for csv_file_name in files_on_sftp:
+                        # Retry deletes that failed on an earlier run. With
+                        # completion tracking a file is only deleted once all
+                        # of its chunks have been imported, and finalisations
+                        # that failed or stalled are retried here
+                        for file_attr in published_files:
+                            file_id = manifest["files"][file_attr.filename].get(
+                                "sha256"
+                            )
+                            if COMPLETION_TRACKING:
+                                retry = claim_finalisation_retry(
+                                    SEIL_S3_BUCKET, file_attr.filename, file_id
+                                )
+                                if retry is not None:
+                                    expected, final = retry
+                                    # The delete below stands in for the
+                                    # consumer's finalise step
+                                    finalise_tracked_file(
+                                        SEIL_S3_BUCKET,
+                                        expected,
+                                        (
+                                            [
+                                                (
+                                                    "notify",
+                                                    lambda summary: notify_file_complete(
+                                                        FILE_COMPLETE_TOPIC_ARN, summary
+                                                    ),
+                                                )
+                                            ]
+                                            if FILE_COMPLETE_TOPIC_ARN
+                                            else []
+                                        ),
+                                        final,
+                                    )
+                            if COMPLETION_TRACKING and not is_file_complete(
+                                SEIL_S3_BUCKET, file_attr.filename, file_id
+                            ):
+                                logger.info(
+                                    f"File {file_attr.filename} already published, "
+                                    "waiting for its chunks to be imported"
+                                )
+                                continue
+                            logger.info(
+                                f"File {file_attr.filename} already published, retrying delete"
+                            )
+                            delete_landmark_file(
+                                delete_ftp_client, sftp_path, file_attr.filename
+                            )
+
+                        # Process each new CSV file on the SFTP server, smallest first
+                        for file_attr in ready_files:
+                            csv_file_name = file_attr.filename
                             if csv_file_name.lower().endswith(".csv"):
                                 try:
-                                    # Download CSV file
-                                    csv_file_data = sftp.open(csv_file_name).read()
-
-                                    # Upload original CSV to 'raw' folder in S3
+                                    # Stream the CSV file into the 'raw' folder in S3,
+                                    # keeping a local copy for parsing. A parallel
+                                    # download is already in /tmp, so it is read
+                                    # again instead of being spooled a second time
                                     raw_csv_key = f"raw/{csv_file_name}"
-                                    s3_client.put_object(
-                                        Body=csv_file_data,
-                                        Bucket=SEIL_S3_BUCKET,
-                                        Key=raw_csv_key,
+                                    with open_remote_file(
+                                        sftp,
+                                        csv_file_name,
+                                        file_attr.st_size,
+                                        SFTP_PARALLEL_THRESHOLD,
+                                        SFTP_PARALLEL_WORKERS,
+                                        SFTP_PREFETCH_REQUESTS,
+                                    ) as remote_file, ExitStack() as spool:
+                                        local_copy = (
+                                            None
+                                            if remote_file.local
+                                            else spool.enter_context(
+                                                tempfile.SpooledTemporaryFile(
+                                                    max_size=SPOOL_MAX_BYTES,
+                                                    dir=tempfile.gettempdir(),
+                                                )
+                                            )
+                                        )
+                                        archive = archive_raw_file(
+                                            remote_file,
+                                            SEIL_S3_BUCKET,
+                                            raw_csv_key,
+                                            file_attr.st_size,
+                                            tee=local_copy,
+                                            part_size=RAW_ARCHIVE_PART_SIZE,
+                                            max_workers=RAW_ARCHIVE_MAX_WORKERS,
+                                        )
+                                        remote_file.log_rate()
+                                        if local_copy is None:
+                                            local_copy = remote_file.local_copy()
+                                        local_copy.seek(0)
+                                        csv_file_data = local_copy.read()
+
+                                    content_hash = archive["sha256"]
+                                    published_name = find_published_hash(
+                                        manifest, content_hash
                                     )
+                                    if published_name is not None:
+                                        logger.info(
+                                            f"File {csv_file_name} has the same content as "
+                                            f"published file {published_name}, skipping"
+                                        )
+                                        record_published(
+                                            manifest, file_attr, content_hash
+                                        )
+                                        save_manifest(
+                                            SEIL_S3_BUCKET,
+                                            SFTP_MANIFEST_KEY,
+                                            manifest,
+                                            MANIFEST_RETENTION_DAYS,
+                                        )
+                                        delete_landmark_file(
+                                            delete_ftp_client, sftp_path, csv_file_name
+                                        )
+                                        continue
 
-                                    time.sleep(20)
+                                    time.sleep(GA_PUSH_DELAY_SECONDS)
                                     # Push File to GoAnywhere SFTP Server
                                     push_file_to_ga(
-                                        SEIL_S3_BUCKET, raw_csv_key, GA_SFTP_SECRET_NAME, GA_FTP_PATH
+                                        SEIL_S3_BUCKET,
+                                        raw_csv_key,
+                                        GA_SFTP_SECRET_NAME,
+                                        GA_FTP_PATH,
                                     )
-                                    
+
                                     logger.info(f"File downloaded {csv_file_name} ")
 
-                                    # Parse CSV file
-                                    csv_rows = parse_csv(csv_file_data)
-                                    row1 = csv_rows[0]
-
-                                    # Split CSV rows into chunks (5000 rows each) and process
-                                    rows_per_chunk = 4999
-                                    for idx, start_index in enumerate(
-                                        range(0, len(csv_rows), rows_per_chunk)
-                                    ):
-                                        end_index = start_index + rows_per_chunk
-                                        chunk_rows = csv_rows[start_index:end_index]
-
-                                        # Convert chunk rows back to CSV data
-                                        csv_chunk_data = StringIO()
-                                        csv_writer = csv.writer(csv_chunk_data)
-                                        if idx > 0:
-                                            csv_writer.writerow(row1)
-                                        csv_writer.writerows(chunk_rows)
-                                        csv_chunk_data.seek(0)
-
-                                        # Calculate record count range
-                                        record_count_start = start_index
-                                        record_count_end = min(
-                                            end_index - 1, len(csv_rows) - 1
+                                    # Detect the source encoding once from a sample
+                                    source_encoding = detect_encoding(
+                                        csv_file_data[:ENCODING_SAMPLE_SIZE]
+                                    )
+                                    logger.info(
+                                        f"Detected {source_encoding} encoding for {csv_file_name}"
+                                    )
+
+                                    if CHUNK_FORMAT == BYTE_RANGE_FORMAT:
+                                        # Publish byte ranges of the raw object, no
+                                        # chunk objects are written
+                                        # Control totals come from the same scan
+                                        reconciliation = (
+                                            ReconciliationBuilder(
+                                                csv_file_name, ROWS_PER_CHUNK
+                                            )
+                                            if CONTROL_TOTALS
+                                            else None
+                                        )
+                                        range_messages = build_range_messages(
+                                            csv_file_name,
+                                            raw_csv_key,
+                                            BytesIO(csv_file_data),
+                                            ROWS_PER_CHUNK,
+                                            source_encoding,
+                                            reconciliation,
                                         )
-                                        record_count_range = (
-                                            f"{record_count_start}_{record_count_end}"
+                                        if reconciliation is not None:
+                                            write_reconciliation_manifest(
+                                                SEIL_S3_BUCKET,
+                                                reconciliation.manifest(),
+                                            )
+                                        for message in range_messages:
+                                            message["file_sha256"] = content_hash
+                                            mark_chunk_queued(message["chunk_key"])
+                                        if COMPLETION_TRACKING:
+                                            register_file(
+                                                SEIL_S3_BUCKET,
+                                                csv_file_name,
+                                                len(range_messages),
+                                                {"raw_key": raw_csv_key},
+                                                content_hash,
+                                            )
+                                        send_range_messages(
+                                            sqs, sqs_queue_url, range_messages
+                                        )
+                                    else:
+                                        # Parse CSV file
+                                        csv_rows = parse_csv(
+                                            csv_file_data, source_encoding
                                         )
 
-                                        # Upload CSV chunk to S3 with record count range in the filename
-                                        csv_key = f"queue/{csv_file_name}_{record_count_range}_{idx + 1}.csv"
-                                        s3_client.put_object(
-                                            Body=csv_chunk_data.read(),
-                                            Bucket=SEIL_S3_BUCKET,
-                                            Key=csv_key,
+                                        # Control totals come from the same parsed rows
+                                        control_totals = (
+                                            publish_control_totals(
+                                                csv_file_name, csv_rows
+                                            )
+                                            if CONTROL_TOTALS
+                                            else None
                                         )
-                                        # Send CSV key to SQS
-                                        sqs.send_message(
-                                            QueueUrl=sqs_queue_url, MessageBody=csv_key
+
+                                        # Split CSV rows into chunks and publish them
+                                        publish_chunks(
+                                            csv_file_name,
+                                            csv_rows,
+                                            source_encoding,
+                                            control_totals,
+                                            content_hash,
                                         )
-                                    file_with_path = sftp_path + "/" + csv_file_name
-                                    delete_file_path = file_with_path.replace(
-                                        "/ftp.out", ""
-                                    )
 
-                                    logger.info(f"Deleting file: {delete_file_path}")
-                                    delete_ftp_client.remove(delete_file_path)
+                                    # Record the file before deleting it so a failed
+                                    # delete does not cause it to be reprocessed
+                                    record_published(manifest, file_attr, content_hash)
+                                    save_manifest(
+                                        SEIL_S3_BUCKET,
+                                        SFTP_MANIFEST_KEY,
+                                        manifest,
+                                        MANIFEST_RETENTION_DAYS,
+                                    )
+                                    if COMPLETION_TRACKING:
+                                        logger.info(
+                                            f"Delete of {csv_file_name} deferred until "
+                                            "all chunks are imported"
+                                        )
+                                    else:
+                                        delete_landmark_file(
+                                            delete_ftp_client, sftp_path, csv_file_name
+                                        )
 
                                 except Exception as download_error:
                                     logger.error(
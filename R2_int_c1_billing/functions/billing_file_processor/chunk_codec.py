@@ -0,0 +1,43 @@
+import gzip
+import logging
+
+try:
+    import zstandard
+except ImportError:  # zstandard is optional, gzip is always available
+    zstandard = None
+
+logger = logging.getLogger("d2_landmark_sftp")
+logger.setLevel(logging.INFO)
+
+IDENTITY = "identity"
+GZIP = "gzip"
+ZSTD = "zstd"
+
+
+def resolve_chunk_encoding(requested_encoding):
+    """
+    Function to resolve the configured chunk encoding to one that can be
+    written here. zstd falls back to gzip when zstandard is not installed.
+    """
+    requested_encoding = (requested_encoding or IDENTITY).strip().lower()
+    if requested_encoding in ("", "none", IDENTITY):
+        return IDENTITY
+    if requested_encoding == ZSTD and zstandard is None:
+        logger.info("zstandard is not installed, using gzip for chunk encoding")
+        return GZIP
+    if requested_encoding not in (GZIP, ZSTD):
+        raise ValueError(f"Unsupported chunk encoding: {requested_encoding}")
+    return requested_encoding
+
+
+def encode_chunk(data, chunk_encoding):
+    """
+    Function to compress chunk bytes.
+    Returns (body, content_encoding); content_encoding is None for identity
+    so the object is written exactly as before.
+    """
+    if chunk_encoding == GZIP:
+        return gzip.compress(data, compresslevel=6, mtime=0), GZIP
+    if chunk_encoding == ZSTD:
+        return zstandard.ZstdCompressor(level=3).compress(data), ZSTD
+    return data, None
@@ -0,0 +1,153 @@
+import csv
+import json
+import logging
+from io import BytesIO, StringIO, TextIOWrapper
+from billing_encoding import canonical_headers
+
+logger = logging.getLogger("d2_landmark_sftp")
+logger.setLevel(logging.INFO)
+
+BYTE_RANGE_FORMAT = "byte-range"
+SCAN_BLOCK_SIZE = 1024 * 1024
+SQS_BATCH_SIZE = 10
+
+
+def find_record_boundaries(file_obj, records_per_chunk, on_chunk=None):
+    """
+    Function to scan a raw CSV stream once for chunk boundaries.
+    Newlines inside quoted fields are not record boundaries. Returns
+    (header_end, boundaries, size, record_count): header_end is the offset
+    just after the header record and boundaries holds the offset after every
+    records_per_chunk-th record, counting the header as record 0 like the
+    row-based split does. record_count includes the header.
+    on_chunk, when given, is called with the bytes of each chunk (the first
+    one starting with the header) as soon as the scan has passed it.
+    """
+    in_quotes = False
+    record_count = 0
+    header_end = None
+    boundaries = []
+    offset = 0
+    last_byte = b""
+    pending = []
+    chunk_start = 0
+
+    while True:
+        block = file_obj.read(SCAN_BLOCK_SIZE)
+        if not block:
+            break
+        position = offset
+        for index, segment in enumerate(block.split(b'"')):
+            if index:
+                in_quotes = not in_quotes
+                position += 1  # the quote itself
+            if not in_quotes:
+                newline = segment.find(b"\n")
+                while newline != -1:
+                    record_count += 1
+                    record_end = position + newline + 1
+                    if header_end is None:
+                        header_end = record_end
+                    if record_count % records_per_chunk == 0:
+                        boundaries.append(record_end)
+                        if on_chunk is not None:
+                            pending.append(
+                                block[
+                                    max(chunk_start - offset, 0) : record_end - offset
+                                ]
+                            )
+                            on_chunk(b"".join(pending))
+                            pending = []
+                            chunk_start = record_end
+                    newline = segment.find(b"\n", newline + 1)
+            position += len(segment)
+        if on_chunk is not None:
+            pending.append(block[max(chunk_start - offset, 0) :])
+        offset += len(block)
+        last_byte = block[-1:]
+
+    if last_byte not in (b"", b"\n"):
+        record_count += 1  # last record has no line ending
+    if on_chunk is not None and any(pending):
+        on_chunk(b"".join(pending))
+    if header_end is None:
+        header_end = offset
+    return header_end, boundaries, offset, record_count
+
+
+def build_range_messages(
+    csv_file_name, raw_key, file_obj, records_per_chunk, encoding, reconciliation=None
+):
+    """
+    Function to build one SQS message per chunk describing its byte range in
+    the raw object. The canonicalised header is carried in every message so the
+    consumer can read its slice with a single ranged get_object, decoding it
+    with the detected source encoding.
+    When a ReconciliationBuilder is given, each chunk's control totals are
+    added to it during the same scan and carried in its message as "totals".
+    """
+    on_chunk = None
+    if reconciliation is not None:
+
+        def on_chunk(data):
+            rows = list(
+                csv.reader(TextIOWrapper(BytesIO(data), encoding=encoding, newline=""))
+            )
+            if not reconciliation.chunks and rows:
+                rows[0] = canonical_headers(rows[0])
+            reconciliation.add_rows(rows)
+
+    header_end, boundaries, size, record_count = find_record_boundaries(
+        file_obj, records_per_chunk, on_chunk
+    )
+    file_obj.seek(0)
+    header_row = next(
+        csv.reader([file_obj.read(header_end).decode(encoding).rstrip("\r\n")])
+    )
+    header_text = StringIO()
+    csv.writer(header_text, lineterminator="").writerow(canonical_headers(header_row))
+    header = header_text.getvalue()
+
+    starts = [header_end] + [b for b in boundaries if b > header_end]
+    ends = starts[1:] + [size]
+    messages = []
+    for idx, (start, end) in enumerate(zip(starts, ends)):
+        if start >= end:
+            continue
+        record_count_start = idx * records_per_chunk
+        record_count_end = min(
+            record_count_start + records_per_chunk - 1, record_count - 1
+        )
+        chunk_key = f"queue/{csv_file_name}_{record_count_start}_{record_count_end}_{idx + 1}.csv"
+        messages.append(
+            {
+                "format": BYTE_RANGE_FORMAT,
+                "chunk_key": chunk_key,
+                "raw_key": raw_key,
+                "start": start,
+                "end": end,
+                "header": header,
+                "encoding": encoding,
+            }
+        )
+        if reconciliation is not None and chunk_key in reconciliation.chunks:
+            messages[-1]["totals"] = reconciliation.chunks[chunk_key]["accepted"]
+    logger.info(f"Found {len(messages)} byte-range chunk(s) in {raw_key}")
+    return messages
+
+
+def send_range_messages(sqs, queue_url, messages):
+    """
+    Function to send byte-range chunk messages to SQS in batches of ten
+    """
+    for batch_start in range(0, len(messages), SQS_BATCH_SIZE):
+        batch = messages[batch_start : batch_start + SQS_BATCH_SIZE]
+        response = sqs.send_message_batch(
+            QueueUrl=queue_url,
+            Entries=[
+                {"Id": str(index), "MessageBody": json.dumps(message)}
+                for index, message in enumerate(batch)
+            ],
+        )
+        if response.get("Failed"):
+            raise IOError(f"Failed to send chunk messages: {response['Failed']}")
@@ -34,6 +34,7 @@ def get_secret(secret_name):
         "user_id": secret["user_id"],
         "password": secret["password"],
         "key_value": secret["key_value"],
+        "port": int(secret.get("port", 22)),
     }
 
     logger.info(f"End get_landmark_secret()")
@@ -41,8 +42,8 @@ def get_secret(secret_name):
     return secret_dict
 
 
-def connect_to_sftp(hostname, username, ssh_key):
-    transport = paramiko.Transport((hostname, 22))
+def connect_to_sftp(hostname, username, ssh_key, port=22):
+    transport = paramiko.Transport((hostname, port))
     transport.connect(username=username, pkey=ssh_key)
     sftp = paramiko.SFTPClient.from_transport(transport)
     return sftp
@@ -78,7 +79,7 @@ def push_file_to_ga(bucket_name, file_name, secret_name, ftp_path):
         s3_response_object = s3.get_object(Bucket=bucket_name, Key=file_name)
         s3_object_body = s3_response_object["Body"].read()
         s3_file_content = BytesIO(s3_object_body)
-        ftp_client = connect_to_sftp(ftp_url, user_id, ssh_key)
+        ftp_client = connect_to_sftp(ftp_url, user_id, ssh_key, ftp_dict["port"])
         logger.info("Connected to GA STP")
         ftp_client.putfo(s3_file_content, sftp_path)
         ftp_client.close()
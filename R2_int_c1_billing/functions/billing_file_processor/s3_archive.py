@@ -0,0 +1,216 @@
+import base64
+import hashlib
+import logging
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+import boto3
+
+logger = logging.getLogger("d2_landmark_sftp")
+logger.setLevel(logging.INFO)
+
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+MIN_PART_SIZE = 5 * 1024 * 1024  # S3 minimum for all but the last part
+PART_UPLOAD_ATTEMPTS = 4
+
+
+class RecordCounter:
+    """
+    Quote-aware CSV record counter fed one block at a time.
+    Newlines inside quoted fields are not counted as record boundaries.
+    """
+
+    def __init__(self):
+        self.in_quotes = False
+        self.newlines = 0
+        self.last_byte = b""
+
+    def update(self, block):
+        for index, segment in enumerate(block.split(b'"')):
+            if index:
+                self.in_quotes = not self.in_quotes
+            if not self.in_quotes:
+                self.newlines += segment.count(b"\n")
+        if block:
+            self.last_byte = block[-1:]
+
+    @property
+    def record_count(self):
+        if self.last_byte in (b"", b"\n"):
+            return self.newlines
+        return self.newlines + 1
+
+
+def b64_sha256(data):
+    return base64.b64encode(hashlib.sha256(data).digest()).decode("ascii")
+
+
+def upload_part_with_retry(s3, bucket_name, key, upload_id, part_number, data):
+    """
+    Function to upload one multipart part, retrying only that part on error
+    """
+    checksum = b64_sha256(data)
+    for attempt in range(1, PART_UPLOAD_ATTEMPTS + 1):
+        try:
+            response = s3.upload_part(
+                Body=data,
+                Bucket=bucket_name,
+                Key=key,
+                UploadId=upload_id,
+                PartNumber=part_number,
+                ChecksumAlgorithm="SHA256",
+                ChecksumSHA256=checksum,
+            )
+            return {
+                "ETag": response["ETag"],
+                "PartNumber": part_number,
+                "ChecksumSHA256": response.get("ChecksumSHA256", checksum),
+            }
+        except Exception as e:
+            if attempt == PART_UPLOAD_ATTEMPTS:
+                raise e
+            logger.info(f"Retrying part {part_number} of {key} after error: {str(e)}")
+            time.sleep(2**attempt)
+
+
+def archive_raw_file(
+    file_obj,
+    bucket_name,
+    key,
+    expected_size,
+    tee=None,
+    part_size=DEFAULT_PART_SIZE,
+    max_workers=4,
+):
+    """
+    Function to stream a raw Landmark file into S3.
+    Files up to part_size are sent with a single checksummed put_object, larger
+    files as a multipart upload with parts sent in parallel. Every block read is
+    also written to tee, when given, so the caller can keep a local copy.
+    The byte size is stored as object metadata; the SHA-256 of the content and
+    the data row count (header excluded) are stored as object tags because they
+    are only known once the stream has been read.
+    Returns a dict with byte_size, row_count, sha256 and parts.
+    """
+    logger.info(f"Entering archive_raw_file() for {key}")
+    s3 = boto3.client("s3")
+    part_size = max(part_size, MIN_PART_SIZE)
+    start_time = time.time()
+
+    content_hash = hashlib.sha256()
+    counter = RecordCounter()
+    byte_size = 0
+
+    def read_part():
+        nonlocal byte_size
+        data = file_obj.read(part_size)
+        if data:
+            byte_size += len(data)
+            content_hash.update(data)
+            counter.update(data)
+            if tee is not None:
+                tee.write(data)
+        return data
+
+    metadata = {"byte-size": str(expected_size)}
+    data = read_part()
+    next_data = read_part() if len(data) == part_size else b""
+
+    if not next_data:
+        check_size(key, byte_size, expected_size)
+        archive = archive_summary(byte_size, counter, content_hash, 1)
+        s3.put_object(
+            Body=data,
+            Bucket=bucket_name,
+            Key=key,
+            ChecksumAlgorithm="SHA256",
+            ChecksumSHA256=b64_sha256(data),
+            Metadata=metadata,
+            Tagging=urlencode(archive_tags(archive)),
+        )
+    else:
+        upload_id = s3.create_multipart_upload(
+            Bucket=bucket_name,
+            Key=key,
+            ChecksumAlgorithm="SHA256",
+            Metadata=metadata,
+        )["UploadId"]
+        try:
+            parts = []
+            pending = deque()
+            part_number = 0
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                while data:
+                    part_number += 1
+                    pending.append(
+                        executor.submit(
+                            upload_part_with_retry,
+                            s3,
+                            bucket_name,
+                            key,
+                            upload_id,
+                            part_number,
+                            data,
+                        )
+                    )
+                    # Bound the number of parts held in memory
+                    while len(pending) >= max_workers * 2:
+                        parts.append(pending.popleft().result())
+                    data, next_data = next_data, (read_part() if next_data else b"")
+                while pending:
+                    parts.append(pending.popleft().result())
+
+            check_size(key, byte_size, expected_size)
+            s3.complete_multipart_upload(
+                Bucket=bucket_name,
+                Key=key,
+                UploadId=upload_id,
+                MultipartUpload={"Parts": parts},
+            )
+        except Exception as e:
+            logger.error(f"Aborting multipart upload of {key}: {str(e)}")
+            s3.abort_multipart_upload(Bucket=bucket_name, Key=key, UploadId=upload_id)
+            raise e
+
+        archive = archive_summary(byte_size, counter, content_hash, part_number)
+        s3.put_object_tagging(
+            Bucket=bucket_name,
+            Key=key,
+            Tagging={
+                "TagSet": [
+                    {"Key": tag_key, "Value": tag_value}
+                    for tag_key, tag_value in archive_tags(archive).items()
+                ]
+            },
+        )
+
+    elapsed = max(time.time() - start_time, 0.001)
+    logger.info(
+        f"Archived {key}: {byte_size} bytes, {archive['row_count']} rows, "
+        f"{archive['parts']} part(s) in {elapsed:.1f}s"
+    )
+    return archive
+
+
+def check_size(key, byte_size, expected_size):
+    if expected_size is not None and byte_size != expected_size:
+        raise IOError(
+            f"Size of {key} changed while archiving: expected {expected_size}, read {byte_size}"
+        )
+
+
+def archive_summary(byte_size, counter, content_hash, parts):
+    return {
+        "byte_size": byte_size,
+        "row_count": max(counter.record_count - 1, 0),
+        "sha256": content_hash.hexdigest(),
+        "parts": parts,
+    }
+
+
+def archive_tags(archive):
+    return {
+        "row-count": str(archive["row_count"]),
+        "sha256": archive["sha256"],
+    }
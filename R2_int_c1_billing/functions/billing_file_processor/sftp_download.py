@@ -0,0 +1,145 @@
+import logging
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+import paramiko
+
+logger = logging.getLogger("d2_landmark_sftp")
+logger.setLevel(logging.INFO)
+
+READ_BLOCK_SIZE = 1024 * 1024
+
+
+class MeteredReader:
+    """
+    Wraps a file-like object and times its reads so the download rate of each
+    file can be reported separately from the S3 upload it feeds.
+    local is True when file_obj is already a file on local disk.
+    """
+
+    def __init__(self, file_obj, file_name, timed=True, local=False):
+        self.file_obj = file_obj
+        self.file_name = file_name
+        self.timed = timed
+        self.local = local
+        self.bytes_read = 0
+        self.seconds = 0.0
+
+    def read(self, size=-1):
+        start_time = time.perf_counter()
+        data = self.file_obj.read(size)
+        if self.timed:
+            self.seconds += time.perf_counter() - start_time
+        self.bytes_read += len(data)
+        return data
+
+    def close(self):
+        self.file_obj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def local_copy(self):
+        """
+        Function to return the downloaded file rewound for another pass, or
+        None when the file was streamed and the caller must keep its own copy
+        """
+        if not self.local:
+            return None
+        self.file_obj.seek(0)
+        return self.file_obj
+
+    def log_rate(self):
+        megabytes = self.bytes_read / (1024 * 1024)
+        rate = megabytes / max(self.seconds, 0.001)
+        logger.info(
+            f"Downloaded {self.file_name}: {megabytes:.1f} MB in {self.seconds:.1f}s "
+            f"({rate:.2f} MB/s)"
+        )
+        return rate
+
+
+def open_sftp_client(ssh_client, window_size=None, max_packet_size=None):
+    """
+    Function to open an SFTP session with a tuned window and packet size.
+    None keeps the paramiko default for that setting.
+    """
+    return paramiko.SFTPClient.from_transport(
+        ssh_client.get_transport(),
+        window_size=window_size,
+        max_packet_size=max_packet_size,
+    )
+
+
+def open_prefetched(sftp, file_name, file_size, max_requests=None):
+    """
+    Function to open a remote file with pipelined prefetch reads, so reads
+    are not bound by one round trip per request
+    """
+    remote_file = sftp.open(file_name, "rb", bufsize=READ_BLOCK_SIZE)
+    remote_file.prefetch(file_size, max_concurrent_requests=max_requests)
+    return remote_file
+
+
+def parallel_download(sftp, file_name, file_size, workers, max_requests=None):
+    """
+    Function to download a remote file as parallel byte-range reads into a
+    temp file in the system temp dir (/tmp on Lambda). Each worker uses its
+    own handle and pipelines its reads with readv. Returns the temp file
+    positioned at the start.
+    """
+    local_file = tempfile.TemporaryFile(dir=tempfile.gettempdir())
+    range_size = -(-file_size // workers)
+
+    def fetch_range(range_start):
+        range_end = min(range_start + range_size, file_size)
+        blocks = [
+            (offset, min(READ_BLOCK_SIZE, range_end - offset))
+            for offset in range(range_start, range_end, READ_BLOCK_SIZE)
+        ]
+        with sftp.open(file_name, "rb") as remote_file:
+            for (offset, _), data in zip(
+                blocks,
+                remote_file.readv(
+                    blocks, max_concurrent_prefetch_requests=max_requests
+                ),
+            ):
+                os.pwrite(local_file.fileno(), data, offset)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for _ in executor.map(fetch_range, range(0, file_size, range_size)):
+            pass
+
+    local_file.seek(0)
+    return local_file
+
+
+def open_remote_file(
+    sftp,
+    file_name,
+    file_size,
+    parallel_threshold=None,
+    workers=1,
+    max_requests=None,
+):
+    """
+    Function to open a Landmark file for a single sequential pass.
+    Files of parallel_threshold bytes or more are fetched with parallel range
+    reads first; everything else is streamed with prefetch.
+    Returns a MeteredReader; call log_rate() once the file has been read.
+    """
+    if parallel_threshold and workers > 1 and file_size >= parallel_threshold:
+        start_time = time.perf_counter()
+        local_file = parallel_download(
+            sftp, file_name, file_size, workers, max_requests
+        )
+        reader = MeteredReader(local_file, file_name, timed=False, local=True)
+        reader.seconds = time.perf_counter() - start_time
+        return reader
+    return MeteredReader(
+        open_prefetched(sftp, file_name, file_size, max_requests), file_name
+    )
@@ -0,0 +1,152 @@
+import json
+import logging
+import time
+import datetime
+from stat import S_ISREG
+import boto3
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger("d2_landmark_sftp")
+logger.setLevel(logging.INFO)
+
+
+def load_manifest(bucket_name, manifest_key):
+    """
+    Function to load the processed-file manifest from S3.
+    An empty manifest is returned when none has been written yet.
+    """
+    s3 = boto3.client("s3")
+    try:
+        response = s3.get_object(Bucket=bucket_name, Key=manifest_key)
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+            logger.info(f"No manifest found at {manifest_key}, starting a new one")
+            return {"files": {}}
+        raise e
+    manifest = json.loads(response["Body"].read())
+    manifest.setdefault("files", {})
+    return manifest
+
+
+def save_manifest(bucket_name, manifest_key, manifest, retention_days=None):
+    """
+    Function to write the processed-file manifest back to S3.
+    Entries older than retention_days are dropped before writing.
+    """
+    if retention_days:
+        prune_manifest(manifest, retention_days)
+    s3 = boto3.client("s3")
+    s3.put_object(
+        Body=json.dumps(manifest, indent=1).encode("utf-8"),
+        Bucket=bucket_name,
+        Key=manifest_key,
+        ContentType="application/json",
+    )
+
+
+def prune_manifest(manifest, retention_days):
+    """
+    Function to drop manifest entries published more than retention_days ago
+    """
+    cutoff = (
+        datetime.datetime.now(datetime.timezone.utc)
+        - datetime.timedelta(days=retention_days)
+    ).isoformat()
+    files = manifest["files"]
+    for file_name in [n for n, e in files.items() if e["published_at"] < cutoff]:
+        del files[file_name]
+
+
+def is_published(manifest, file_attr):
+    """
+    Function to check whether a file with the same name, size and mtime
+    has already been published
+    """
+    entry = manifest["files"].get(file_attr.filename)
+    return (
+        entry is not None
+        and entry["size"] == file_attr.st_size
+        and entry["mtime"] == file_attr.st_mtime
+    )
+
+
+def find_published_hash(manifest, content_hash):
+    """
+    Function to return the name of a published file with the same content, if any
+    """
+    for file_name, entry in manifest["files"].items():
+        if entry.get("sha256") == content_hash:
+            return file_name
+    return None
+
+
+def record_published(manifest, file_attr, content_hash):
+    """
+    Function to record a file as published in the manifest
+    """
+    manifest["files"][file_attr.filename] = {
+        "size": file_attr.st_size,
+        "mtime": file_attr.st_mtime,
+        "sha256": content_hash,
+        "published_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+    }
+
+
+def list_csv_attrs(sftp):
+    """
+    Function to list the regular .csv files in the current SFTP directory
+    """
+    return {
+        file_attr.filename: file_attr
+        for file_attr in sftp.listdir_attr()
+        if file_attr.filename.lower().endswith(".csv")
+        and (file_attr.st_mode is None or S_ISREG(file_attr.st_mode))
+    }
+
+
+def scan_for_new_files(sftp, manifest, poll_seconds):
+    """
+    Function to scan the SFTP directory against the manifest.
+    Returns (ready_files, published_files):
+    ready_files - new files whose size and mtime did not change between two
+                  listings, sorted smallest first
+    published_files - files already in the manifest that are still on the
+                      server, i.e. their delete failed on an earlier run
+    """
+    logger.info("Entering scan_for_new_files()")
+    first_listing = list_csv_attrs(sftp)
+
+    published_files = []
+    candidates = {}
+    for file_name, file_attr in first_listing.items():
+        if is_published(manifest, file_attr):
+            published_files.append(file_attr)
+        else:
+            candidates[file_name] = file_attr
+
+    if candidates and poll_seconds > 0:
+        time.sleep(poll_seconds)
+        second_listing = list_csv_attrs(sftp)
+    else:
+        second_listing = first_listing
+
+    ready_files = []
+    for file_name, file_attr in candidates.items():
+        latest_attr = second_listing.get(file_name)
+        if latest_attr is None:
+            logger.info(f"File {file_name} disappeared during scan, skipping")
+        elif (
+            latest_attr.st_size != file_attr.st_size
+            or latest_attr.st_mtime != file_attr.st_mtime
+        ):
+            logger.info(f"File {file_name} is still being written, skipping")
+        else:
+            ready_files.append(latest_attr)
+
+    ready_files.sort(key=lambda file_attr: file_attr.st_size)
+    logger.info(
+        f"Scan found {len(ready_files)} new, {len(published_files)} already published, "
+        f"{len(first_listing) - len(ready_files) - len(published_files)} skipped"
+    )
+    logger.info("Exiting scan_for_new_files()")
+    return ready_files, published_files
@@ -5,14 +5,60 @@ import boto3
 import csv
 import io
 from io import StringIO
-import datetime
 from botocore.exceptions import ClientError
 import xml.etree.ElementTree as ET
+import gzip
+import itertools
+import time
+from botocore.config import Config
+from botocore.exceptions import ReadTimeoutError
+
+from billing_rows import (
+    TECHONE_ROWS_FORMAT,
+    change_date_format,
+    str_field_handling,
+    soap_envelope,
+    strip_embedded_quotes,
+    wrap_rows,
+)
+from billing_encoding import canonical_headers
+from billing_limiter import (
+    AdaptiveLimiter,
+    LocalStateBackend,
+    S3StateBackend,
+    NOT_CALLED,
+    SERVER_ERROR,
+    SUCCESS,
+    TIMEOUT,
+    classify_status_code,
+)
+from billing_totals import ControlTotals, compare_totals
+from billing_profiling import profiled
+from billing_state import DELIVERED, ERROR, record_chunk_state
+from billing_tracker import (
+    finalise_tracked_file,
+    notify_file_complete,
+    record_chunk_complete,
+)
+from billing_validation import (
+    validate_dict_rows,
+    rejected_rows_report,
+    write_rejected_report,
+)
+
+try:
+    import zstandard
+except ImportError:  # only needed for zstd encoded chunks
+    zstandard = None
 
 logger = logging.getLogger("Billing Queue Consumer")
 logger.setLevel(logging.INFO)
 
 DEFAULT_REGION = "ap-southeast-2"  # Sydney
+BYTE_RANGE_FORMAT = "byte-range"
+
+# Kept for the life of a warm container when LIMITER_BACKEND is "local"
+local_limiter_state = LocalStateBackend()
 
 
 def listToString(s):
@@ -60,156 +106,6 @@ def replace_all(text, dic):
     return text
 
 
-def change_date_format(row_billing):
-    """
-    Function to change date to dd/mm/yyyy format
-    """
-    try:
-        source_format = "%d%m%Y"
-        target_format = "%d/%m/%Y"
-        # row_billing_str_split = row_billing_str.split(",")
-        i_start_date = row_billing["Start Date"]
-        i_start_date_len = len(row_billing["Start Date"])
-        # logger.info(f"i_start_date_len :{i_start_date_len}")
-        if i_start_date_len == 7:
-            i_start_date = "0" + str(i_start_date)
-        i_end_date = row_billing["End Date"]
-        i_end_date_len = len(row_billing["End Date"])
-
-        # logger.info(f"i_end_date_len :{i_end_date_len}")
-        if i_end_date_len == 7:
-            i_end_date = "0" + str(i_end_date)
-        i_campaign_start_date = row_billing["Campaign Billing Start Date"]
-        i_campaign_start_date_len = len(i_campaign_start_date)
-        # logger.info(f"i_campaign_start_date_len: {i_campaign_start_date_len}")
-        i_campaign_end_date = row_billing["Campaign Billing End Date"]
-        i_campaign_end_date_len = len(i_campaign_end_date)
-        # logger.info(f"i_campaign_end_date_len: {i_campaign_end_date_len}")
-        if i_campaign_start_date_len == 7:
-            i_campaign_start_date = "0" + str(i_campaign_start_date)
-        if i_campaign_end_date_len == 7:
-            i_campaign_end_date = "0" + str(i_campaign_end_date)
-        start_date = datetime.datetime.strptime(i_start_date, source_format).strftime(
-            target_format
-        )
-        end_date = datetime.datetime.strptime(i_end_date, source_format).strftime(
-            target_format
-        )
-        campaign_start_date = datetime.datetime.strptime(
-            i_campaign_start_date, source_format
-        ).strftime(target_format)
-        campaign_end_date = datetime.datetime.strptime(
-            i_campaign_end_date, source_format
-        ).strftime(target_format)
-        # replace_dic = {
-        #    i_start_date: start_date,
-        #    i_end_date: end_date,
-        #    i_campaign_start_date: campaign_start_date,
-        #    i_campaign_end_date: campaign_end_date,
-        # }
-        # row_billing_str = replace_all(row_billing_str, replace_dic)
-        row_billing["Start Date"] = start_date
-        row_billing["End Date"] = end_date
-        row_billing["Campaign Billing Start Date"] = campaign_start_date
-        row_billing["Campaign Billing End Date"] = campaign_end_date
-
-        return row_billing
-    except Exception as e:
-        print(f"Error converting in row: {row_billing}. Error: {e}")
-
-
-def str_field_handling(row_billing):
-    """
-    Function to add double quotes to the string fields.
-    Numeric and Date fields will be ignored
-    """
-    # row_billing_str_split = row_billing_str.split(",")
-    # Double quote will be added to belowString field
-    business_area_code = row_billing["Business Area"]
-    sales_rep = row_billing["Sales Rep"]
-    sales_group = row_billing["Sales Group"]
-    sales_office = row_billing["Sales Office"]
-    transaction_type = row_billing["Transaction Type"]
-    goods_received = row_billing["Goods Received"]
-    campaign_type = row_billing["Campaign Type"]
-    crmid = row_billing["CRMID"]
-    billing_account_name = row_billing["Billing Account Name"]
-    primary_advertiser = row_billing["Primary Advertiser"]
-    campaign_name = row_billing["Campaign Name"]
-    revenue_type = row_billing["Revenue Type"]
-    invoice_currency = row_billing["Invoice Currency"]
-    external_po_number = row_billing["PO Number"]
-    subtotal_salesarea_code = row_billing["Subtotal \x96 Sales Area Code"]
-    subtotal_salesarea = row_billing["Subtotal \x96 Sales Area"]
-    tax = row_billing["Tax"]
-
-    # Double quotes should not be added to Numeric and Date fields.
-    # Numeric fields
-    general_ledger_code = row_billing["General Ledger Code"]
-    campaign_reference = row_billing["Campaign Reference"]
-    invoice_number = row_billing["Invoice Number"]
-    line_number = row_billing["Line Number"]
-    subtotal_line = row_billing["Subtotal Line"]
-    agency_commision = row_billing["Agency Commission"]
-
-    # Date Column
-    i_start_date = row_billing["Start Date"]
-    i_end_date = row_billing["End Date"]
-    i_campaign_start_date = row_billing["Campaign Billing Start Date"]
-    i_campaign_end_date = row_billing["Campaign Billing End Date"]
-
-    journal_comments = row_billing["Journal Comments"]
-    journal_type = row_billing["Journal Type"]
-    product_code = row_billing["Product Code"]
-    product_name = row_billing["Product Name"]
-
-    field_list = [
-        general_ledger_code,
-        business_area_code,
-        sales_rep,
-        sales_group,
-        sales_office,
-        transaction_type,
-        goods_received,
-        campaign_type,
-        crmid,
-        billing_account_name,
-        primary_advertiser,
-        i_start_date,
-        i_end_date,
-        campaign_reference,
-        campaign_name,
-        revenue_type,
-        invoice_currency,
-        invoice_number,
-        line_number,
-        external_po_number,
-        subtotal_salesarea_code,
-        subtotal_salesarea,
-        tax,
-        subtotal_line,
-        agency_commision,
-        i_campaign_start_date,
-        i_campaign_end_date,
-        journal_comments,
-        journal_type,
-        product_code,
-        product_name,
-    ]
-    modified_row_billing_str = ""
-
-    for index, field in enumerate(field_list):
-        # Double quotes will not be added for below fields
-        if index in [0, 11, 12, 13, 17, 18, 23, 24, 25, 26, 28, 29]:
-            modified_row_billing_str += field + ","
-        else:
-            field_quote = f'"{field}"'
-            modified_row_billing_str += field_quote + ","
-
-    modified_row_billing_str = modified_row_billing_str[:-1]
-    return modified_row_billing_str
-
-
 def construct_soap_request(user_id, password, config, csv_reader_list, first_file_flag):
     """
     Function to construct Techone SOAP Request.
@@ -236,63 +132,7 @@ def construct_soap_request(user_id, password, config, csv_reader_list, first_fil
     Sales Office	-->  SALESOFFICE
     """
 
-    soap_request = (
-        '<?xml version="1.0" encoding="UTF-8"?>'
-        + "<soapenv:Envelope"
-        + ' xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/" '
-        + ' xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
-        + ' xmlns:ns1="http://TechnologyOneCorp.com/Public/Services"> '
-        + "   <soapenv:Header/> "
-        + "   <soapenv:Body> "
-        + "     <ns1:Warehouse_DoImport> "
-        + '         <ns1:request WarehouseName="SALESFORCE" WarehouseTableName="BILLINGDATA" ImportMode="MixedMode"> '
-        + '            <ns1:Auth UserId="'
-        + user_id
-        + '" Password="'
-        + password
-        + '" Config="'
-        + config
-        + '" FunctionName="$E1.BI.WHT.DOIMP.WS"/> '
-        + "            <ns1:Columns> "
-        + '               <ns1:ColumnInfo Name="GENERALLEDGERCODE"/>'
-        + '               <ns1:ColumnInfo Name="BUSINESSAREACODE"/>'
-        + '               <ns1:ColumnInfo Name="SALESREP"/>'
-        + '               <ns1:ColumnInfo Name="SALESGROUP"/> '
-        + '               <ns1:ColumnInfo Name="SALESOFFICE"/> '
-        + '               <ns1:ColumnInfo Name="TRANSACTIONTYPE"/> '
-        + '               <ns1:ColumnInfo Name="GOODSRECEIVED"/>'
-        + '               <ns1:ColumnInfo Name="CAMPAIGNTYPE"/>'
-        + '               <ns1:ColumnInfo Name="CRMID"/>'
-        + '               <ns1:ColumnInfo Name="BILLINGACCOUNTNAME"/>'
-        + '               <ns1:ColumnInfo Name="PRIMARYADVERTISER"/>'
-        + '               <ns1:ColumnInfo Name="STARTDATE"/> '
-        + '               <ns1:ColumnInfo Name="ENDDATE"/> '
-        + '               <ns1:ColumnInfo Name="CAMPAIGNREFERENCE"/>'
-        + '               <ns1:ColumnInfo Name="CAMPAIGNNAME"/>'
-        + '               <ns1:ColumnInfo Name="REVENUETYPE"/>'
-        + '               <ns1:ColumnInfo Name="INVOICECURRENCY"/>'
-        + '               <ns1:ColumnInfo Name="INVOICENUMBER"/>'
-        + '               <ns1:ColumnInfo Name="LINENUMBER"/>'
-        + '               <ns1:ColumnInfo Name="EXTERNALPONUMBER"/>'
-        + '               <ns1:ColumnInfo Name="SUBTOTALSALESAREACODE"/>'
-        + '               <ns1:ColumnInfo Name="SUBTOTALSALESAREA"/>'
-        + '               <ns1:ColumnInfo Name="TAX"/>'
-        + '               <ns1:ColumnInfo Name="SUBTOTALLINE"/>'
-        + '               <ns1:ColumnInfo Name="AGENCYCOMMISSION"/>'
-        + '               <ns1:ColumnInfo Name="CAMPAIGNBILLINGSTARTDATE"/> '
-        + '               <ns1:ColumnInfo Name="CAMPAIGNBILLINGENDDATE"/> '
-        + '               <ns1:ColumnInfo Name="JOURNALCOMMENTS"/> '
-        + '               <ns1:ColumnInfo Name="JOURNALTYPE"/> '
-        + '               <ns1:ColumnInfo Name="PRODUCTCODE"/> '
-        + '               <ns1:ColumnInfo Name="PRODUCTNAME"/> '
-        + "            </ns1:Columns> "
-        + "            <ns1:Rows> "
-        + "            </ns1:Rows> "
-        + "         </ns1:request> "
-        + "      </ns1:Warehouse_DoImport> "
-        + "   </soapenv:Body> "
-        + "</soapenv:Envelope> "
-    )
+    soap_request = soap_envelope(user_id, password, config)
 
     file_object = io.StringIO(soap_request)
     tree = ET.parse(file_object)
@@ -336,84 +176,507 @@ def construct_soap_request(user_id, password, config, csv_reader_list, first_fil
     return root
 
 
-def read_data_from_s3(file_path):
+def open_chunk_stream(s3_object):
     """
-    Function to read data from S3 bucket
+    Function to return a binary stream over a chunk object, decompressing it
+    on the fly according to its ContentEncoding
+    """
+    body = s3_object["Body"]
+    content_encoding = (s3_object.get("ContentEncoding") or "").lower()
+    if content_encoding == "gzip":
+        return gzip.GzipFile(fileobj=body, mode="rb")
+    if content_encoding == "zstd":
+        if zstandard is None:
+            raise ValueError("Chunk is zstd encoded but zstandard is not installed")
+        return zstandard.ZstdDecompressor().stream_reader(body)
+    return body
+
+
+def parse_queue_message(body):
+    """
+    Function to parse an SQS message body. Plain bodies are chunk keys, JSON
+    bodies are byte-range manifests published by the processor.
+    """
+    if body.lstrip().startswith("{"):
+        return json.loads(body)
+    return {"chunk_key": body}
+
+
+def chunk_charset(s3_object):
+    """
+    Function to return the charset a chunk object was written with.
+    The processor writes UTF-8 and says so in the ContentType.
+    """
+    content_type = s3_object.get("ContentType") or ""
+    for param in content_type.split(";")[1:]:
+        key, _, value = param.strip().partition("=")
+        if key.lower() == "charset" and value:
+            return value
+    return "utf-8"
+
+
+def get_chunk_object(file_path):
+    """
+    Function to get a chunk object from S3 bucket
     """
     billing_bucket = os.environ["BILLING_BUCKET"]
     s3_client = boto3.client("s3", region_name=DEFAULT_REGION)
     logger.info("Getting Object from S3")
-    data = s3_client.get_object(Bucket=billing_bucket, Key=file_path)
-    contents = data["Body"].read().decode("utf-8").splitlines()
-    # contents = data["Body"].read().decode("windows-1252").splitlines()
+    return s3_client.get_object(Bucket=billing_bucket, Key=file_path)
+
+
+def read_row_lines_from_s3(data):
+    """
+    Function to read a pre-transformed chunk, one <ns1:Row> payload per line
+    """
+    contents = io.TextIOWrapper(
+        open_chunk_stream(data), encoding=chunk_charset(data), newline=""
+    )
+    return [line.rstrip("\r\n") for line in contents if line.strip()]
+
+
+def read_data_from_s3(file_path, data=None):
+    """
+    Function to read data from S3 bucket
+    """
+    if data is None:
+        data = get_chunk_object(file_path)
+    contents = io.TextIOWrapper(
+        open_chunk_stream(data), encoding=chunk_charset(data), newline=""
+    )
+    return parse_csv_lines(contents)
+
+
+def read_range_from_s3(message):
+    """
+    Function to read a chunk's byte range straight from the raw object.
+    The header carried in the message is put in front of the slice.
+    """
+    billing_bucket = os.environ["BILLING_BUCKET"]
+    s3_client = boto3.client("s3", region_name=DEFAULT_REGION)
+    logger.info(
+        f"Getting bytes {message['start']}-{message['end'] - 1} of {message['raw_key']} from S3"
+    )
+    data = s3_client.get_object(
+        Bucket=billing_bucket,
+        Key=message["raw_key"],
+        Range=f"bytes={message['start']}-{message['end'] - 1}",
+    )
+    contents = io.TextIOWrapper(data["Body"], encoding=message["encoding"], newline="")
+    return parse_csv_lines(itertools.chain([message["header"] + "\n"], contents))
+
+
+def parse_csv_lines(contents):
+    """
+    Function to parse CSV lines into row dicts with canonical header names,
+    removing embedded double quotes
+    """
     csv_reader = csv.DictReader(
         contents, delimiter=",", quotechar='"', quoting=csv.QUOTE_MINIMAL
     )
+    # Chunks written before ingest-time normalisation still carry the raw
+    # Landmark header names
+    csv_reader.fieldnames = canonical_headers(csv_reader.fieldnames or [])
     parsed_data = list(csv_reader)
 
-    # Check for double quotes and log
-    cleaned_data = []
-    for row in parsed_data:
-        cleaned_row = {}
-        for key, value in row.items():
-            if isinstance(value, str):
-                if '"' in value:  # Check if double quotes exist
-                    logger.info(
-                        f'Double quotes found in key "{key}", value: "{value}", row: "{row}"'
+    return [strip_embedded_quotes(row) for row in parsed_data]
+
+
+def finalise_if_complete(chunk_key, details, file_id=None):
+    """
+    Function to record a chunk as imported and, when it is the last chunk of
+    its file, run the file-level actions once: write the summary, ask the
+    processor to delete the Landmark file and send a notification.
+    Failed actions are recorded and retried by the processor's next run.
+    """
+    billing_bucket = os.environ["BILLING_BUCKET"]
+    expected = record_chunk_complete(billing_bucket, chunk_key, details, file_id)
+    if expected is None:
+        return
+    logger.info(f"All chunks of {expected['file_name']} imported")
+
+    actions = []
+    finalise_function = os.environ.get("FILE_FINALISE_FUNCTION")
+    if finalise_function:
+        actions.append(
+            (
+                "finalise",
+                lambda summary: boto3.client("lambda").invoke(
+                    FunctionName=finalise_function,
+                    InvocationType="Event",
+                    Payload=json.dumps(
+                        {
+                            "action": "finalise",
+                            "file_name": summary["file_name"],
+                            "file_sha256": summary["file_id"],
+                        }
+                    ),
+                ),
+            )
+        )
+    topic_arn = os.environ.get("FILE_COMPLETE_TOPIC_ARN")
+    if topic_arn:
+        actions.append(
+            ("notify", lambda summary: notify_file_complete(topic_arn, summary))
+        )
+    finalise_tracked_file(billing_bucket, expected, actions)
+
+
+def get_limiter():
+    """
+    Function to build the TechOne concurrency limiter from the environment.
+    Returns None when LIMITER_BACKEND is "off".
+    """
+    backend_name = os.environ.get("LIMITER_BACKEND", "off").lower()
+    if backend_name == "off":
+        return None
+    if backend_name == "s3":
+        # Not the billing bucket: its versioning and replication would copy
+        # every limiter write
+        backend = S3StateBackend(
+            os.environ["LIMITER_BUCKET"],
+            os.environ.get("LIMITER_STATE_KEY", "limiter/techone.json"),
+        )
+    else:
+        backend = local_limiter_state
+    return AdaptiveLimiter(
+        backend,
+        max_limit=int(os.environ.get("LIMITER_MAX_CONCURRENCY", "10")),
+        initial_limit=int(os.environ.get("LIMITER_INITIAL_CONCURRENCY", "2")),
+        target_latency=float(os.environ.get("LIMITER_TARGET_LATENCY_SECONDS", "30")),
+        failure_threshold=int(os.environ.get("LIMITER_FAILURE_THRESHOLD", "3")),
+        open_seconds=int(os.environ.get("LIMITER_OPEN_SECONDS", "120")),
+    )
+
+
+def defer_records(records, seconds):
+    """
+    Function to make refused messages visible again after `seconds` instead
+    of the queue's full visibility timeout. Queue URLs are looked up once
+    per queue and messages are changed in batches of 10.
+    """
+    by_queue = {}
+    for record in records:
+        if record.get("receiptHandle") and record.get("eventSourceARN"):
+            by_queue.setdefault(record["eventSourceARN"], []).append(record)
+    if not by_queue:
+        return
+    sqs = boto3.client("sqs")
+    for queue_arn, queue_records in by_queue.items():
+        try:
+            queue_url = sqs.get_queue_url(QueueName=queue_arn.split(":")[-1])[
+                "QueueUrl"
+            ]
+            for start in range(0, len(queue_records), 10):
+                response = sqs.change_message_visibility_batch(
+                    QueueUrl=queue_url,
+                    Entries=[
+                        {
+                            "Id": str(index),
+                            "ReceiptHandle": record["receiptHandle"],
+                            "VisibilityTimeout": seconds,
+                        }
+                        for index, record in enumerate(
+                            queue_records[start : start + 10]
+                        )
+                    ],
+                )
+                for failed in response.get("Failed", []):
+                    logger.error(
+                        f"Could not change visibility of a refused message: {failed}"
                     )
-                    cleaned_row[key] = value.replace('"', "")  # remove the quotes.
-                else:
-                    cleaned_row[key] = value
-            else:
-                cleaned_row[key] = value
-        cleaned_data.append(cleaned_row)
+        except ClientError as e:
+            logger.error(
+                f"Could not change visibility of refused messages on {queue_arn}: {e}"
+            )
 
-    return cleaned_data
 
+def track_chunk_state(chunk_key, state, details=None):
+    """
+    Function to record a chunk's delivery state when STATE_TRACKING is
+    "ledger" (tags and markers) or "prefix" (the old copy and delete moves)
+    """
+    mode = os.environ.get("STATE_TRACKING", "off").lower()
+    if mode == "off":
+        return
+    try:
+        record_chunk_state(
+            os.environ["BILLING_BUCKET"], chunk_key, state, details, mode
+        )
+    except Exception as e:
+        logger.error(f"Could not record {chunk_key} as {state}: {e}")
 
-def lambda_handler(event, context):
-    logger.info("Billing Queue Consumer")
-    logger.info(event)
 
-    techone_soap_secret_name = os.environ["TECHONE_SOAP_SECRET_NAME"]
+def receive_count(record):
+    return int(record.get("attributes", {}).get("ApproximateReceiveCount", "1"))
 
-    techone_soap_dic = get_techone_soap_secret(techone_soap_secret_name)
+
+def is_final_attempt(record):
+    """
+    Function to check whether a failed message will not be retried: this was
+    its last receive before SQS moves it to the DLQ. MAX_RECEIVE_COUNT must
+    match the queue's maxReceiveCount; unset, every failure counts as final.
+    """
+    max_receive_count = int(os.environ.get("MAX_RECEIVE_COUNT", "0"))
+    return not max_receive_count or receive_count(record) >= max_receive_count
+
+
+def read_invoke_payload(response):
+    """
+    Function to read the adaptor's result from a Lambda invoke response
+    """
+    payload = response.get("Payload")
+    if hasattr(payload, "read"):
+        payload = payload.read()
+    if not payload:
+        return None
+    try:
+        return json.loads(payload)
+    except ValueError:
+        return payload
+
+
+def call_techone(wsdl, soap_request_str):
+    """
+    Function to send a SOAP request through the TechOne adaptor.
+    Returns (outcome, seconds taken) where outcome is one of the limiter
+    outcomes: timeouts, 429s and 5xx are told apart from a good answer.
+    """
+    # Wait out the adaptor's own timeout and never resend an import on our own
+    lambda_client = boto3.client(
+        "lambda", config=Config(read_timeout=310, retries={"max_attempts": 0})
+    )
+    techone_request = {
+        "content": {"soap_url": wsdl, "content": soap_request_str},
+    }
+
+    start_time = time.perf_counter()
+    try:
+        techone_response = lambda_client.invoke(
+            FunctionName=os.environ["TECHONE_ADAPTOR_FUNCTION"],
+            InvocationType="RequestResponse",
+            Payload=json.dumps(techone_request),
+        )
+    except ReadTimeoutError:
+        logger.error("Timed out waiting for the TechOne adaptor")
+        return TIMEOUT, time.perf_counter() - start_time
+    latency = time.perf_counter() - start_time
+
+    logger.info(techone_response)
+    logger.info(techone_response["ResponseMetadata"]["HTTPStatusCode"])
+    payload = read_invoke_payload(techone_response)
+    logger.info(payload)
+
+    if "FunctionError" in techone_response:
+        error_message = str(payload)
+        return (
+            TIMEOUT if "timed out" in error_message.lower() else SERVER_ERROR
+        ), latency
+    if techone_response["ResponseMetadata"]["HTTPStatusCode"] != 200:
+        return SERVER_ERROR, latency
+    if isinstance(payload, dict) and "status_code" in payload:
+        return (
+            classify_status_code(payload["status_code"], payload.get("body")),
+            latency,
+        )
+    return SUCCESS, latency
+
+
+def check_control_totals(chunk_key, expected, accepted):
+    """
+    Function to compare the totals of the rows being imported with the
+    chunk's expected control totals from the processor.
+    Returns True/False, or None when the chunk carries no expected totals.
+    """
+    if not expected:
+        return None
+    differences = compare_totals(expected, accepted.compact())
+    if differences:
+        logger.error(
+            f"{chunk_key} does not match its control totals: {'; '.join(differences)}"
+        )
+        return False
+    logger.info(f"{chunk_key} matches its control totals")
+    return True
+
+
+def process_record(record, techone_soap_dic, limiter=None, lease=None):
+    """
+    Function to import one queued chunk into TechOne.
+    Returns the limiter outcome of the TechOne call.
+    """
     user_id = techone_soap_dic["user_id"]
     password = techone_soap_dic["password"]
     wsdl = techone_soap_dic["wsdl"]
     config = techone_soap_dic["config"]
 
-    records = event["Records"][0]
-    logger.info(records)
-    file_path = event["Records"][0]["body"]
+    logger.info(record)
+    message = parse_queue_message(record["body"])
+    file_path = message["chunk_key"]
     logger.info(file_path)
     if file_path.endswith("_1.csv"):
         first_file_flag = True
     else:
         first_file_flag = False
-    csv_reader_list = read_data_from_s3(file_path)
-    logger.info("Before Content")
-    logger.info(csv_reader_list)
-    root_xml = construct_soap_request(
-        user_id, password, config, csv_reader_list, first_file_flag
+    if message.get("format") == BYTE_RANGE_FORMAT:
+        chunk_object = None
+        chunk_format = BYTE_RANGE_FORMAT
+        expected_totals = message.get("totals")
+        file_id = message.get("file_sha256")
+    else:
+        chunk_object = get_chunk_object(file_path)
+        chunk_format = chunk_object.get("Metadata", {}).get("chunk-format")
+        expected_totals = json.loads(
+            chunk_object.get("Metadata", {}).get("control-totals") or "null"
+        )
+        file_id = chunk_object.get("Metadata", {}).get("file-sha256")
+    if chunk_format == TECHONE_ROWS_FORMAT:
+        # Rows were validated and transformed by the processor at split time
+        row_lines = read_row_lines_from_s3(chunk_object)
+        row_count, rejected_count = len(row_lines), 0
+        accepted_totals = ControlTotals().add_row_lines(row_lines)
+        logger.info(f"Record Count in Construct stage: {len(row_lines)}")
+        soap_request_str = soap_envelope(
+            user_id, password, config, wrap_rows(row_lines)
+        )
+    else:
+        if chunk_format == BYTE_RANGE_FORMAT:
+            csv_reader_list = read_range_from_s3(message)
+        else:
+            csv_reader_list = read_data_from_s3(file_path, chunk_object)
+        logger.info("Before Content")
+        logger.info(csv_reader_list)
+
+        # Validate the whole chunk up front so one bad row cannot fail the import
+        mask, reasons = validate_dict_rows(csv_reader_list)
+        if reasons:
+            write_rejected_report(
+                os.environ["BILLING_BUCKET"],
+                file_path,
+                rejected_rows_report(file_path, csv_reader_list, reasons),
+            )
+            csv_reader_list = [
+                row_billing for row_billing, ok in zip(csv_reader_list, mask) if ok
+            ]
+        row_count, rejected_count = len(csv_reader_list), len(reasons)
+        accepted_totals = ControlTotals().add_dict_rows(csv_reader_list)
+        root_xml = construct_soap_request(
+            user_id, password, config, csv_reader_list, first_file_flag
+        )
+        logger.info(type(root_xml))
+        logger.info(root_xml)
+        root_xml_str = ET.tostring(root_xml)
+        # logger.info(root_xml_str)
+        # print(ET.tostring(root_xml, encoding='utf8').decode('utf8'))
+        soap_request_str = root_xml_str.decode()
+
+    reconciled = check_control_totals(file_path, expected_totals, accepted_totals)
+
+    outcome, latency = call_techone(wsdl, soap_request_str)
+    if limiter is not None:
+        try:
+            limiter.release(lease, latency, outcome)
+        except Exception as e:
+            # The lease expires on its own; failing here would re-import the chunk
+            logger.error(f"Could not release limiter lease after {outcome}: {e}")
+    if outcome != SUCCESS:
+        logger.error(f"TechOne import of {file_path} failed: {outcome}")
+        # Retries leave the state alone; only a chunk bound for the DLQ is an error
+        if is_final_attempt(record):
+            track_chunk_state(
+                file_path,
+                ERROR,
+                {
+                    "outcome": outcome,
+                    "body": record["body"],
+                    "receive_count": receive_count(record),
+                    "terminal": True,
+                },
+            )
+        return outcome
+
+    track_chunk_state(
+        file_path, DELIVERED, {"row_count": row_count, "rejected_count": rejected_count}
     )
-    logger.info(type(root_xml))
-    logger.info(root_xml)
-    root_xml_str = ET.tostring(root_xml)
-    # logger.info(root_xml_str)
-    # print(ET.tostring(root_xml, encoding='utf8').decode('utf8'))
 
-    lambda_client = boto3.client("lambda")
-    techone_request = {
-        "content": {"soap_url": wsdl, "content": root_xml_str.decode()},
-    }
+    if os.environ.get("COMPLETION_TRACKING", "false").lower() == "true":
+        # The chunk is in TechOne now; bookkeeping failures must not send it
+        # back to the queue to be imported again
+        try:
+            finalise_if_complete(
+                file_path,
+                {
+                    "row_count": row_count,
+                    "rejected_count": rejected_count,
+                    "reconciled": reconciled,
+                    "totals": accepted_totals.to_dict(),
+                },
+                file_id,
+            )
+        except Exception as e:
+            logger.exception(f"Could not record {file_path} as complete: {e}")
+    return outcome
+
+
+@profiled
+def lambda_handler(event, context):
+    logger.info("Billing Queue Consumer")
+    logger.info(event)
 
-    techone_response = lambda_client.invoke(
-        FunctionName=os.environ["TECHONE_ADAPTOR_FUNCTION"],
-        InvocationType="RequestResponse",
-        Payload=json.dumps(techone_request),
-    )
+    techone_soap_secret_name = os.environ["TECHONE_SOAP_SECRET_NAME"]
 
-    logger.info(techone_response)
-    logger.info(techone_response["ResponseMetadata"]["HTTPStatusCode"])
-    logger.info(techone_response["Payload"])
+    techone_soap_dic = get_techone_soap_secret(techone_soap_secret_name)
+    limiter = get_limiter()
+    retry_seconds = int(os.environ.get("LIMITER_RETRY_SECONDS", "60"))
+
+    batch_item_failures = []
+    for position, record in enumerate(event["Records"]):
+        lease = None
+        if limiter is not None:
+            try:
+                lease, reason = limiter.try_acquire()
+            except Exception as acquire_error:
+                # Treated as a refusal: raising would redeliver the whole batch,
+                # re-importing the records already imported above
+                logger.error(f"Could not acquire limiter lease: {acquire_error}")
+                lease, reason = None, f"limiter unavailable: {acquire_error}"
+            if lease is None:
+                logger.info(f"Not calling TechOne: {reason}")
+                # Hand the rest of the batch back without touching TechOne
+                refused = event["Records"][position:]
+                defer_records(refused, retry_seconds)
+                batch_item_failures += [
+                    {"itemIdentifier": record.get("messageId")} for record in refused
+                ]
+                break
+        try:
+            outcome = process_record(record, techone_soap_dic, limiter, lease)
+        except Exception as e:
+            logger.exception(
+                f"Failed to process message {record.get('messageId')}: {e}"
+            )
+            try:
+                chunk_key = parse_queue_message(record["body"])["chunk_key"]
+            except (ValueError, KeyError):
+                chunk_key = None
+            if chunk_key and is_final_attempt(record):
+                track_chunk_state(
+                    chunk_key,
+                    ERROR,
+                    {
+                        "error": str(e),
+                        "body": record["body"],
+                        "receive_count": receive_count(record),
+                        "terminal": True,
+                    },
+                )
+            if limiter is not None:
+                try:
+                    limiter.release(lease, 0.0, NOT_CALLED)
+                except Exception as release_error:
+                    logger.error(f"Could not release limiter lease: {release_error}")
+            outcome = NOT_CALLED
+        if outcome != SUCCESS:
+            batch_item_failures.append({"itemIdentifier": record.get("messageId")})
+
+    return {"batchItemFailures": batch_item_failures}
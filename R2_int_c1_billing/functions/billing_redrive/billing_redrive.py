@@ -0,0 +1,460 @@
+"""
+Replays failed billing chunks back onto the billing queue.
+
+Runs as a Lambda (options in the event) or from a shell:
+
+    PYTHONPATH=functions/billing_common python functions/billing_redrive/billing_redrive.py \
+        --source dlq --file FINANCE_20240510113633.csv --since 2024-05-10 --rate 20
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import boto3
+
+from billing_state import (
+    DELIVERED,
+    ERROR,
+    LEDGER_MODE,
+    PREFIX_MODE,
+    QUEUED,
+    get_chunk_state,
+    list_chunks_in_state,
+    move_chunk,
+    record_chunk_state,
+    state_marker_key,
+)
+from billing_tracker import get_document
+
+logger = logging.getLogger("Billing Redrive")
+logger.setLevel(logging.INFO)
+
+SQS_BATCH_SIZE = 10
+DLQ_VISIBILITY_SECONDS = 900
+
+
+class RateLimiter:
+    """
+    Token bucket shared by the sending workers, `rate` messages per second
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, count=1):
+        if not self.rate:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    max(self.rate, count),
+                    self.tokens + (now - self.updated) * self.rate,
+                )
+                self.updated = now
+                if self.tokens >= count:
+                    self.tokens -= count
+                    return
+                wait = (count - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def parse_time(value):
+    """
+    Function to read an ISO date or date-time option as UTC
+    """
+    if not value:
+        return None
+    if isinstance(value, datetime.datetime):
+        parsed = value
+    else:
+        parsed = datetime.datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+    return parsed
+
+
+def message_chunk_key(body):
+    """
+    Function to get the chunk key from a queue message body, plain key or
+    byte-range manifest
+    """
+    if body.lstrip().startswith("{"):
+        return json.loads(body)["chunk_key"]
+    return body.strip()
+
+
+def matches(chunk_key, timestamp, options):
+    """
+    Function to apply the file and date range filters to one chunk
+    """
+    if options["file_name"] and not chunk_key.startswith(
+        f"queue/{options['file_name']}_"
+    ):
+        return False
+    if options["since"] and (timestamp is None or timestamp < options["since"]):
+        return False
+    if options["until"] and (timestamp is None or timestamp >= options["until"]):
+        return False
+    return True
+
+
+def read_dlq(sqs, dlq_url, options):
+    """
+    Function to read the DLQ in batches with parallel readers.
+    Returns (candidates, skipped): one candidate per distinct chunk key,
+    at most options["max_messages"], holding the receipt handles of all its
+    copies, and the receipt handles of messages that did not match the
+    filters or were over the limit, to be released.
+    """
+    candidates = {}
+    skipped = []
+    lock = threading.Lock()
+
+    def reader():
+        while True:
+            with lock:
+                if (
+                    options["max_messages"]
+                    and len(candidates) >= options["max_messages"]
+                ):
+                    return
+            response = sqs.receive_message(
+                QueueUrl=dlq_url,
+                MaxNumberOfMessages=SQS_BATCH_SIZE,
+                WaitTimeSeconds=1,
+                VisibilityTimeout=DLQ_VISIBILITY_SECONDS,
+                MessageSystemAttributeNames=["SentTimestamp"],
+            )
+            messages = response.get("Messages", [])
+            if not messages:
+                return
+            with lock:
+                for message in messages:
+                    sent = datetime.datetime.fromtimestamp(
+                        int(message["Attributes"]["SentTimestamp"]) / 1000,
+                        tz=datetime.timezone.utc,
+                    )
+                    try:
+                        chunk_key = message_chunk_key(message["Body"])
+                    except (ValueError, KeyError):
+                        logger.error(f"Unreadable DLQ message {message['MessageId']}")
+                        skipped.append(message["ReceiptHandle"])
+                        continue
+                    if not matches(chunk_key, sent, options):
+                        skipped.append(message["ReceiptHandle"])
+                    elif chunk_key in candidates:
+                        candidates[chunk_key]["receipts"].append(
+                            message["ReceiptHandle"]
+                        )
+                    elif (
+                        options["max_messages"]
+                        and len(candidates) >= options["max_messages"]
+                    ):
+                        skipped.append(message["ReceiptHandle"])
+                    else:
+                        candidates[chunk_key] = {
+                            "chunk_key": chunk_key,
+                            "body": message["Body"],
+                            "receipts": [message["ReceiptHandle"]],
+                        }
+
+    with ThreadPoolExecutor(max_workers=options["workers"]) as executor:
+        for future in [executor.submit(reader) for _ in range(options["workers"])]:
+            future.result()
+    return list(candidates.values()), skipped
+
+
+def read_error_chunks(bucket_name, options):
+    """
+    Function to find failed chunks in S3: ledger error markers and, for
+    chunks moved in prefix mode, objects under error/. Markers not flagged
+    terminal may belong to chunks still being retried from the billing
+    queue and are left alone.
+    """
+    s3 = boto3.client("s3")
+    candidates = {}
+
+    for batch in list_chunks_in_state(bucket_name, ERROR, options["file_name"] or ""):
+        for item in batch:
+            if not matches(item["chunk_key"], item["updated_at"], options):
+                continue
+            marker = get_document(
+                s3, bucket_name, state_marker_key(ERROR, item["chunk_key"])
+            )
+            if not (marker or {}).get("terminal"):
+                logger.info(
+                    f"{item['chunk_key']} may still be retrying, not replaying it"
+                )
+                continue
+            candidates[item["chunk_key"]] = {
+                "chunk_key": item["chunk_key"],
+                "body": marker.get("body") or item["chunk_key"],
+                "mode": LEDGER_MODE,
+            }
+
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(
+        Bucket=bucket_name, Prefix=f"{ERROR}/{options['file_name'] or ''}"
+    ):
+        for item in page.get("Contents", []):
+            chunk_key = "queue/" + item["Key"].split("/")[-1]
+            if chunk_key in candidates or not matches(
+                chunk_key, item.get("LastModified"), options
+            ):
+                continue
+            candidates[chunk_key] = {
+                "chunk_key": chunk_key,
+                "body": chunk_key,
+                "mode": PREFIX_MODE,
+                "error_key": item["Key"],
+            }
+
+    candidates = list(candidates.values())
+    if options["max_messages"]:
+        candidates = candidates[: options["max_messages"]]
+    return candidates
+
+
+def reinject(sqs, queue_url, candidates, options, dlq_url=None, bucket_name=None):
+    """
+    Function to send the candidates back to the billing queue in batches of
+    10 with parallel workers, no faster than options["rate"] per second.
+    Sent DLQ messages (every copy) are deleted; replayed error chunks are
+    put back in queue/ and marked queued. A ledger error chunk is checked
+    again just before it is sent and skipped when it is no longer in error,
+    e.g. delivered by a late retry. Returns (number sent, chunk keys whose
+    DLQ copies could not all be deleted and will be delivered again, chunk
+    keys skipped as no longer failed).
+    """
+    rate_limiter = RateLimiter(options["rate"])
+    batches = [
+        candidates[start : start + SQS_BATCH_SIZE]
+        for start in range(0, len(candidates), SQS_BATCH_SIZE)
+    ]
+    s3 = boto3.client("s3") if bucket_name else None
+
+    def send(batch):
+        not_failed = [
+            candidate["chunk_key"]
+            for candidate in batch
+            if candidate.get("mode") == LEDGER_MODE
+            and get_chunk_state(bucket_name, candidate["chunk_key"]) != ERROR
+        ]
+        for chunk_key in not_failed:
+            logger.info(f"{chunk_key} is no longer in error, not replaying it")
+        batch = [c for c in batch if c["chunk_key"] not in not_failed]
+        if not batch:
+            return 0, [], not_failed
+        for candidate in batch:
+            if candidate.get("mode") == PREFIX_MODE:
+                move_chunk(s3, bucket_name, candidate["error_key"], "queue")
+        rate_limiter.acquire(len(batch))
+        response = sqs.send_message_batch(
+            QueueUrl=queue_url,
+            Entries=[
+                {"Id": str(position), "MessageBody": candidate["body"]}
+                for position, candidate in enumerate(batch)
+            ],
+        )
+        for failure in response.get("Failed", []):
+            logger.error(
+                f"Could not re-send {batch[int(failure['Id'])]['chunk_key']}: {failure.get('Message')}"
+            )
+        sent = [batch[int(success["Id"])] for success in response.get("Successful", [])]
+
+        receipts = {
+            receipt: candidate["chunk_key"]
+            for candidate in sent
+            for receipt in candidate.get("receipts", [])
+        }
+        not_deleted = delete_messages(sqs, dlq_url, list(receipts))
+        for candidate in sent:
+            if candidate.get("mode") == LEDGER_MODE:
+                record_chunk_state(bucket_name, candidate["chunk_key"], QUEUED)
+        return (
+            len(sent),
+            sorted({receipts[receipt] for receipt in not_deleted}),
+            not_failed,
+        )
+
+    with ThreadPoolExecutor(max_workers=options["workers"]) as executor:
+        results = list(executor.map(send, batches))
+    return (
+        sum(count for count, _, _ in results),
+        [chunk_key for _, chunk_keys, _ in results for chunk_key in chunk_keys],
+        [chunk_key for _, _, chunk_keys in results for chunk_key in chunk_keys],
+    )
+
+
+def delete_messages(sqs, dlq_url, receipts, attempts=2):
+    """
+    Function to delete DLQ messages in batches of 10, retrying entries that
+    failed through no fault of the request. Returns the receipt handles that
+    could not be deleted.
+    """
+    for _ in range(attempts):
+        failed = []
+        for start in range(0, len(receipts), SQS_BATCH_SIZE):
+            batch = receipts[start : start + SQS_BATCH_SIZE]
+            response = sqs.delete_message_batch(
+                QueueUrl=dlq_url,
+                Entries=[
+                    {"Id": str(position), "ReceiptHandle": receipt}
+                    for position, receipt in enumerate(batch)
+                ],
+            )
+            for failure in response.get("Failed", []):
+                logger.error(
+                    f"Could not delete a DLQ message: {failure.get('Message')}"
+                )
+                failed.append((batch[int(failure["Id"])], failure.get("SenderFault")))
+        receipts = [receipt for receipt, sender_fault in failed if not sender_fault]
+        if not receipts:
+            break
+    return [receipt for receipt, _ in failed]
+
+
+def release_messages(sqs, dlq_url, receipts):
+    """
+    Function to make skipped DLQ messages visible again straight away
+    """
+    for start in range(0, len(receipts), SQS_BATCH_SIZE):
+        sqs.change_message_visibility_batch(
+            QueueUrl=dlq_url,
+            Entries=[
+                {"Id": str(position), "ReceiptHandle": receipt, "VisibilityTimeout": 0}
+                for position, receipt in enumerate(
+                    receipts[start : start + SQS_BATCH_SIZE]
+                )
+            ],
+        )
+
+
+def redrive(options):
+    """
+    Function to replay failed chunks from the DLQ or from S3.
+    Returns a summary of what was found and sent.
+    """
+    sqs = boto3.client("sqs")
+    start_time = time.perf_counter()
+    summary = {"source": options["source"], "dry_run": options["dry_run"]}
+
+    if options["source"] == "dlq":
+        candidates, skipped = read_dlq(sqs, options["dlq_url"], options)
+        summary["duplicates"] = sum(len(c["receipts"]) - 1 for c in candidates)
+        summary["skipped"] = len(skipped)
+        if options["bucket_name"]:
+            # e.g. the DLQ copy of a chunk already replayed whose delete failed
+            delivered = [
+                c
+                for c in candidates
+                if get_chunk_state(options["bucket_name"], c["chunk_key"]) == DELIVERED
+            ]
+            delivered_receipts = [r for c in delivered for r in c["receipts"]]
+            if options["dry_run"]:
+                skipped += delivered_receipts
+            elif delivered_receipts:
+                delete_messages(sqs, options["dlq_url"], delivered_receipts)
+            delivered_keys = {c["chunk_key"] for c in delivered}
+            candidates = [c for c in candidates if c["chunk_key"] not in delivered_keys]
+            summary["already_delivered"] = len(delivered)
+    else:
+        candidates, skipped = read_error_chunks(options["bucket_name"], options), []
+    summary["chunks"] = len(candidates)
+
+    if options["dry_run"]:
+        summary["chunk_keys"] = [candidate["chunk_key"] for candidate in candidates]
+        summary["sent"] = 0
+        skipped += [receipt for c in candidates for receipt in c.get("receipts", [])]
+    else:
+        summary["sent"], delete_failed, not_failed = reinject(
+            sqs,
+            options["queue_url"],
+            candidates,
+            options,
+            dlq_url=options["dlq_url"],
+            bucket_name=options["bucket_name"],
+        )
+        if not_failed:
+            summary["no_longer_failed"] = len(not_failed)
+        if delete_failed:
+            # Already re-sent; their DLQ copies will come back and must not
+            # be replayed a second time
+            logger.error(f"DLQ copies of {delete_failed} could not be deleted")
+            summary["delete_failed"] = delete_failed
+    if skipped:
+        release_messages(sqs, options["dlq_url"], skipped)
+
+    summary["seconds"] = round(time.perf_counter() - start_time, 1)
+    logger.info(f"Redrive finished: {summary}")
+    return summary
+
+
+def build_options(values):
+    """
+    Function to fill in redrive options from the environment
+    """
+    source = values.get("source") or "dlq"
+    if source not in ("dlq", "error"):
+        raise ValueError(f"Unknown redrive source: {source}")
+    return {
+        "source": source,
+        "file_name": values.get("file_name"),
+        "since": parse_time(values.get("since")),
+        "until": parse_time(values.get("until")),
+        "rate": float(
+            values["rate"]
+            if values.get("rate") is not None
+            else os.environ.get("REDRIVE_RATE", "10")
+        ),
+        "workers": int(values.get("workers") or os.environ.get("REDRIVE_WORKERS", "4")),
+        "max_messages": int(values.get("max_messages") or 0),
+        "dry_run": bool(values.get("dry_run")),
+        "queue_url": values.get("queue_url") or os.environ.get("BILLING_QUEUE_URL"),
+        "dlq_url": values.get("dlq_url") or os.environ.get("BILLING_DLQ_URL"),
+        "bucket_name": values.get("bucket_name") or os.environ.get("BILLING_BUCKET"),
+    }
+
+
+def lambda_handler(event, context):
+    logger.info("Billing Redrive")
+    logger.info(event)
+    summary = redrive(build_options(event or {}))
+    # Keep a dry run's response well under the Lambda payload limit
+    summary["chunk_keys"] = summary.get("chunk_keys", [])[:1000]
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay failed billing chunks")
+    parser.add_argument("--source", choices=("dlq", "error"), default="dlq")
+    parser.add_argument(
+        "--file", dest="file_name", help="only chunks of this Landmark file"
+    )
+    parser.add_argument("--since", help="ISO date/time, inclusive")
+    parser.add_argument("--until", help="ISO date/time, exclusive")
+    parser.add_argument(
+        "--rate", type=float, help="messages per second, 0 for no limit"
+    )
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--max-messages", dest="max_messages", type=int)
+    parser.add_argument("--dry-run", dest="dry_run", action="store_true")
+    parser.add_argument("--queue-url", dest="queue_url")
+    parser.add_argument("--dlq-url", dest="dlq_url")
+    parser.add_argument("--bucket", dest="bucket_name")
+    logging.basicConfig()
+    summary = redrive(build_options(vars(parser.parse_args(argv))))
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -8,6 +8,10 @@ from botocore.exceptions import ClientError
 logger = logging.getLogger("Billing Queue Consumer")
 logger.setLevel(logging.INFO)
 
+# Stay inside the Lambda timeout so a hung TechOne call is reported as a
+# timeout instead of killing the function
+REQUEST_TIMEOUT_SECONDS = int(os.environ.get("TECHONE_REQUEST_TIMEOUT_SECONDS", "240"))
+
 
 # Get Landmark SFTP details from Secret Manager
 def get_techone_secret():
@@ -75,32 +79,43 @@ def lambda_handler(event, context):
     content = content.strip()
     logger.info(content)
 
-    token_response = requests.post(access_token_url, data=auth_payload)
-    if token_response.status_code == 200:
-        token = token_response.json()
-        access_token = token["access_token"]
-
-        techone_response = requests.post(
-            soap_url,
-            headers={
-                "Accept": "text/xml",
-                "Content-Type": "text/xml",
-                "Authorization": access_token,
-                "SOAPAction": billing_soap_action_url,
-            },
-            data=content,
+    try:
+        token_response = requests.post(
+            access_token_url, data=auth_payload, timeout=REQUEST_TIMEOUT_SECONDS
         )
-        logger.info(techone_response)
-        techone_response_text = techone_response.text
-        logger.info(techone_response_text)
-        logger.info(techone_response.content)
-        logger.info(type(techone_response))
-
-    else:
-        logger.error("Error in C1 Token Generation")
-        logger.error(token_response.status_code)
-        techone_response_text = "Error in Fetching Token"
+        if token_response.status_code == 200:
+            token = token_response.json()
+            access_token = token["access_token"]
+
+            techone_response = requests.post(
+                soap_url,
+                headers={
+                    "Accept": "text/xml",
+                    "Content-Type": "text/xml",
+                    "Authorization": access_token,
+                    "SOAPAction": billing_soap_action_url,
+                },
+                data=content,
+                timeout=REQUEST_TIMEOUT_SECONDS,
+            )
+            logger.info(techone_response)
+            status_code = techone_response.status_code
+            techone_response_text = techone_response.text
+            logger.info(techone_response_text)
+            logger.info(techone_response.content)
+            logger.info(type(techone_response))
+
+        else:
+            logger.error("Error in C1 Token Generation")
+            logger.error(token_response.status_code)
+            status_code = token_response.status_code
+            techone_response_text = "Error in Fetching Token"
+    except requests.Timeout:
+        logger.error(f"TechOne did not answer within {REQUEST_TIMEOUT_SECONDS}s")
+        status_code = 504
+        techone_response_text = "Timed out calling TechOne"
 
     logger.info("Existing lambda_handler")
 
-    return techone_response_text
+    # The status lets the consumer tell throttling and outages from bad data
+    return {"status_code": status_code, "body": techone_response_text}
@@ -0,0 +1,10 @@
+import os
+import sys
+
+sys.path.append(
+    os.path.join(
+        os.path.abspath(os.path.dirname(os.path.dirname(__file__))),
+        "functions",
+        "billing_common",
+    )
+)  # shared layer, on the path of the Lambda runtime via /opt/python
@@ -0,0 +1,650 @@
+"""
+Offline end-to-end load test of the billing pipeline.
+
+Runs the real processor, consumer and TechOne adaptor handlers against an
+in-process SFTP server (Landmark and GoAnywhere), moto-backed S3, SQS, SSM,
+Secrets Manager and SNS, and a local TechOne HTTP stub with configurable
+latency and faults. Lambda invokes are routed to the handlers in-process and
+consumer workers poll the moto queue the way the SQS event source would.
+
+    python -m tests.harness.load_test --files 4 --rows 20000 --consumers 8 \
+        --latency 0.2 --throttle-rate 0.05
+"""
+
+import argparse
+import contextlib
+import csv
+import importlib
+import io
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from unittest import mock
+
+import boto3
+import paramiko
+from moto import mock_aws
+
+ROOT = os.path.abspath(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+sys.path.append(ROOT)  # project root folder
+sys.path.append(
+    os.path.join(ROOT, "functions", "billing_common")
+)  # shared layer, on the path of the Lambda runtime via /opt/python
+sys.path.append(
+    os.path.join(ROOT, "functions", "billing_file_processor")
+)  # the processor imports its modules flat
+
+from billing_encoding import ENCODING_SAMPLE_SIZE, detect_encoding
+from billing_state import STATES, list_chunks_in_state
+from tests.harness.sftp_server import LocalSFTPService
+from tests.harness.techone_stub import TechOneStub
+
+logger = logging.getLogger("Billing Harness")
+logger.setLevel(logging.INFO)
+
+REGION = "ap-southeast-2"
+BUCKET = "billing-harness"
+FIXTURE = os.path.join(ROOT, "tests", "FINANCE_20240510113633.csv")
+LANDMARK_DIR = "landmark"
+GA_DIR = "goanywhere"
+ADAPTOR_FUNCTION = "techone-adaptor"
+PROCESSOR_FUNCTION = "billing-file-processor"
+ROWS_PER_INVOICE = 10
+
+
+def synthetic_file(template_path, file_index, row_count):
+    """
+    Function to build a Landmark file of row_count rows by cycling the
+    template's rows. Invoice numbers are rewritten per file so every file
+    has distinct content (and control totals).
+    Returns the file as bytes, in the template's encoding.
+    """
+    with open(template_path, "rb") as template_file:
+        raw_data = template_file.read()
+    encoding = detect_encoding(raw_data[:ENCODING_SAMPLE_SIZE])
+    template_rows = list(csv.reader(io.StringIO(raw_data.decode(encoding), newline="")))
+    header, data_rows = template_rows[0], template_rows[1:]
+    invoice_position = header.index("Invoice Number")
+    line_position = header.index("Line Number")
+
+    output = io.StringIO()
+    writer = csv.writer(output, lineterminator="\r\n")
+    writer.writerow(header)
+    for index in range(row_count):
+        row = list(data_rows[index % len(data_rows)])
+        row[invoice_position] = str(
+            (file_index + 1) * 10**7 + index // ROWS_PER_INVOICE
+        )
+        row[line_position] = str(index % ROWS_PER_INVOICE + 1)
+        writer.writerow(row)
+    return output.getvalue().encode(encoding)
+
+
+class LocalLambda:
+    """
+    Stand-in for the Lambda client. RequestResponse invokes run the handler
+    in the calling thread; Event invokes run it in a background thread.
+    """
+
+    def __init__(self, handlers):
+        self.handlers = handlers
+        self.threads = []
+        self.errors = []
+        self.lock = threading.Lock()
+
+    def run_async(self, handler, event):
+        try:
+            handler(event, None)
+        except Exception as e:
+            logger.error(f"Async invoke failed: {e}")
+            with self.lock:
+                self.errors.append(str(e))
+
+    def invoke(self, FunctionName, Payload, InvocationType="RequestResponse", **kwargs):
+        handler = self.handlers[FunctionName]
+        event = json.loads(Payload)
+        if InvocationType == "Event":
+            thread = threading.Thread(target=self.run_async, args=(handler, event))
+            with self.lock:
+                self.threads.append(thread)
+            thread.start()
+            return {"StatusCode": 202, "ResponseMetadata": {"HTTPStatusCode": 202}}
+
+        response = {"StatusCode": 200, "ResponseMetadata": {"HTTPStatusCode": 200}}
+        try:
+            result = handler(event, None)
+        except Exception as e:
+            response["FunctionError"] = "Unhandled"
+            result = {"errorMessage": str(e), "errorType": type(e).__name__}
+        response["Payload"] = io.BytesIO(json.dumps(result).encode("utf-8"))
+        return response
+
+    def join(self):
+        with self.lock:
+            threads = list(self.threads)
+        for thread in threads:
+            thread.join()
+
+
+def patched_boto3_client(local_lambda):
+    """
+    Function to route Lambda clients to local_lambda and serialise client
+    creation, which is not thread-safe on the default session
+    """
+    real_client = boto3.client
+    lock = threading.Lock()
+
+    def client(service_name, *args, **kwargs):
+        if service_name == "lambda":
+            return local_lambda
+        with lock:
+            return real_client(service_name, *args, **kwargs)
+
+    return mock.patch("boto3.client", client)
+
+
+def load_module(name):
+    """
+    Function to import a handler module fresh, so it reads the current
+    environment and creates its clients inside the moto mock
+    """
+    if name in sys.modules:
+        return importlib.reload(sys.modules[name])
+    return importlib.import_module(name)
+
+
+def create_resources(sftp_port, stub_url, options):
+    """
+    Function to create the bucket, queues, topic, parameters and secrets.
+    Returns the queue URLs and the topic ARN.
+    """
+    s3 = boto3.client("s3")
+    s3.create_bucket(
+        Bucket=BUCKET, CreateBucketConfiguration={"LocationConstraint": REGION}
+    )
+
+    sqs = boto3.client("sqs")
+    dlq_url = sqs.create_queue(QueueName="billing-harness-dlq")["QueueUrl"]
+    dlq_arn = sqs.get_queue_attributes(QueueUrl=dlq_url, AttributeNames=["QueueArn"])[
+        "Attributes"
+    ]["QueueArn"]
+    queue_url = sqs.create_queue(
+        QueueName="billing-harness",
+        Attributes={
+            "VisibilityTimeout": str(options["visibility_timeout"]),
+            "RedrivePolicy": json.dumps(
+                {
+                    "deadLetterTargetArn": dlq_arn,
+                    "maxReceiveCount": options["max_receives"],
+                }
+            ),
+        },
+    )["QueueUrl"]
+    queue_arn = sqs.get_queue_attributes(
+        QueueUrl=queue_url, AttributeNames=["QueueArn"]
+    )["Attributes"]["QueueArn"]
+    topic_arn = boto3.client("sns").create_topic(Name="billing-harness-complete")[
+        "TopicArn"
+    ]
+
+    ssm = boto3.client("ssm")
+    for name, value in (
+        ("/harness/lmk_ftppath", f"/{LANDMARK_DIR}"),
+        ("/harness/ga_ftp_path", f"/{GA_DIR}"),
+        ("/harness/allowed_schedule_range", "1-31"),
+        ("/harness/accesstokenurl", f"{stub_url}/token"),
+        ("/harness/billing_soap_action_url", "urn:ImportWarehouseData"),
+    ):
+        ssm.put_parameter(Name=name, Value=value, Type="String")
+
+    key_file = io.StringIO()
+    paramiko.RSAKey.generate(2048).write_private_key(key_file)
+    sftp_secret = {
+        "ftp_url": "127.0.0.1",
+        "port": sftp_port,
+        "user_id": "harness",
+        "password": "harness",
+        "key_value": key_file.getvalue(),
+    }
+    secrets = boto3.client("secretsmanager")
+    for name, secret in (
+        ("harness/lmk_ftp", sftp_secret),
+        ("harness/lmk_ftp_delete", sftp_secret),
+        ("harness/ga_ftp", sftp_secret),
+        (
+            "harness/tech1/soap",
+            {
+                "UserId": "harness",
+                "Password": "harness",
+                "WSDL": f"{stub_url}/soap",
+                "Config": "HARNESS",
+            },
+        ),
+        (
+            "harness/techone_account_key",
+            {"client_id": "harness", "client_secret": "harness"},
+        ),
+    ):
+        secrets.create_secret(Name=name, SecretString=json.dumps(secret))
+
+    return queue_url, queue_arn, dlq_url, topic_arn
+
+
+def harness_environment(queue_url, topic_arn, options):
+    """
+    Function to build the environment of all three functions, as in the
+    template but with the delays that only matter against real servers off
+    """
+    return {
+        "AWS_DEFAULT_REGION": REGION,
+        # Processor
+        "LANDMARK_SFTP_PATH": "/harness/lmk_ftppath",
+        "ALLOWED_SCHEDULE_RANGE": "/harness/allowed_schedule_range",
+        "SEIL_S3_BUCKET": BUCKET,
+        "LANDMARK_SFTP_SECRET_NAME": "harness/lmk_ftp",
+        "LANDMARK_SFTP_SECRET_NAME_DELETE": "harness/lmk_ftp_delete",
+        "GA_SFTP_SECRET_NAME": "harness/ga_ftp",
+        "GA_FTP_PATH": "/harness/ga_ftp_path",
+        "GA_PUSH_DELAY_SECONDS": "0",
+        "SQS_QUEUE_URL": queue_url,
+        "SFTP_SCAN_POLL_SECONDS": "0",
+        "CHUNK_FORMAT": options["chunk_format"],
+        "SFTP_WINDOW_SIZE_MB": "32",
+        "SFTP_MAX_PACKET_SIZE_KB": "32",
+        "COMPLETION_TRACKING": "true",
+        "CONTROL_TOTALS": "true",
+        # Consumer
+        "BILLING_BUCKET": BUCKET,
+        "TECHONE_SOAP_SECRET_NAME": "harness/tech1/soap",
+        "TECHONE_ADAPTOR_FUNCTION": ADAPTOR_FUNCTION,
+        "FILE_FINALISE_FUNCTION": PROCESSOR_FUNCTION,
+        "FILE_COMPLETE_TOPIC_ARN": topic_arn,
+        "LIMITER_BACKEND": "local",
+        "LIMITER_MAX_CONCURRENCY": str(options["consumers"]),
+        "LIMITER_INITIAL_CONCURRENCY": str(min(2, options["consumers"])),
+        "LIMITER_TARGET_LATENCY_SECONDS": str(options["target_latency"]),
+        "LIMITER_OPEN_SECONDS": str(options["open_seconds"]),
+        "LIMITER_RETRY_SECONDS": "1",
+        "STATE_TRACKING": "ledger",
+        # Adaptor
+        "TECHONE_SECRET_NAME": "harness/techone_account_key",
+        "TECHONE_API_ACCESS_TOKEN_URL": "/harness/accesstokenurl",
+        "TECHONE_BILLING_SOAP_ACTION_URL": "/harness/billing_soap_action_url",
+        "TECHONE_REQUEST_TIMEOUT_SECONDS": str(options["request_timeout"]),
+    }
+
+
+class ConsumerPool:
+    """
+    Polls the queue from worker threads and calls the consumer handler with
+    SQS event records. Messages the handler does not report as failed are
+    deleted. Failed ones come back after retry_delay seconds rather than the
+    queue's full visibility timeout, to keep runs short, and reach the DLQ
+    after max_receives attempts.
+    """
+
+    def __init__(self, handler, queue_url, queue_arn, workers, batch_size, retry_delay):
+        self.handler = handler
+        self.queue_url = queue_url
+        self.queue_arn = queue_arn
+        self.workers = workers
+        self.batch_size = batch_size
+        self.retry_delay = retry_delay
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+        self.stats = {
+            "invocations": 0,
+            "messages": 0,
+            "imported": 0,
+            "handed_back": 0,
+            "errors": 0,
+        }
+
+    def count(self, **increments):
+        with self.lock:
+            for key, value in increments.items():
+                self.stats[key] += value
+
+    def poll(self):
+        sqs = boto3.client("sqs")
+        while not self.stopped.is_set():
+            messages = sqs.receive_message(
+                QueueUrl=self.queue_url,
+                MaxNumberOfMessages=self.batch_size,
+                AttributeNames=["ApproximateReceiveCount"],
+            ).get("Messages", [])
+            if not messages:
+                time.sleep(0.05)
+                continue
+            records = [
+                {
+                    "messageId": message["MessageId"],
+                    "receiptHandle": message["ReceiptHandle"],
+                    "body": message["Body"],
+                    "attributes": message.get("Attributes", {}),
+                    "eventSource": "aws:sqs",
+                    "eventSourceARN": self.queue_arn,
+                }
+                for message in messages
+            ]
+            try:
+                result = self.handler({"Records": records}, None)
+                failed = {
+                    item["itemIdentifier"] for item in result["batchItemFailures"]
+                }
+            except Exception as e:
+                logger.error(f"Consumer invocation failed: {e}")
+                self.count(errors=1)
+                failed = {record["messageId"] for record in records}
+
+            for message in messages:
+                if message["MessageId"] not in failed:
+                    sqs.delete_message(
+                        QueueUrl=self.queue_url, ReceiptHandle=message["ReceiptHandle"]
+                    )
+                else:
+                    sqs.change_message_visibility(
+                        QueueUrl=self.queue_url,
+                        ReceiptHandle=message["ReceiptHandle"],
+                        VisibilityTimeout=self.retry_delay,
+                    )
+            self.count(
+                invocations=1,
+                messages=len(messages),
+                imported=len(messages) - len(failed),
+                handed_back=len(failed),
+            )
+
+    def __enter__(self):
+        self.threads = [threading.Thread(target=self.poll) for _ in range(self.workers)]
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stopped.set()
+        for thread in self.threads:
+            thread.join()
+
+
+def queue_depth(queue_url):
+    attributes = boto3.client("sqs").get_queue_attributes(
+        QueueUrl=queue_url,
+        AttributeNames=[
+            "ApproximateNumberOfMessages",
+            "ApproximateNumberOfMessagesNotVisible",
+        ],
+    )["Attributes"]
+    return int(attributes["ApproximateNumberOfMessages"]) + int(
+        attributes["ApproximateNumberOfMessagesNotVisible"]
+    )
+
+
+def count_chunks_by_state():
+    return {
+        state: sum(len(batch) for batch in list_chunks_in_state(BUCKET, state))
+        for state in STATES
+    }
+
+
+def collect_summaries():
+    s3 = boto3.client("s3")
+    summaries = []
+    for page in s3.get_paginator("list_objects_v2").paginate(
+        Bucket=BUCKET, Prefix="summary/"
+    ):
+        for item in page.get("Contents", []):
+            summaries.append(
+                json.loads(s3.get_object(Bucket=BUCKET, Key=item["Key"])["Body"].read())
+            )
+    return summaries
+
+
+DEFAULT_OPTIONS = {
+    "files": 2,
+    "rows": 10000,
+    "consumers": 4,
+    "batch_size": 1,
+    "rows_per_chunk": 4999,
+    "chunk_format": "csv",
+    "request_timeout": 10,
+    "target_latency": 30,
+    "open_seconds": 2,
+    "visibility_timeout": 120,
+    "retry_delay": 1,
+    "max_receives": 5,
+    "timeout": 600,
+    "template": FIXTURE,
+    "techone": {},
+}
+
+
+def run_load_test(**overrides):
+    """
+    Function to run one load test. Options are DEFAULT_OPTIONS; "techone"
+    takes TechOneStub arguments (latency, throttle_rate, outage_seconds...).
+    Returns the metrics.
+    """
+    options = {**DEFAULT_OPTIONS, **overrides}
+    with tempfile.TemporaryDirectory() as sftp_root, LocalSFTPService(
+        sftp_root
+    ) as sftp_service, TechOneStub(**options["techone"]) as stub, mock_aws():
+        os.mkdir(os.path.join(sftp_root, LANDMARK_DIR))
+        os.mkdir(os.path.join(sftp_root, GA_DIR))
+        total_bytes = 0
+        for file_index in range(options["files"]):
+            data = synthetic_file(options["template"], file_index, options["rows"])
+            total_bytes += len(data)
+            file_name = f"FINANCE_20240510{file_index:06d}.csv"
+            with open(
+                os.path.join(sftp_root, LANDMARK_DIR, file_name), "wb"
+            ) as landmark_file:
+                landmark_file.write(data)
+
+        with mock.patch.dict(os.environ, {"AWS_DEFAULT_REGION": REGION}):
+            queue_url, queue_arn, dlq_url, topic_arn = create_resources(
+                sftp_service.port, stub.url, options
+            )
+        local_lambda = LocalLambda({})
+        with mock.patch.dict(
+            os.environ, harness_environment(queue_url, topic_arn, options)
+        ), patched_boto3_client(local_lambda):
+            processor = load_module("app")
+            processor.ROWS_PER_CHUNK = options["rows_per_chunk"]
+            consumer = load_module(
+                "functions.billing_queue_consumer.c1_billing_queue_consumer"
+            )
+            adaptor = load_module("functions.techone_adaptor.c1_techone_soap_adaptor")
+            local_lambda.handlers.update(
+                {
+                    ADAPTOR_FUNCTION: adaptor.lambda_handler,
+                    PROCESSOR_FUNCTION: processor.lambda_handler,
+                }
+            )
+
+            start_time = time.perf_counter()
+            deadline = time.monotonic() + options["timeout"]
+            with ConsumerPool(
+                consumer.lambda_handler,
+                queue_url,
+                queue_arn,
+                options["consumers"],
+                options["batch_size"],
+                options["retry_delay"],
+            ) as pool:
+                processor.lambda_handler({}, None)
+                processor_seconds = time.perf_counter() - start_time
+                while queue_depth(queue_url) and time.monotonic() < deadline:
+                    time.sleep(0.2)
+                left_on_queue = queue_depth(queue_url)
+            local_lambda.join()
+            seconds = time.perf_counter() - start_time
+
+            summaries = collect_summaries()
+            chunks_by_state = count_chunks_by_state()
+            dead_letters = queue_depth(dlq_url)
+
+        rows_imported = stub.stats["rows_imported"]
+        return {
+            "files": options["files"],
+            "rows": options["files"] * options["rows"],
+            "bytes": total_bytes,
+            "chunks": options["files"]
+            * -(-(options["rows"] + 1) // options["rows_per_chunk"]),
+            "seconds": round(seconds, 2),
+            "processor_seconds": round(processor_seconds, 2),
+            "processor_mb_per_s": round(
+                total_bytes / (1024 * 1024) / max(processor_seconds, 0.001), 2
+            ),
+            "consumer": dict(pool.stats),
+            "chunks_per_s": round(pool.stats["imported"] / max(seconds, 0.001), 2),
+            "rows_per_s": round(rows_imported / max(seconds, 0.001), 1),
+            "dead_letters": dead_letters,
+            "left_on_queue": left_on_queue,
+            "chunks_by_state": chunks_by_state,
+            "finalised_files": len(summaries),
+            "reconciled_files": sum(
+                1
+                for summary in summaries
+                if summary.get("reconciliation", {}).get("matched")
+            ),
+            "files_left_on_landmark": len(
+                os.listdir(os.path.join(sftp_root, LANDMARK_DIR))
+            ),
+            "files_on_goanywhere": len(os.listdir(os.path.join(sftp_root, GA_DIR))),
+            "finalise_errors": len(local_lambda.errors),
+            "techone": {
+                **{
+                    key: value
+                    for key, value in stub.stats.items()
+                    if key != "in_flight"
+                },
+                "status": {
+                    str(code): count
+                    for code, count in sorted(stub.stats["status"].items())
+                },
+            },
+        }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Offline end-to-end load test of the billing pipeline"
+    )
+    parser.add_argument("--files", type=int, default=DEFAULT_OPTIONS["files"])
+    parser.add_argument(
+        "--rows", type=int, default=DEFAULT_OPTIONS["rows"], help="data rows per file"
+    )
+    parser.add_argument(
+        "--consumers",
+        type=int,
+        default=DEFAULT_OPTIONS["consumers"],
+        help="concurrent consumer invocations",
+    )
+    parser.add_argument(
+        "--batch-size",
+        dest="batch_size",
+        type=int,
+        default=DEFAULT_OPTIONS["batch_size"],
+    )
+    parser.add_argument(
+        "--rows-per-chunk",
+        dest="rows_per_chunk",
+        type=int,
+        default=DEFAULT_OPTIONS["rows_per_chunk"],
+    )
+    parser.add_argument(
+        "--chunk-format",
+        dest="chunk_format",
+        default="csv",
+        choices=("csv", "techone-rows", "byte-range"),
+    )
+    parser.add_argument(
+        "--request-timeout",
+        dest="request_timeout",
+        type=int,
+        default=DEFAULT_OPTIONS["request_timeout"],
+    )
+    parser.add_argument(
+        "--max-receives",
+        dest="max_receives",
+        type=int,
+        default=DEFAULT_OPTIONS["max_receives"],
+    )
+    parser.add_argument(
+        "--timeout",
+        type=int,
+        default=DEFAULT_OPTIONS["timeout"],
+        help="give up after this many seconds",
+    )
+    parser.add_argument(
+        "--template", default=FIXTURE, help="Landmark file whose rows are cycled"
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="TechOne seconds per import"
+    )
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument(
+        "--throttle-rate",
+        dest="throttle_rate",
+        type=float,
+        default=0.0,
+        help="share of imports answered 429",
+    )
+    parser.add_argument(
+        "--error-rate",
+        dest="error_rate",
+        type=float,
+        default=0.0,
+        help="share of imports answered 500",
+    )
+    parser.add_argument(
+        "--hang-rate",
+        dest="hang_rate",
+        type=float,
+        default=0.0,
+        help="share of imports that hang",
+    )
+    parser.add_argument("--hang-seconds", dest="hang_seconds", type=float, default=15.0)
+    parser.add_argument(
+        "--outage-seconds",
+        dest="outage_seconds",
+        type=float,
+        default=0.0,
+        help="answer 503 for the first N seconds",
+    )
+    parser.add_argument("--seed", type=int)
+    parser.add_argument(
+        "--verbose", action="store_true", help="show the functions' INFO logs"
+    )
+    args = vars(parser.parse_args(argv))
+
+    logging.basicConfig(format="%(asctime)s %(name)s %(message)s")
+    if not args.pop("verbose"):
+        # The functions log every record and payload at INFO
+        logging.disable(logging.INFO)
+    techone = {
+        key: args.pop(key)
+        for key in (
+            "latency",
+            "jitter",
+            "throttle_rate",
+            "error_rate",
+            "hang_rate",
+            "hang_seconds",
+            "outage_seconds",
+            "seed",
+        )
+    }
+    # Keep stdout for the metrics, the consumer prints its envelopes
+    with contextlib.redirect_stdout(sys.stderr):
+        metrics = run_load_test(techone=techone, **args)
+    print(json.dumps(metrics, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+"""
+In-process SFTP server backed by a local directory, standing in for the
+Landmark and GoAnywhere servers. Any user, password or key is accepted.
+"""
+
+import os
+import socket
+import threading
+
+import paramiko
+from paramiko import SFTPAttributes, SFTPHandle, SFTPServer, SFTPServerInterface
+from paramiko.sftp import SFTP_FAILURE, SFTP_NO_SUCH_FILE, SFTP_OK
+
+
+def to_sftp_error(error):
+    return SFTPServer.convert_errno(error.errno)
+
+
+class AcceptAllServer(paramiko.ServerInterface):
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return "password,publickey"
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+
+class LocalHandle(SFTPHandle):
+    def stat(self):
+        try:
+            return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as e:
+            return to_sftp_error(e)
+
+
+class LocalSFTPServer(SFTPServerInterface):
+    """
+    Serves the directory given as root; absolute SFTP paths are resolved
+    inside it
+    """
+
+    root = None
+
+    def __init__(self, server, *args, **kwargs):
+        super().__init__(server, *args, **kwargs)
+
+    def local_path(self, path):
+        return os.path.join(self.root, self.canonicalize(path).lstrip("/"))
+
+    def canonicalize(self, path):
+        return os.path.normpath("/" + path).replace("\\", "/") if path else "/"
+
+    def list_folder(self, path):
+        local = self.local_path(path)
+        try:
+            attrs = []
+            for name in os.listdir(local):
+                attr = SFTPAttributes.from_stat(os.stat(os.path.join(local, name)))
+                attr.filename = name
+                attrs.append(attr)
+            return attrs
+        except OSError as e:
+            return to_sftp_error(e)
+
+    def stat(self, path):
+        try:
+            return SFTPAttributes.from_stat(os.stat(self.local_path(path)))
+        except OSError as e:
+            return to_sftp_error(e)
+
+    lstat = stat
+
+    def open(self, path, flags, attr):
+        local = self.local_path(path)
+        try:
+            fd = os.open(local, flags | getattr(os, "O_BINARY", 0), 0o644)
+        except OSError as e:
+            return to_sftp_error(e)
+        if flags & os.O_WRONLY:
+            mode = "ab" if flags & os.O_APPEND else "wb"
+        elif flags & os.O_RDWR:
+            mode = "a+b" if flags & os.O_APPEND else "r+b"
+        else:
+            mode = "rb"
+        handle = LocalHandle(flags)
+        file_obj = os.fdopen(fd, mode)
+        handle.filename = local
+        handle.readfile = file_obj
+        handle.writefile = file_obj
+        return handle
+
+    def remove(self, path):
+        try:
+            os.remove(self.local_path(path))
+        except OSError as e:
+            return to_sftp_error(e)
+        return SFTP_OK
+
+    def rename(self, oldpath, newpath):
+        try:
+            os.rename(self.local_path(oldpath), self.local_path(newpath))
+        except OSError as e:
+            return to_sftp_error(e)
+        return SFTP_OK
+
+    def mkdir(self, path, attr):
+        try:
+            os.mkdir(self.local_path(path))
+        except OSError as e:
+            return to_sftp_error(e)
+        return SFTP_OK
+
+    def rmdir(self, path):
+        try:
+            os.rmdir(self.local_path(path))
+        except OSError as e:
+            return to_sftp_error(e)
+        return SFTP_OK
+
+    def chattr(self, path, attr):
+        if not os.path.exists(self.local_path(path)):
+            return SFTP_NO_SUCH_FILE
+        return SFTP_OK
+
+    def symlink(self, target_path, path):
+        return SFTP_FAILURE
+
+
+class LocalSFTPService:
+    """
+    Listens on 127.0.0.1 and serves root over SFTP from background threads.
+    Use as a context manager; port holds the bound port.
+    """
+
+    def __init__(self, root, host_key=None):
+        self.root = root
+        self.host_key = host_key or paramiko.RSAKey.generate(2048)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(("127.0.0.1", 0))
+        self.port = self.socket.getsockname()[1]
+        self.transports = []
+        self.stopped = threading.Event()
+        self.server_class = type("RootedSFTPServer", (LocalSFTPServer,), {"root": root})
+
+    def serve(self):
+        self.socket.listen(16)
+        self.socket.settimeout(0.2)
+        while not self.stopped.is_set():
+            try:
+                connection, _ = self.socket.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            transport = paramiko.Transport(connection)
+            transport.add_server_key(self.host_key)
+            transport.set_subsystem_handler("sftp", SFTPServer, self.server_class)
+            transport.start_server(server=AcceptAllServer())
+            self.transports.append(transport)
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stopped.set()
+        self.thread.join()
+        self.socket.close()
+        for transport in self.transports:
+            transport.close()
@@ -0,0 +1,131 @@
+"""
+Local HTTP stand-in for the TechOne token and SOAP import endpoints, with
+configurable latency and fault injection
+"""
+
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROW_TAG = b"<ns1:Row>"
+
+
+class TechOneStub:
+    """
+    POST /token returns an access token, POST /soap accepts an import.
+    Each import waits latency + uniform(0, jitter) seconds. Then, in order:
+    for outage_seconds from the first import every import gets a 503;
+    otherwise it is throttled (429), failed (500) or hung for hang_seconds
+    with the given probabilities. Rows of imports answered 200 are counted.
+    """
+
+    def __init__(
+        self,
+        latency=0.0,
+        jitter=0.0,
+        throttle_rate=0.0,
+        error_rate=0.0,
+        hang_rate=0.0,
+        hang_seconds=5.0,
+        outage_seconds=0.0,
+        seed=None,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+        self.hang_rate = hang_rate
+        self.hang_seconds = hang_seconds
+        self.outage_seconds = outage_seconds
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {
+            "requests": 0,
+            "status": {},
+            "rows_imported": 0,
+            "in_flight": 0,
+            "max_in_flight": 0,
+        }
+        self.first_import = None
+
+    def choose_status(self):
+        with self.lock:
+            draw = self.random.random()
+        if time.monotonic() - self.first_import < self.outage_seconds:
+            return 503
+        if draw < self.throttle_rate:
+            return 429
+        draw -= self.throttle_rate
+        if draw < self.error_rate:
+            return 500
+        draw -= self.error_rate
+        if draw < self.hang_rate:
+            time.sleep(self.hang_seconds)
+        return 200
+
+    def handle_soap(self, body):
+        with self.lock:
+            self.stats["requests"] += 1
+            if self.first_import is None:
+                self.first_import = time.monotonic()
+            self.stats["in_flight"] += 1
+            self.stats["max_in_flight"] = max(
+                self.stats["max_in_flight"], self.stats["in_flight"]
+            )
+            delay = self.latency + self.random.uniform(0, self.jitter)
+        try:
+            time.sleep(delay)
+            status = self.choose_status()
+            with self.lock:
+                self.stats["status"][status] = self.stats["status"].get(status, 0) + 1
+                if status == 200:
+                    self.stats["rows_imported"] += body.count(ROW_TAG)
+            return status
+        finally:
+            with self.lock:
+                self.stats["in_flight"] -= 1
+
+    def make_handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def reply(self, status, body, content_type):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                if self.path == "/token":
+                    self.reply(
+                        200,
+                        json.dumps({"access_token": "token"}).encode(),
+                        "application/json",
+                    )
+                    return
+                status = stub.handle_soap(body)
+                try:
+                    self.reply(status, b"<ImportResult/>", "text/xml")
+                except (BrokenPipeError, ConnectionResetError):
+                    pass  # the client gave up on a hung request
+
+        return Handler
+
+    def __enter__(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.make_handler())
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
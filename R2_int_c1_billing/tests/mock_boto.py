@@ -3,7 +3,7 @@ import json
 
 
 def mock_client_generator(type_class_dict):
-    return lambda type, region_name="": (
+    return lambda type, region_name="", **kwargs: (
         type_class_dict[type](region_name) if type in type_class_dict else None
     )
 
@@ -16,4 +16,105 @@ def mock_lambda_simple_return(return_value):
         def invoke(self, FunctionName, InvocationType="", Payload=None):
             return {"Payload": io.BytesIO(json.dumps(return_value).encode("utf-8"))}
 
-    return lambda type, region_name="": mock_lambda_client()
+    return lambda type, region_name="", **kwargs: mock_lambda_client()
+
+
+class mock_s3_store:
+    """
+    In-memory S3 stand-in covering the calls the billing functions make on
+    small JSON/state objects: put/get/head/copy/delete, conditional writes,
+    tagging and list_objects_v2 pagination.
+    """
+
+    def __init__(self, region_name=""):
+        self.objects = {}
+        self.tags = {}
+        self.version = 0
+
+    def _error(self, code, operation):
+        from botocore.exceptions import ClientError
+
+        return ClientError({"Error": {"Code": code, "Message": code}}, operation)
+
+    def put_object(
+        self,
+        Bucket,
+        Key,
+        Body=b"",
+        IfNoneMatch=None,
+        IfMatch=None,
+        Tagging=None,
+        **kwargs,
+    ):
+        if IfNoneMatch == "*" and (Bucket, Key) in self.objects:
+            raise self._error("PreconditionFailed", "PutObject")
+        if IfMatch is not None and (
+            (Bucket, Key) not in self.objects
+            or self.objects[(Bucket, Key)]["ETag"] != IfMatch
+        ):
+            raise self._error("PreconditionFailed", "PutObject")
+        if isinstance(Body, str):
+            Body = Body.encode("utf-8")
+        self.version += 1
+        etag = f'"{self.version}"'
+        self.objects[(Bucket, Key)] = {"Body": Body, "ETag": etag, **kwargs}
+        if Tagging:
+            from urllib.parse import parse_qsl
+
+            self.tags[(Bucket, Key)] = dict(parse_qsl(Tagging))
+        return {"ETag": etag}
+
+    def get_object(self, Bucket, Key, **kwargs):
+        if (Bucket, Key) not in self.objects:
+            raise self._error("NoSuchKey", "GetObject")
+        stored = self.objects[(Bucket, Key)]
+        return {**stored, "Body": io.BytesIO(stored["Body"])}
+
+    def head_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise self._error("404", "HeadObject")
+        return {"ContentLength": len(self.objects[(Bucket, Key)]["Body"])}
+
+    def copy_object(self, CopySource, Bucket, Key, **kwargs):
+        source = (CopySource["Bucket"], CopySource["Key"])
+        if source not in self.objects:
+            raise self._error("NoSuchKey", "CopyObject")
+        self.objects[(Bucket, Key)] = dict(self.objects[source])
+        return {}
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop((Bucket, Key), None)
+        self.tags.pop((Bucket, Key), None)
+        return {}
+
+    def get_object_tagging(self, Bucket, Key):
+        return {
+            "TagSet": [
+                {"Key": k, "Value": v}
+                for k, v in self.tags.get((Bucket, Key), {}).items()
+            ]
+        }
+
+    def put_object_tagging(self, Bucket, Key, Tagging):
+        self.tags[(Bucket, Key)] = {t["Key"]: t["Value"] for t in Tagging["TagSet"]}
+        return {}
+
+    def list_objects_v2(self, Bucket, Prefix="", **kwargs):
+        keys = sorted(
+            k for b, k in self.objects if b == Bucket and k.startswith(Prefix)
+        )
+        return {
+            "KeyCount": len(keys),
+            "Contents": [
+                {"Key": k, "Size": len(self.objects[(Bucket, k)]["Body"])} for k in keys
+            ],
+        }
+
+    def get_paginator(self, operation_name):
+        store = self
+
+        class paginator:
+            def paginate(self, **kwargs):
+                return [getattr(store, operation_name)(**kwargs)]
+
+        return paginator()
@@ -0,0 +1,53 @@
+import json
+import os
+import sys
+import xml.etree.ElementTree as ET
+
+sys.path.append(
+    os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
+)  # project root folder
+
+from billing_backfill import list_sources
+from tools.run_backfill import run_backfill
+
+FILE_NAME = "FINANCE_20240510113633.csv"
+ROW_TAG = "{http://TechnologyOneCorp.com/Public/Services}Row"
+
+
+class TestBillingBackfill:
+
+    def test_run_backfill_writes_envelopes(self, tmp_path):
+        source = os.path.join(os.path.dirname(__file__), FILE_NAME)
+        options = {
+            "output": str(tmp_path),
+            "auth": {"user_id": "user-id", "password": "password", "config": "config"},
+            "rows_per_chunk": 500,
+        }
+
+        totals = run_backfill(list_sources(source), options, workers=2)
+
+        # 1250 data rows plus the header, cut like the processor cuts them
+        assert sorted(os.listdir(tmp_path)) == [
+            f"{FILE_NAME}_0_499_1.xml",
+            f"{FILE_NAME}_1000_1250_3.xml",
+            f"{FILE_NAME}_500_999_2.xml",
+        ]
+        rows = 0
+        for name in os.listdir(tmp_path):
+            root = ET.parse(os.path.join(tmp_path, name)).getroot()
+            rows += len(root.findall(f".//{ROW_TAG}"))
+        assert rows == totals["rows"] == 1250 - totals["rejected"]
+        assert totals["files"] == 1 and totals["chunks"] == 3
+
+    def test_failed_file_does_not_stop_the_run(self, tmp_path):
+        source = os.path.join(os.path.dirname(__file__), FILE_NAME)
+        missing = str(tmp_path / "MISSING.csv")
+        options = {
+            "output": str(tmp_path),
+            "auth": {"user_id": "", "password": "", "config": ""},
+        }
+
+        totals = run_backfill(list_sources(source) + [(missing, 0)], options, workers=2)
+
+        assert totals["files"] == 1 and totals["rows"] > 0
+        assert [failure["path"] for failure in totals["failed_files"]] == [missing]
@@ -0,0 +1,64 @@
+import codecs
+import io
+import os
+import sys
+
+sys.path.append(
+    os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
+)  # project root folder
+
+from billing_encoding import (
+    ENCODING_SAMPLE_SIZE,
+    detect_encoding,
+    canonical_header,
+    canonical_headers,
+)
+
+HEADER = "General Ledger Code,Subtotal – Sales Area Code,Subtotal – Sales Area\r\n"
+
+
+class TestBillingEncoding:
+
+    def test_detect_encoding(self):
+        assert detect_encoding(HEADER.encode("cp1252")) == "cp1252-latin1"
+        assert detect_encoding(HEADER.encode("utf-8")) == "utf-8-cp1252"
+        assert detect_encoding(codecs.BOM_UTF8 + HEADER.encode("utf-8")) == "utf-8-sig"
+        assert detect_encoding(b"General Ledger Code,CRMID\r\n") == "utf-8-cp1252"
+        # 0x81 is undefined in windows-1252
+        assert detect_encoding(b"a,\x81\x96") == "latin-1"
+
+    def test_detect_encoding_sample_cut_mid_character(self):
+        sample = "Café – Sales".encode("utf-8")[:-7]
+        assert detect_encoding(sample) == "utf-8-cp1252"
+
+    def test_ascii_sample_decodes_later_bytes(self):
+        data = b"Campaign Name\r\n" + b"x" * 100 + "Café,".encode("utf-8")
+        data += "– Sales".encode("cp1252") + b",\x81\x8d\r\n"
+        encoding = detect_encoding(data[:16])
+        text = io.TextIOWrapper(io.BytesIO(data), encoding=encoding, newline="").read()
+        assert text.endswith("Café,– Sales,\x81\x8d\r\n")
+        assert data.decode(encoding) == text
+
+    def test_odd_byte_after_sample_decodes(self):
+        padding = b"x" * ENCODING_SAMPLE_SIZE + b"\r\n"
+        # A windows-1252 en dash after a UTF-8 sample
+        utf8_data = HEADER.encode("utf-8") + padding + b"\x96\r\n"
+        # A byte windows-1252 leaves undefined after a windows-1252 sample
+        cp1252_data = HEADER.encode("cp1252") + padding + b"\x81\r\n"
+        for data, last_line in ((utf8_data, "–\r\n"), (cp1252_data, "\x81\r\n")):
+            encoding = detect_encoding(data[:ENCODING_SAMPLE_SIZE])
+            text = io.TextIOWrapper(
+                io.BytesIO(data), encoding=encoding, newline=""
+            ).read()
+            assert text.startswith(HEADER)
+            assert text.endswith(last_line)
+            assert data.decode(encoding) == text
+
+    def test_canonical_header(self):
+        raw_names = HEADER.encode("cp1252").decode("charmap").rstrip().split(",")
+        assert canonical_headers(raw_names) == [
+            "General Ledger Code",
+            "Subtotal - Sales Area Code",
+            "Subtotal - Sales Area",
+        ]
+        assert canonical_header("﻿Subtotal —  Sales Area ") == ("Subtotal - Sales Area")
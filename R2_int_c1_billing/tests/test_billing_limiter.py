@@ -0,0 +1,95 @@
+from unittest import mock
+
+import os
+import sys
+
+sys.path.append(
+    os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
+)  # project root folder
+
+from billing_limiter import (
+    CLIENT_ERROR,
+    SERVER_ERROR,
+    AdaptiveLimiter,
+    LocalStateBackend,
+    S3StateBackend,
+    SUCCESS,
+    THROTTLED,
+    classify_status_code,
+)
+from tests.mock_boto import mock_s3_store
+
+
+class TestBillingLimiter:
+
+    def test_limit_caps_in_flight_calls(self):
+        limiter = AdaptiveLimiter(LocalStateBackend(), initial_limit=2)
+        first, _ = limiter.try_acquire()
+        second, _ = limiter.try_acquire()
+        third, reason = limiter.try_acquire()
+        assert first and second and third is None
+        assert "limit" in reason
+
+        limiter.release(first, 1.0, SUCCESS)
+        assert limiter.try_acquire()[0] is not None
+
+    def test_additive_increase_multiplicative_decrease(self):
+        limiter = AdaptiveLimiter(LocalStateBackend(), initial_limit=2, max_limit=10)
+        for _ in range(4):
+            lease, _ = limiter.try_acquire()
+            limit = limiter.release(lease, 1.0, SUCCESS)
+        assert 3.0 < limit < 4.0
+
+        # Slow successes do not grow the limit
+        lease, _ = limiter.try_acquire()
+        assert limiter.release(lease, 120.0, SUCCESS) == limit
+
+        lease, _ = limiter.try_acquire()
+        assert limiter.release(lease, 1.0, THROTTLED) == limit / 2
+
+    def test_circuit_opens_and_probes(self):
+        limiter = AdaptiveLimiter(
+            LocalStateBackend(), initial_limit=4, failure_threshold=2, open_seconds=60
+        )
+        with mock.patch("time.time", return_value=1000.0):
+            for _ in range(2):
+                lease, _ = limiter.try_acquire()
+                limiter.release(lease, 1.0, classify_status_code(503))
+            lease, reason = limiter.try_acquire()
+            assert lease is None and reason == "circuit open"
+
+        with mock.patch("time.time", return_value=1061.0):
+            probe, reason = limiter.try_acquire()
+            assert probe is not None and "probing" in reason
+            # Only one probe at a time
+            assert limiter.try_acquire()[0] is None
+            limiter.release(probe, 1.0, SUCCESS)
+            assert limiter.try_acquire()[0] is not None
+
+    def test_s3_backend_shares_state(self):
+        s3 = mock_s3_store()
+        with mock.patch("boto3.client", lambda type, region_name="": s3):
+            one = AdaptiveLimiter(
+                S3StateBackend("bucket", "limiter/techone.json"), initial_limit=1
+            )
+            other = AdaptiveLimiter(
+                S3StateBackend("bucket", "limiter/techone.json"), initial_limit=1
+            )
+            lease, _ = one.try_acquire()
+            assert lease is not None
+            assert other.try_acquire()[0] is None
+            one.release(lease, 1.0, SUCCESS)
+            assert other.try_acquire()[0] is not None
+
+    def test_soap_fault_is_a_client_error(self):
+        fault = (
+            '<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/"><s:Body>'
+            "<s:Fault><faultcode>s:Server</faultcode><faultstring>Invalid date</faultstring>"
+            "</s:Fault></s:Body></s:Envelope>"
+        )
+        assert classify_status_code(500, fault) == CLIENT_ERROR
+        assert (
+            classify_status_code(500, "<html>Service Unavailable</html>")
+            == SERVER_ERROR
+        )
+        assert classify_status_code(500) == SERVER_ERROR
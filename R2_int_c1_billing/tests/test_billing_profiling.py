@@ -0,0 +1,108 @@
+from unittest import mock
+
+import json
+import marshal
+import os
+import sys
+from types import SimpleNamespace
+
+sys.path.append(
+    os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
+)  # project root folder
+
+import billing_profiling
+from billing_profiling import parse_settings, profiled
+from tests.mock_boto import mock_client_generator, mock_s3_store
+
+BUCKET = "billing-bucket"
+CONTEXT = SimpleNamespace(function_name="billing-consumer", aws_request_id="req-1")
+
+
+class MockSSMClient:
+    def __init__(mock_self, value):
+        mock_self.value = value
+        mock_self.calls = 0
+
+    def get_parameter(mock_self, Name):
+        mock_self.calls += 1
+        return {"Parameter": {"Name": Name, "Value": mock_self.value}}
+
+
+@profiled
+def handler(event, context):
+    rows = [str(number) * 10 for number in range(20000)]
+    return {"rows": len(rows)}
+
+
+class TestBillingProfiling:
+
+    def test_parse_settings(self):
+        assert parse_settings(True) == {"sample_rate": 1.0, "top": 30}
+        assert parse_settings("0.25") == {"sample_rate": 0.25, "top": 30}
+        assert parse_settings('{"sample_rate": 0.5, "top": 5}') == {
+            "sample_rate": 0.5,
+            "top": 5,
+        }
+        for off in (False, "0", None, "off", {"sample_rate": "x"}):
+            assert parse_settings(off) is None
+
+    def test_event_profiles_invocation(self):
+        s3 = mock_s3_store()
+        with mock.patch.dict(os.environ, {"PROFILING_BUCKET": BUCKET}), mock.patch(
+            "boto3.client", mock_client_generator({"s3": lambda region_name: s3})
+        ):
+            result = handler({"profile": {"top": 5}}, CONTEXT)
+
+        assert result == {"rows": 20000}
+        keys = sorted(key for _, key in s3.objects)
+        assert len(keys) == 2 and keys[0].startswith("profiles/billing-consumer/")
+        assert keys[0].endswith("_req-1.json") and keys[1].endswith("_req-1.pstats")
+        # The dump is a marshalled pstats table, loadable by pstats/snakeviz
+        assert isinstance(marshal.loads(s3.objects[(BUCKET, keys[1])]["Body"]), dict)
+        report = json.loads(s3.objects[(BUCKET, keys[0])]["Body"])
+        assert len(report["top_functions"]) <= 5 and len(report["top_allocations"]) == 5
+        assert any("handler" in entry["function"] for entry in report["top_functions"])
+        assert report["peak_traced_mb"] > 0
+
+    def test_parameter_sampling(self):
+        s3 = mock_s3_store()
+        ssm = MockSSMClient('{"sample_rate": 0.5}')
+        billing_profiling.parameter_cache.update({"value": None, "expires": 0.0})
+        with mock.patch.dict(
+            os.environ,
+            {"PROFILING_BUCKET": BUCKET, "PROFILING_PARAMETER": "/env/c1/profiling"},
+        ), mock.patch(
+            "boto3.client",
+            mock_client_generator(
+                {"s3": lambda region_name: s3, "ssm": lambda region_name: ssm}
+            ),
+        ), mock.patch(
+            "random.random", side_effect=[0.9, 0.1]
+        ):
+            handler({"Records": []}, CONTEXT)
+            assert s3.objects == {}
+            handler({"Records": []}, CONTEXT)
+
+        # Sampled in on the second call only; the parameter was read once
+        assert len(s3.objects) == 2
+        assert ssm.calls == 1
+        billing_profiling.parameter_cache.update({"value": None, "expires": 0.0})
+
+    def test_unreachable_parameter_leaves_profiling_off(self):
+        from botocore.exceptions import EndpointConnectionError
+
+        class UnreachableSSMClient:
+            def __init__(mock_self, region_name=""):
+                pass
+
+            def get_parameter(mock_self, Name):
+                raise EndpointConnectionError(endpoint_url="https://ssm")
+
+        billing_profiling.parameter_cache.update({"value": None, "expires": 0.0})
+        with mock.patch.dict(
+            os.environ, {"PROFILING_PARAMETER": "/env/c1/profiling"}
+        ), mock.patch(
+            "boto3.client", mock_client_generator({"ssm": UnreachableSSMClient})
+        ):
+            assert handler({"Records": []}, CONTEXT) == {"rows": 20000}
+        billing_profiling.parameter_cache.update({"value": None, "expires": 0.0})
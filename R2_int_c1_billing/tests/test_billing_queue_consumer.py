@@ -1,17 +1,19 @@
 from unittest import mock
 
+import gzip
 import json
 import io
 import os
 import sys
+import xml.etree.ElementTree as ET
 
 sys.path.append(
     os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
 )  # project root folder
 
+from billing_limiter import SUCCESS
 from tests.mock_boto import mock_client_generator
 
-
 MOCK_ENV = {
     "TECHONE_SOAP_SECRET_NAME": "techone-soap-secret-name",
     "BILLING_BUCKET": "billing-bucket",
@@ -76,3 +78,201 @@ class TestBillingQueueConsumer:
             )
 
             lambda_handler(GOOD_EVENT, {})
+
+    def test_read_data_from_s3_gzip(self):
+
+        class MockS3Client:
+            def __init__(mock_self, region_name) -> None:
+                pass
+
+            def get_object(mock_self, Bucket, Key):
+                f = open(os.path.dirname(__file__) + "/" + FILE_NAME, "rb")
+                return {
+                    "Body": io.BytesIO(gzip.compress(f.read())),
+                    "ContentEncoding": "gzip",
+                }
+
+        with mock.patch("boto3.client", mock_client_generator({"s3": MockS3Client})):
+            from functions.billing_queue_consumer.c1_billing_queue_consumer import (
+                read_data_from_s3,
+            )
+
+            rows = read_data_from_s3("queue/" + FILE_NAME + "_0_1249_1.csv")
+
+        assert len(rows) == 1250
+        assert rows[0]["CRMID"] == "000290"
+
+    def test_lambda_handler_techone_rows(self):
+
+        def mock_boto3_session():
+            client = mock.MagicMock()
+            client.get_secret_value.return_value = {
+                "SecretString": json.dumps(
+                    {
+                        "UserId": "user-id",
+                        "Password": "password",
+                        "WSDL": "wsdl",
+                        "Config": "config",
+                    }
+                )
+            }
+
+            result = mock.MagicMock()
+            result.client.return_value = client
+            return result
+
+        row_lines = [
+            '152-0300-00020-00000,"NAT","Andy Gibb",01/12/2022',
+            '152-0300-00020-00000,"NAT","R&amp;D&#10;line",01/12/2022',
+        ]
+
+        class MockS3Client:
+            def __init__(mock_self, region_name) -> None:
+                pass
+
+            def get_object(mock_self, Bucket, Key):
+                body = "".join(line + "\n" for line in row_lines)
+                return {
+                    "Body": io.BytesIO(body.encode("utf-8")),
+                    "Metadata": {"chunk-format": "techone-rows", "row-count": "2"},
+                }
+
+        invoked = {}
+
+        class MockLambdaClient:
+            def __init__(mock_self, region_name="") -> None:
+                pass
+
+            def invoke(mock_self, FunctionName, InvocationType, Payload):
+                invoked["payload"] = json.loads(Payload)
+                return {"ResponseMetadata": {"HTTPStatusCode": 200}, "Payload": ""}
+
+        with mock.patch("boto3.session.Session", mock_boto3_session), mock.patch(
+            "boto3.client",
+            mock_client_generator({"s3": MockS3Client, "lambda": MockLambdaClient}),
+        ):
+            from functions.billing_queue_consumer.c1_billing_queue_consumer import (
+                lambda_handler,
+            )
+
+            lambda_handler({"Records": [{"body": "queue/F.csv_0_1_1.csv"}]}, {})
+
+        content = invoked["payload"]["content"]["content"]
+        root = ET.fromstring(content)
+        rows = root.findall(".//{http://TechnologyOneCorp.com/Public/Services}Row")
+        assert [row.text for row in rows] == [
+            '152-0300-00020-00000,"NAT","Andy Gibb",01/12/2022',
+            '152-0300-00020-00000,"NAT","R&D\nline",01/12/2022',
+        ]
+
+    def test_lambda_handler_circuit_open(self):
+
+        def mock_boto3_session():
+            client = mock.MagicMock()
+            client.get_secret_value.return_value = {
+                "SecretString": json.dumps(
+                    {
+                        "UserId": "user-id",
+                        "Password": "password",
+                        "WSDL": "wsdl",
+                        "Config": "config",
+                    }
+                )
+            }
+
+            result = mock.MagicMock()
+            result.client.return_value = client
+            return result
+
+        class MockS3Client:
+            def __init__(mock_self, region_name) -> None:
+                pass
+
+            def get_object(mock_self, Bucket, Key):
+                f = open(os.path.dirname(__file__) + "/" + FILE_NAME, "r")
+                return {"Body": io.BytesIO(f.read().encode("utf-8"))}
+
+        invoked = []
+
+        class MockLambdaClient:
+            def __init__(mock_self, region_name="") -> None:
+                pass
+
+            def invoke(mock_self, FunctionName, InvocationType, Payload):
+                invoked.append(FunctionName)
+                return {
+                    "ResponseMetadata": {"HTTPStatusCode": 200},
+                    "Payload": io.BytesIO(
+                        json.dumps({"status_code": 503, "body": ""}).encode("utf-8")
+                    ),
+                }
+
+        records = [
+            {"messageId": f"m{i}", "body": f"queue/{FILE_NAME}_0_1249_1.csv"}
+            for i in range(4)
+        ]
+        with mock.patch.dict(
+            "os.environ", {"LIMITER_BACKEND": "local", "LIMITER_FAILURE_THRESHOLD": "1"}
+        ), mock.patch("boto3.session.Session", mock_boto3_session), mock.patch(
+            "boto3.client",
+            mock_client_generator({"s3": MockS3Client, "lambda": MockLambdaClient}),
+        ):
+            from functions.billing_queue_consumer.c1_billing_queue_consumer import (
+                lambda_handler,
+            )
+
+            result = lambda_handler({"Records": records}, {})
+
+        # The 503 opens the breaker, the rest are handed back without a call
+        assert len(invoked) == 1
+        assert result == {
+            "batchItemFailures": [{"itemIdentifier": f"m{i}"} for i in range(4)]
+        }
+
+    def test_lambda_handler_limiter_failure(self):
+        limiter = mock.Mock()
+        limiter.try_acquire.side_effect = [
+            ("lease", None),
+            RuntimeError("Limiter state save failed: too many conflicting writers"),
+        ]
+        records = [
+            {
+                "messageId": f"m{i}",
+                "receiptHandle": f"r{i}",
+                "eventSourceARN": "arn:aws:sqs:ap-southeast-2:0:billing",
+                "body": f"queue/{FILE_NAME}_0_1249_1.csv",
+            }
+            for i in range(3)
+        ]
+        process_record = mock.Mock(return_value=SUCCESS)
+        from functions.billing_queue_consumer import c1_billing_queue_consumer
+
+        with mock.patch.multiple(
+            c1_billing_queue_consumer,
+            get_techone_soap_secret=mock.Mock(return_value={}),
+            get_limiter=mock.Mock(return_value=limiter),
+            process_record=process_record,
+            defer_records=mock.DEFAULT,
+        ) as patched:
+            result = c1_billing_queue_consumer.lambda_handler({"Records": records}, {})
+
+        # The imported record is not handed back to be imported again
+        assert process_record.call_count == 1
+        patched["defer_records"].assert_called_once_with(records[1:], 60)
+        assert result == {
+            "batchItemFailures": [{"itemIdentifier": "m1"}, {"itemIdentifier": "m2"}]
+        }
+
+    def test_is_final_attempt(self):
+        from functions.billing_queue_consumer.c1_billing_queue_consumer import (
+            is_final_attempt,
+        )
+
+        def record(count):
+            return {"attributes": {"ApproximateReceiveCount": str(count)}}
+
+        # Unset, every failure is final
+        assert is_final_attempt(record(1))
+        with mock.patch.dict("os.environ", {"MAX_RECEIVE_COUNT": "5"}):
+            assert not is_final_attempt(record(4))
+            assert is_final_attempt(record(5))
@@ -0,0 +1,215 @@
+from unittest import mock
+
+import json
+import os
+import sys
+import threading
+
+sys.path.append(
+    os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
+)  # project root folder
+
+from tests.mock_boto import mock_client_generator, mock_s3_store
+
+FILE_NAME = "FINANCE_20240510113633.csv"
+BUCKET = "billing-bucket"
+
+
+class MockSQSClient:
+    def __init__(mock_self, messages=(), failing_deletes=()):
+        mock_self.messages = list(messages)
+        mock_self.failing_deletes = set(failing_deletes)
+        mock_self.sent = []
+        mock_self.deleted = []
+        mock_self.released = []
+        mock_self.lock = threading.Lock()
+
+    def receive_message(mock_self, QueueUrl, MaxNumberOfMessages, **kwargs):
+        with mock_self.lock:
+            batch = mock_self.messages[:MaxNumberOfMessages]
+            mock_self.messages = mock_self.messages[MaxNumberOfMessages:]
+        return {"Messages": batch}
+
+    def send_message_batch(mock_self, QueueUrl, Entries):
+        with mock_self.lock:
+            mock_self.sent += [entry["MessageBody"] for entry in Entries]
+        return {"Successful": [{"Id": entry["Id"]} for entry in Entries]}
+
+    def delete_message_batch(mock_self, QueueUrl, Entries):
+        failed = [e for e in Entries if e["ReceiptHandle"] in mock_self.failing_deletes]
+        with mock_self.lock:
+            mock_self.deleted += [
+                e["ReceiptHandle"] for e in Entries if e not in failed
+            ]
+        return {
+            "Successful": [{"Id": e["Id"]} for e in Entries if e not in failed],
+            "Failed": [
+                {
+                    "Id": e["Id"],
+                    "SenderFault": True,
+                    "Message": "ReceiptHandleIsInvalid",
+                }
+                for e in failed
+            ],
+        }
+
+    def change_message_visibility_batch(mock_self, QueueUrl, Entries):
+        mock_self.released += [entry["ReceiptHandle"] for entry in Entries]
+
+
+def dlq_message(number, body, sent_timestamp):
+    return {
+        "MessageId": f"m{number}",
+        "ReceiptHandle": f"r{number}",
+        "Body": body,
+        "Attributes": {"SentTimestamp": str(sent_timestamp)},
+    }
+
+
+class TestBillingRedrive:
+
+    def test_redrive_dlq_dedupes_and_filters(self):
+        may_10 = 1715299200000  # 2024-05-10T00:00:00Z in ms
+        range_body = json.dumps(
+            {"format": "byte-range", "chunk_key": f"queue/{FILE_NAME}_4999_9997_2.csv"}
+        )
+        sqs = MockSQSClient(
+            [
+                dlq_message(i, f"queue/{FILE_NAME}_0_4998_1.csv", may_10)
+                for i in range(3)
+            ]
+            + [dlq_message(3, range_body, may_10)]
+            # Other file, and the right file but before --since
+            + [dlq_message(4, "queue/OTHER.csv_0_4998_1.csv", may_10)]
+            + [dlq_message(5, f"queue/{FILE_NAME}_9998_9999_3.csv", may_10 - 86400000)]
+        )
+
+        with mock.patch("boto3.client", lambda type, region_name="", **kwargs: sqs):
+            from functions.billing_redrive.billing_redrive import build_options, redrive
+
+            summary = redrive(
+                build_options(
+                    {
+                        "file_name": FILE_NAME,
+                        "since": "2024-05-10",
+                        "rate": 0,
+                        "queue_url": "queue-url",
+                        "dlq_url": "dlq-url",
+                    }
+                )
+            )
+
+        assert (
+            summary["chunks"] == 2
+            and summary["duplicates"] == 2
+            and summary["sent"] == 2
+        )
+        assert sorted(sqs.sent) == sorted(
+            [f"queue/{FILE_NAME}_0_4998_1.csv", range_body]
+        )
+        assert sorted(sqs.deleted) == ["r0", "r1", "r2", "r3"]
+        assert sorted(sqs.released) == ["r4", "r5"]
+
+    def test_replay_from_error(self):
+        s3 = mock_s3_store()
+        sqs = MockSQSClient()
+        range_body = json.dumps(
+            {"format": "byte-range", "chunk_key": f"queue/{FILE_NAME}_0_4998_1.csv"}
+        )
+        s3.put_object(
+            Bucket=BUCKET,
+            Key=f"state/error/{FILE_NAME}_0_4998_1.csv.json",
+            Body=json.dumps({"body": range_body, "terminal": True}),
+        )
+        # Not terminal: the chunk may still be retrying from the billing queue
+        s3.put_object(
+            Bucket=BUCKET,
+            Key=f"state/error/{FILE_NAME}_9998_9999_3.csv.json",
+            Body=json.dumps({"body": f"queue/{FILE_NAME}_9998_9999_3.csv"}),
+        )
+        s3.put_object(
+            Bucket=BUCKET, Key=f"error/{FILE_NAME}_4999_9997_2.csv", Body=b"a,b\n"
+        )
+        # Listed as a terminal error, but delivered by the time it is sent
+        s3.put_object(
+            Bucket=BUCKET,
+            Key=f"state/error/{FILE_NAME}_10000_10001_4.csv.json",
+            Body=json.dumps({"body": "late", "terminal": True}),
+        )
+        s3.put_object(
+            Bucket=BUCKET,
+            Key=f"state/delivered/{FILE_NAME}_10000_10001_4.csv.json",
+            Body=b"{}",
+        )
+
+        with mock.patch(
+            "boto3.client",
+            mock_client_generator(
+                {"s3": lambda region_name: s3, "sqs": lambda region_name: sqs}
+            ),
+        ):
+            from functions.billing_redrive.billing_redrive import build_options, redrive
+
+            summary = redrive(
+                build_options(
+                    {
+                        "source": "error",
+                        "rate": 0,
+                        "queue_url": "queue-url",
+                        "bucket_name": BUCKET,
+                    }
+                )
+            )
+
+        assert summary["sent"] == 2 and summary["no_longer_failed"] == 1
+        assert sorted(sqs.sent) == sorted(
+            [range_body, f"queue/{FILE_NAME}_4999_9997_2.csv"]
+        )
+        # The ledger chunk is queued again, the moved chunk is back in queue/
+        assert (BUCKET, f"state/queued/{FILE_NAME}_0_4998_1.csv.json") in s3.objects
+        assert (BUCKET, f"state/error/{FILE_NAME}_0_4998_1.csv.json") not in s3.objects
+        assert (BUCKET, f"queue/{FILE_NAME}_4999_9997_2.csv") in s3.objects
+
+    def test_redrive_dlq_limit_and_failed_deletes(self):
+        may_10 = 1715299200000
+        s3 = mock_s3_store()
+        sqs = MockSQSClient(
+            [
+                dlq_message(i, f"queue/{FILE_NAME}_0_4998_{i}.csv", may_10)
+                for i in range(1, 5)
+            ],
+            failing_deletes=["r2"],
+        )
+        # Chunk 1 was imported by an earlier replay whose DLQ delete failed
+        s3.put_object(
+            Bucket=BUCKET,
+            Key=f"state/delivered/{FILE_NAME}_0_4998_1.csv.json",
+            Body=b"{}",
+        )
+
+        with mock.patch(
+            "boto3.client",
+            mock_client_generator(
+                {"s3": lambda region_name: s3, "sqs": lambda region_name: sqs}
+            ),
+        ):
+            from functions.billing_redrive.billing_redrive import build_options, redrive
+
+            summary = redrive(
+                build_options(
+                    {
+                        "rate": 0,
+                        "workers": 1,
+                        "max_messages": 3,
+                        "queue_url": "queue-url",
+                        "dlq_url": "dlq-url",
+                        "bucket_name": BUCKET,
+                    }
+                )
+            )
+
+        # Over the limit: message 4 is released, not held for 900s
+        assert sqs.released == ["r4"]
+        assert summary["already_delivered"] == 1 and "r1" in sqs.deleted
+        assert summary["sent"] == 2
+        assert summary["delete_failed"] == [f"queue/{FILE_NAME}_0_4998_2.csv"]
@@ -0,0 +1,56 @@
+import csv
+import os
+import sys
+import xml.etree.ElementTree as ET
+
+import pytest
+
+sys.path.append(
+    os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
+)  # project root folder
+
+from billing_rows import transform_rows, soap_envelope, wrap_rows
+
+FILE_NAME = "FINANCE_20240510113633.csv"
+NS = "{http://TechnologyOneCorp.com/Public/Services}"
+
+
+def read_fixture():
+    with open(os.path.dirname(__file__) + "/" + FILE_NAME, newline="") as f:
+        rows = list(csv.reader(f))
+    return rows[0], rows[1:]
+
+
+class TestBillingRows:
+
+    def test_transform_rows_matches_row_format(self):
+        header, rows = read_fixture()
+        row_lines, reasons = transform_rows(header, rows[:3])
+
+        assert reasons == {}
+        assert len(row_lines) == 3
+        assert row_lines[0].startswith('152-0300-00020-00000,"NAT","Andy Gibb"')
+        assert ",01/12/2022,31/12/2037,506," in row_lines[0]
+
+    def test_transformed_rows_embed_in_envelope(self):
+        header, rows = read_fixture()
+        rows[0][header.index("Campaign Name")] = 'R&D <launch>\nphase "2"'
+        row_lines, reasons = transform_rows(header, rows[:2])
+
+        assert all("\n" not in line for line in row_lines)
+        root = ET.fromstring(
+            soap_envelope("user", "pass", "config", wrap_rows(row_lines))
+        )
+        texts = [row.text for row in root.iter(NS + "Row")]
+        assert len(texts) == 2
+        # Embedded quotes are removed, as the consumer does for csv chunks
+        assert '"R&D <launch>\nphase 2"' in texts[0]
+
+    def test_transform_rows_fails_on_missing_column(self):
+        header, rows = read_fixture()
+        position = header.index("Product Name")
+        header = header[:position] + header[position + 1 :]
+        rows = [row[:position] + row[position + 1 :] for row in rows[:3]]
+
+        with pytest.raises(ValueError, match="missing columns: Product Name"):
+            transform_rows(header, rows)
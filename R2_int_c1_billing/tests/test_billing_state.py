@@ -0,0 +1,68 @@
+from unittest import mock
+
+import os
+import sys
+
+sys.path.append(
+    os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
+)  # project root folder
+
+from billing_state import (
+    DELIVERED,
+    ERROR,
+    PREFIX_MODE,
+    STATE_TAG,
+    get_chunk_state,
+    list_chunks_in_state,
+    record_chunk_state,
+)
+from tests.mock_boto import mock_s3_store
+
+FILE_NAME = "FINANCE_20240510113633.csv"
+BUCKET = "billing-bucket"
+
+
+class TestBillingState:
+
+    def test_ledger_tags_chunk_in_place(self):
+        s3 = mock_s3_store()
+        chunk_key = f"queue/{FILE_NAME}_0_4998_1.csv"
+        s3.put_object(
+            Bucket=BUCKET, Key=chunk_key, Body=b"a,b\n", Tagging="source=landmark"
+        )
+        delete_object = mock.Mock(wraps=s3.delete_object)
+        s3.delete_object = delete_object
+        with mock.patch("boto3.client", lambda type, region_name="": s3):
+            record_chunk_state(BUCKET, chunk_key, ERROR)
+            record_chunk_state(BUCKET, chunk_key, DELIVERED, {"row_count": 1})
+            # Byte-range chunks have no object, only the marker
+            record_chunk_state(BUCKET, f"queue/{FILE_NAME}_4999_9997_2.csv", DELIVERED)
+
+            assert get_chunk_state(BUCKET, chunk_key) == DELIVERED
+            batches = list(list_chunks_in_state(BUCKET, DELIVERED, FILE_NAME))
+            assert list(list_chunks_in_state(BUCKET, ERROR)) == []
+
+        assert [item["chunk_key"] for batch in batches for item in batch] == [
+            chunk_key,
+            f"queue/{FILE_NAME}_4999_9997_2.csv",
+        ]
+        # The chunk was not copied and keeps its other tags
+        assert (BUCKET, chunk_key) in s3.objects
+        assert s3.tags[(BUCKET, chunk_key)] == {
+            "source": "landmark",
+            STATE_TAG: DELIVERED,
+        }
+        # Only the previous state's marker is deleted, no blind deletes
+        delete_object.assert_called_once_with(
+            Bucket=BUCKET, Key=f"state/error/{FILE_NAME}_0_4998_1.csv.json"
+        )
+
+    def test_prefix_mode_moves_chunk(self):
+        s3 = mock_s3_store()
+        chunk_key = f"queue/{FILE_NAME}_0_4998_1.csv"
+        s3.put_object(Bucket=BUCKET, Key=chunk_key, Body=b"a,b\n")
+        with mock.patch("boto3.client", lambda type, region_name="": s3):
+            record_chunk_state(BUCKET, chunk_key, DELIVERED, mode=PREFIX_MODE)
+
+        assert (BUCKET, chunk_key) not in s3.objects
+        assert (BUCKET, f"delivered/{FILE_NAME}_0_4998_1.csv") in s3.objects
@@ -0,0 +1,101 @@
+from unittest import mock
+
+import csv
+import io
+import os
+import sys
+
+sys.path.append(
+    os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
+)  # project root folder
+
+from billing_rows import transform_rows
+from billing_totals import (
+    ControlTotals,
+    build_reconciliation_manifest,
+    compare_totals,
+    write_reconciliation_manifest,
+)
+from billing_tracker import register_file, record_chunk_complete, write_file_summary
+from billing_validation import validate_dict_rows
+from tests.mock_boto import mock_s3_store
+
+FILE_NAME = "FINANCE_20240510113633.csv"
+BUCKET = "billing-bucket"
+
+
+def read_fixture_rows():
+    with open(os.path.join(os.path.dirname(__file__), FILE_NAME), newline="") as f:
+        return list(csv.reader(f))
+
+
+class TestBillingTotals:
+
+    def test_consumer_totals_match_manifest(self):
+        csv_rows = read_fixture_rows()
+        manifest = build_reconciliation_manifest(FILE_NAME, csv_rows, 500)
+        chunk_key = f"queue/{FILE_NAME}_500_999_2.csv"
+        assert list(manifest["chunks"]) == [
+            f"queue/{FILE_NAME}_0_499_1.csv",
+            chunk_key,
+            f"queue/{FILE_NAME}_1000_1250_3.csv",
+        ]
+        assert manifest["file"]["all"]["row_count"] == 1250
+
+        # csv chunk: the consumer validates dict rows and sums what it keeps
+        text = io.StringIO()
+        csv.writer(text).writerows([csv_rows[0]] + csv_rows[500:1000])
+        rows = list(csv.DictReader(io.StringIO(text.getvalue())))
+        mask, _ = validate_dict_rows(rows)
+        accepted = ControlTotals().add_dict_rows(r for r, ok in zip(rows, mask) if ok)
+        expected = manifest["chunks"][chunk_key]["accepted"]
+        assert compare_totals(expected, accepted.compact()) == []
+
+        # techone-rows chunk: the same totals from the transformed row lines
+        row_lines, _ = transform_rows(csv_rows[0], csv_rows[500:1000])
+        assert (
+            compare_totals(expected, ControlTotals().add_row_lines(row_lines).compact())
+            == []
+        )
+
+        rows[0]["Subtotal Line"] = "1.00"
+        tampered = ControlTotals().add_dict_rows(r for r, ok in zip(rows, mask) if ok)
+        assert any(
+            "Subtotal Line" in d for d in compare_totals(expected, tampered.compact())
+        )
+
+    def test_row_lines_with_quotes_and_commas(self):
+        csv_rows = read_fixture_rows()
+        header = csv_rows[0]
+        rows = [list(row) for row in csv_rows[1:4]]
+        rows[0][header.index("Campaign Name")] = 'Big "Sale", & more'
+        rows[1][header.index("Product Name")] = '"Quoted", <b>\nline'
+        row_lines, reasons = transform_rows(header, [list(row) for row in rows])
+
+        assert reasons == {}
+        from_lines = ControlTotals().add_row_lines(row_lines)
+        from_rows = ControlTotals().add_list_rows(header, rows)
+        assert from_lines.to_dict() == from_rows.to_dict()
+
+    def test_file_summary_reconciles(self):
+        csv_rows = read_fixture_rows()
+        manifest = build_reconciliation_manifest(FILE_NAME, csv_rows, 1000)
+        s3 = mock_s3_store()
+        with mock.patch("boto3.client", lambda type, region_name="": s3):
+            write_reconciliation_manifest(BUCKET, manifest)
+            register_file(BUCKET, FILE_NAME, 2)
+            for chunk_key in manifest["chunks"]:
+                start, end = (int(n) for n in chunk_key.split("_")[-3:-1])
+                header = csv_rows[0]
+                data = csv_rows[max(start, 1) : end + 1]
+                totals = ControlTotals().add_list_rows(header, data)
+                expected = record_chunk_complete(
+                    BUCKET,
+                    chunk_key,
+                    {"row_count": len(data), "totals": totals.to_dict()},
+                )
+            summary = write_file_summary(BUCKET, expected)
+
+        assert summary["reconciliation"]["matched"]
+        assert summary["reconciliation"]["accepted"]["row_count"] == 1250
+        assert "totals" not in summary["chunks"][0]
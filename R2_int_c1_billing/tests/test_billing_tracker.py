@@ -0,0 +1,136 @@
+from unittest import mock
+
+import json
+import os
+import sys
+
+sys.path.append(
+    os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
+)  # project root folder
+
+from billing_tracker import (
+    FAILED,
+    claim_finalisation_retry,
+    finalise_tracked_file,
+    parse_chunk_key,
+    register_file,
+    record_chunk_complete,
+    is_file_complete,
+    write_file_summary,
+)
+from tests.mock_boto import mock_s3_store
+
+FILE_NAME = "FINANCE_20240510113633.csv"
+BUCKET = "billing-bucket"
+
+
+class TestBillingTracker:
+
+    def test_parse_chunk_key(self):
+        assert parse_chunk_key(f"queue/{FILE_NAME}_4999_9997_2.csv") == (FILE_NAME, 2)
+
+    def test_last_chunk_finalises_once(self):
+        s3 = mock_s3_store()
+        with mock.patch("boto3.client", lambda type, region_name="": s3):
+            register_file(BUCKET, FILE_NAME, 3)
+
+            first = record_chunk_complete(
+                BUCKET, f"queue/{FILE_NAME}_0_4998_1.csv", {"row_count": 4998}
+            )
+            # Redelivered message for the same chunk does not double count
+            again = record_chunk_complete(
+                BUCKET, f"queue/{FILE_NAME}_0_4998_1.csv", {"row_count": 4998}
+            )
+            second = record_chunk_complete(
+                BUCKET, f"queue/{FILE_NAME}_4999_9997_2.csv", {"row_count": 4999}
+            )
+            assert (first, again, second) == (None, None, None)
+            assert not is_file_complete(BUCKET, FILE_NAME)
+
+            last = record_chunk_complete(
+                BUCKET,
+                f"queue/{FILE_NAME}_9998_10000_3.csv",
+                {"row_count": 2, "rejected_count": 1},
+            )
+            assert last["expected_chunks"] == 3
+            # Claimed, but not complete until its actions have run
+            assert not is_file_complete(BUCKET, FILE_NAME)
+
+            # A late duplicate of the last chunk does not finalise again
+            assert (
+                record_chunk_complete(BUCKET, f"queue/{FILE_NAME}_9998_10000_3.csv")
+                is None
+            )
+
+            summary = write_file_summary(BUCKET, last)
+
+        assert summary["completed_chunks"] == 3
+        assert summary["row_count"] == 4998 + 4999 + 2
+        assert summary["rejected_count"] == 1
+        stored = json.loads(s3.objects[(BUCKET, f"summary/{FILE_NAME}.json")]["Body"])
+        assert stored["file_name"] == FILE_NAME
+
+    def test_failed_step_is_retried(self):
+        s3 = mock_s3_store()
+        calls = []
+
+        def notify(summary):
+            calls.append(summary["file_name"])
+            if len(calls) == 1:
+                raise RuntimeError("SNS unavailable")
+
+        with mock.patch("boto3.client", lambda type, region_name="": s3):
+            register_file(BUCKET, FILE_NAME, 1, file_id="abc")
+            expected = record_chunk_complete(
+                BUCKET, f"queue/{FILE_NAME}_0_10_1.csv", {"row_count": 10}, "abc"
+            )
+            finalise = mock.Mock()
+            failed = finalise_tracked_file(
+                BUCKET, expected, [("finalise", finalise), ("notify", notify)]
+            )
+            assert failed == ["notify"]
+            assert not is_file_complete(BUCKET, FILE_NAME, "abc")
+            final = json.loads(
+                s3.objects[(BUCKET, f"tracking/{FILE_NAME}/abc/final.json")]["Body"]
+            )
+            assert final["status"] == FAILED
+
+            retry = claim_finalisation_retry(BUCKET, FILE_NAME, "abc")
+            # Only one caller wins the retry
+            assert claim_finalisation_retry(BUCKET, FILE_NAME, "abc") is None
+            expected, final = retry
+            assert (
+                finalise_tracked_file(
+                    BUCKET,
+                    expected,
+                    [("finalise", finalise), ("notify", notify)],
+                    final,
+                )
+                == []
+            )
+            assert is_file_complete(BUCKET, FILE_NAME, "abc")
+
+        # Steps that succeeded the first time are not repeated
+        assert finalise.call_count == 1
+        assert calls == [FILE_NAME, FILE_NAME]
+
+    def test_redropped_file_is_tracked_apart(self):
+        s3 = mock_s3_store()
+        with mock.patch("boto3.client", lambda type, region_name="": s3):
+            register_file(BUCKET, FILE_NAME, 1, file_id="first")
+            expected = record_chunk_complete(
+                BUCKET, f"queue/{FILE_NAME}_0_10_1.csv", {}, "first"
+            )
+            finalise_tracked_file(BUCKET, expected, [])
+            assert is_file_complete(BUCKET, FILE_NAME, "first")
+
+            # Same name, new content: its chunks start from nothing
+            register_file(BUCKET, FILE_NAME, 2, file_id="second")
+            assert not is_file_complete(BUCKET, FILE_NAME, "second")
+            assert (
+                record_chunk_complete(
+                    BUCKET, f"queue/{FILE_NAME}_0_10_1.csv", {}, "second"
+                )
+                is None
+            )
+            assert not is_file_complete(BUCKET, FILE_NAME, "second")
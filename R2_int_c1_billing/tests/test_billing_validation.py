@@ -0,0 +1,62 @@
+import csv
+import os
+import sys
+
+import pytest
+
+sys.path.append(
+    os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
+)  # project root folder
+
+from billing_validation import (
+    validate_list_rows,
+    validate_dict_rows,
+    rejected_rows_report,
+)
+
+FILE_NAME = "FINANCE_20240510113633.csv"
+
+
+def read_fixture():
+    with open(os.path.dirname(__file__) + "/" + FILE_NAME, newline="") as f:
+        rows = list(csv.reader(f))
+    return rows[0], rows[1:]
+
+
+class TestBillingValidation:
+
+    def test_fixture_rows_are_valid(self):
+        header, rows = read_fixture()
+        mask, reasons = validate_list_rows(header, rows)
+
+        assert all(mask)
+        assert reasons == {}
+
+    def test_bad_rows_are_rejected(self):
+        header, rows = read_fixture()
+        rows = [list(row) for row in rows[:5]]
+        rows[1][header.index("CRMID")] = "  "
+        rows[2][header.index("Start Date")] = "31022024"
+        rows[3][header.index("Subtotal Line")] = "12.5O"
+        rows[4][header.index("End Date")] = "3112"
+
+        mask, reasons = validate_list_rows(header, rows)
+
+        assert mask == [True, False, False, False, False]
+        assert reasons[1] == ["CRMID is empty"]
+        assert reasons[2] == ["Start Date is not a ddmmyyyy date"]
+        assert reasons[3] == ["Subtotal Line is not numeric"]
+        assert reasons[4] == ["End Date is not a ddmmyyyy date"]
+
+        report = rejected_rows_report("queue/F.csv_0_4_1.csv", rows, reasons, 1)
+        assert report["rejected_count"] == 4
+        assert [r["row"] for r in report["rows"]] == [2, 3, 4, 5]
+
+    def test_missing_column_fails_chunk(self):
+        header, rows = read_fixture()
+        dict_rows = [dict(zip(header, row)) for row in rows[:3]]
+        for row in dict_rows:
+            del row["Product Name"]
+
+        with pytest.raises(ValueError, match="missing columns: Product Name"):
+            validate_dict_rows(dict_rows)
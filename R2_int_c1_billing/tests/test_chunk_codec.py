@@ -0,0 +1,98 @@
+from unittest import mock
+
+import os
+import sys
+
+import pytest
+
+sys.path.append(
+    os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
+)  # project root folder
+sys.path.append(
+    os.path.join(
+        os.path.abspath(os.path.dirname(os.path.dirname(__file__))),
+        "functions",
+        "billing_file_processor",
+    )
+)  # the processor imports its modules flat
+
+from tests.mock_boto import mock_s3_store
+
+BUCKET = "billing-bucket"
+FILE_NAME = "FINANCE_20240510113633.csv"
+
+MOCK_ENV = {
+    "LANDMARK_SFTP_PATH": "/outbound",
+    "SEIL_S3_BUCKET": BUCKET,
+    "LANDMARK_SFTP_SECRET_NAME": "landmark-secret-name",
+    "LANDMARK_SFTP_SECRET_NAME_DELETE": "landmark-delete-secret-name",
+    "GA_SFTP_SECRET_NAME": "ga-secret-name",
+    "GA_FTP_PATH": "/inbound",
+    "SQS_QUEUE_URL": "https://sqs.ap-southeast-2.amazonaws.com/0/billing",
+    "TECHONE_SOAP_SECRET_NAME": "techone-soap-secret-name",
+    "BILLING_BUCKET": BUCKET,
+    "TECHONE_ADAPTOR_FUNCTION": "techone-adaptor-function",
+}
+
+HEADER = ["CRMID", "Description", "Amount"]
+ROWS = [HEADER] + [[f"{i:06d}", f"Café line {i}", f"{i}.50"] for i in range(7)]
+
+
+class MockSQSClient:
+    def __init__(self):
+        self.sent = []
+
+    def send_message(self, QueueUrl, MessageBody):
+        self.sent.append(MessageBody)
+        return {}
+
+
+@mock.patch.dict("os.environ", MOCK_ENV)
+class TestChunkCodec:
+
+    def test_resolve_chunk_encoding(self):
+        from functions.billing_file_processor import chunk_codec
+
+        assert chunk_codec.resolve_chunk_encoding(None) == "identity"
+        assert chunk_codec.resolve_chunk_encoding(" GZIP ") == "gzip"
+        with mock.patch.object(chunk_codec, "zstandard", None):
+            assert chunk_codec.resolve_chunk_encoding("zstd") == "gzip"
+        with pytest.raises(ValueError):
+            chunk_codec.resolve_chunk_encoding("brotli")
+
+    @pytest.mark.parametrize("chunk_encoding", ["identity", "gzip", "zstd"])
+    def test_processor_chunks_round_trip(self, chunk_encoding):
+        if chunk_encoding == "zstd":
+            pytest.importorskip("zstandard")
+        s3 = mock_s3_store()
+        sqs = MockSQSClient()
+        with mock.patch("boto3.client", lambda type, region_name="", **kwargs: s3):
+            import app
+            from functions.billing_queue_consumer.c1_billing_queue_consumer import (
+                read_data_from_s3,
+            )
+
+            with mock.patch.multiple(
+                app,
+                s3_client=s3,
+                sqs=sqs,
+                ROWS_PER_CHUNK=5,
+                CHUNK_ENCODING=chunk_encoding,
+                CHUNK_FORMAT="csv",
+                COMPLETION_TRACKING=False,
+            ):
+                chunk_keys = app.publish_chunks(FILE_NAME, ROWS, "cp1252")
+
+            assert sqs.sent == chunk_keys
+            chunks = [read_data_from_s3(key) for key in chunk_keys]
+
+        stored = s3.objects[(BUCKET, chunk_keys[0])]
+        if chunk_encoding == "identity":
+            assert "ContentEncoding" not in stored
+        else:
+            assert stored["ContentEncoding"] == chunk_encoding
+        assert stored["Metadata"]["source-encoding"] == "cp1252"
+        # Every chunk decodes back to the rows that went in
+        assert [row for chunk in chunks for row in chunk] == [
+            dict(zip(HEADER, row)) for row in ROWS[1:]
+        ]
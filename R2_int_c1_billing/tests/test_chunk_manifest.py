@@ -0,0 +1,95 @@
+from unittest import mock
+
+import csv
+import io
+import json
+import os
+import sys
+
+sys.path.append(
+    os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
+)  # project root folder
+
+from functions.billing_file_processor.chunk_manifest import build_range_messages
+from tests.mock_boto import mock_client_generator
+
+FILE_NAME = "FINANCE_20240510113633.csv"
+
+
+def read_fixture_bytes():
+    with open(os.path.dirname(__file__) + "/" + FILE_NAME, "rb") as f:
+        data = f.read()
+    # Put a quoted newline in the first data row to exercise quote handling
+    return data.replace(b'"Hello fresh seniors","CONTRA', b'"Hello\nfresh","CONTRA', 1)
+
+
+@mock.patch.dict("os.environ", {"BILLING_BUCKET": "billing-bucket"}, clear=True)
+class TestChunkManifest:
+
+    def test_ranges_cover_every_row_once(self):
+        data = read_fixture_bytes()
+        messages = build_range_messages(
+            FILE_NAME, "raw/" + FILE_NAME, io.BytesIO(data), 100, "charmap"
+        )
+        expected_rows = list(csv.reader(io.StringIO(data.decode("charmap"))))
+
+        assert len(messages) == 13
+        assert messages[0]["chunk_key"] == f"queue/{FILE_NAME}_0_99_1.csv"
+        assert messages[-1]["chunk_key"] == f"queue/{FILE_NAME}_1200_1250_13.csv"
+
+        rows = []
+        for message in messages:
+            chunk = data[message["start"] : message["end"]].decode("charmap")
+            rows.extend(csv.reader(io.StringIO(chunk)))
+        assert [messages[0]["header"].split(",")] == expected_rows[:1]
+        assert rows == expected_rows[1:]
+        assert rows[0][14] == "Hello\nfresh"
+
+    def test_scan_totals_match_parsed_totals(self):
+        from billing_encoding import canonical_headers
+        from billing_totals import ReconciliationBuilder, build_reconciliation_manifest
+
+        data = read_fixture_bytes()
+        builder = ReconciliationBuilder(FILE_NAME, 100)
+        # Small blocks so chunks span several reads
+        with mock.patch(
+            "functions.billing_file_processor.chunk_manifest.SCAN_BLOCK_SIZE", 1000
+        ):
+            messages = build_range_messages(
+                FILE_NAME, "raw/" + FILE_NAME, io.BytesIO(data), 100, "charmap", builder
+            )
+        csv_rows = list(csv.reader(io.StringIO(data.decode("charmap"), newline="")))
+        csv_rows[0] = canonical_headers(csv_rows[0])
+        expected = build_reconciliation_manifest(FILE_NAME, csv_rows, 100)
+
+        assert builder.manifest()["chunks"] == expected["chunks"]
+        assert builder.manifest()["file"] == expected["file"]
+        assert (
+            messages[3]["totals"]
+            == expected["chunks"][messages[3]["chunk_key"]]["accepted"]
+        )
+
+    def test_consumer_reads_range(self):
+        data = read_fixture_bytes()
+        message = build_range_messages(
+            FILE_NAME, "raw/" + FILE_NAME, io.BytesIO(data), 100, "charmap"
+        )[1]
+
+        class MockS3Client:
+            def __init__(mock_self, region_name) -> None:
+                pass
+
+            def get_object(mock_self, Bucket, Key, Range):
+                start, end = Range[len("bytes=") :].split("-")
+                return {"Body": io.BytesIO(data[int(start) : int(end) + 1])}
+
+        with mock.patch("boto3.client", mock_client_generator({"s3": MockS3Client})):
+            from functions.billing_queue_consumer.c1_billing_queue_consumer import (
+                read_range_from_s3,
+                parse_queue_message,
+            )
+
+            rows = read_range_from_s3(parse_queue_message(json.dumps(message)))
+
+        expected_rows = list(csv.DictReader(io.StringIO(data.decode("charmap"))))
+        assert rows == expected_rows[99:199]
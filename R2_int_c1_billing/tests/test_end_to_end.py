@@ -0,0 +1,44 @@
+import os
+import sys
+
+import pytest
+
+sys.path.append(
+    os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
+)  # project root folder
+
+pytest.importorskip("moto")
+
+from tests.harness.load_test import run_load_test
+
+
+class TestEndToEnd:
+
+    def test_files_are_imported_and_finalised(self):
+        metrics = run_load_test(files=2, rows=600, rows_per_chunk=250, consumers=3)
+
+        assert metrics["finalised_files"] == 2
+        assert metrics["reconciled_files"] == 2
+        assert metrics["dead_letters"] == 0 and metrics["left_on_queue"] == 0
+        # Every chunk was recorded as queued and moved on to delivered
+        assert metrics["chunks_by_state"] == {"queued": 0, "delivered": 6, "error": 0}
+        # Deleted from Landmark once imported, copied to GoAnywhere
+        assert metrics["files_left_on_landmark"] == 0
+        assert metrics["files_on_goanywhere"] == 2
+        # Exactly once: a duplicate import would push this over
+        assert metrics["techone"]["rows_imported"] == 1200
+
+    def test_recovers_from_techone_outage(self):
+        metrics = run_load_test(
+            files=1,
+            rows=600,
+            rows_per_chunk=250,
+            consumers=3,
+            max_receives=50,
+            techone={"outage_seconds": 1.5},
+        )
+
+        assert metrics["techone"]["status"]["503"] > 0
+        assert metrics["finalised_files"] == 1 and metrics["reconciled_files"] == 1
+        assert metrics["dead_letters"] == 0
+        assert metrics["techone"]["rows_imported"] == 600
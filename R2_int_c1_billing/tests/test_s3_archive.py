@@ -0,0 +1,73 @@
+from unittest import mock
+
+import hashlib
+import io
+import os
+import sys
+
+import pytest
+
+sys.path.append(
+    os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
+)  # project root folder
+
+from functions.billing_file_processor.s3_archive import (
+    archive_raw_file,
+    RecordCounter,
+    MIN_PART_SIZE,
+)
+
+
+class TestS3Archive:
+
+    def test_record_counter_ignores_quoted_newlines(self):
+        counter = RecordCounter()
+        for block in [b'a,b\n1,"x', b'\ny"\n2,', b"z"]:
+            counter.update(block)
+        assert counter.record_count == 3
+
+    def test_archive_raw_file_multipart(self):
+        s3 = mock.MagicMock()
+        s3.create_multipart_upload.return_value = {"UploadId": "upload-id"}
+        s3.upload_part.side_effect = lambda **kwargs: {
+            "ETag": f'"{kwargs["PartNumber"]}"'
+        }
+
+        data = (b"header\n" + b"row,1\n" * 2000000)[: MIN_PART_SIZE * 2 + 10]
+        tee = io.BytesIO()
+        with mock.patch("boto3.client", lambda type: s3):
+            archive = archive_raw_file(
+                io.BytesIO(data),
+                "bucket",
+                "raw/FINANCE.csv",
+                len(data),
+                tee=tee,
+                part_size=MIN_PART_SIZE,
+            )
+
+        assert archive["parts"] == 3
+        assert archive["byte_size"] == len(data)
+        assert archive["sha256"] == hashlib.sha256(data).hexdigest()
+        assert tee.getvalue() == data
+        parts = s3.complete_multipart_upload.call_args.kwargs["MultipartUpload"]
+        assert [p["PartNumber"] for p in parts["Parts"]] == [1, 2, 3]
+        s3.put_object_tagging.assert_called_once()
+
+    def test_archive_raw_file_size_mismatch_aborts(self):
+        s3 = mock.MagicMock()
+        s3.create_multipart_upload.return_value = {"UploadId": "upload-id"}
+        s3.upload_part.return_value = {"ETag": '"1"'}
+
+        data = b"x" * (MIN_PART_SIZE + 1)
+        with mock.patch("boto3.client", lambda type: s3):
+            with pytest.raises(IOError):
+                archive_raw_file(
+                    io.BytesIO(data),
+                    "bucket",
+                    "raw/F.csv",
+                    len(data) + 1,
+                    part_size=MIN_PART_SIZE,
+                )
+
+        s3.abort_multipart_upload.assert_called_once()
+        s3.complete_multipart_upload.assert_not_called()
@@ -0,0 +1,52 @@
+from unittest import mock
+
+import io
+import os
+import sys
+
+sys.path.append(
+    os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
+)  # project root folder
+
+from functions.billing_file_processor.sftp_download import (
+    open_remote_file,
+    READ_BLOCK_SIZE,
+)
+
+
+class MockRemoteFile(io.BytesIO):
+    def prefetch(self, file_size=None, max_concurrent_requests=None):
+        pass
+
+    def readv(self, chunks, max_concurrent_prefetch_requests=None):
+        for offset, size in chunks:
+            yield self.getvalue()[offset : offset + size]
+
+
+class TestSftpDownload:
+
+    def test_prefetched_stream(self):
+        data = os.urandom(3 * READ_BLOCK_SIZE + 17)
+        sftp = mock.MagicMock()
+        sftp.open.side_effect = lambda *args, **kwargs: MockRemoteFile(data)
+
+        with open_remote_file(sftp, "FINANCE.csv", len(data)) as remote_file:
+            assert remote_file.read() == data
+            assert remote_file.log_rate() > 0
+            assert remote_file.local_copy() is None
+
+        assert remote_file.bytes_read == len(data)
+
+    def test_parallel_range_download(self):
+        data = os.urandom(5 * READ_BLOCK_SIZE + 123)
+        sftp = mock.MagicMock()
+        sftp.open.side_effect = lambda *args, **kwargs: MockRemoteFile(data)
+
+        with open_remote_file(
+            sftp, "FINANCE.csv", len(data), parallel_threshold=1, workers=3
+        ) as remote_file:
+            assert remote_file.read() == data
+            # Already on local disk, so it can be read again without a copy
+            assert remote_file.local_copy().read() == data
+
+        assert sftp.open.call_count == 3
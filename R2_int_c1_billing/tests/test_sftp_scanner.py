@@ -0,0 +1,62 @@
+from unittest import mock
+
+import hashlib
+import os
+import sys
+
+sys.path.append(
+    os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
+)  # project root folder
+
+from paramiko import SFTPAttributes
+
+from functions.billing_file_processor.sftp_scanner import (
+    scan_for_new_files,
+    record_published,
+    find_published_hash,
+)
+
+
+def make_attr(filename, size, mtime=1715300000):
+    attr = SFTPAttributes()
+    attr.filename = filename
+    attr.st_size = size
+    attr.st_mtime = mtime
+    attr.st_mode = 0o100644
+    return attr
+
+
+class TestSftpScanner:
+
+    def test_scan_for_new_files(self):
+        manifest = {"files": {}}
+        record_published(manifest, make_attr("FINANCE_1.csv", 100), "abc")
+
+        first = [
+            make_attr("FINANCE_1.csv", 100),
+            make_attr("FINANCE_2.csv", 900),
+            make_attr("FINANCE_3.csv", 300),
+            make_attr("FINANCE_4.csv", 50),
+            make_attr("notes.txt", 10),
+        ]
+        # FINANCE_4.csv is still growing between the two listings
+        second = first[:3] + [make_attr("FINANCE_4.csv", 80), first[4]]
+
+        sftp = mock.MagicMock()
+        sftp.listdir_attr.side_effect = [first, second]
+
+        with mock.patch("time.sleep"):
+            ready, published = scan_for_new_files(sftp, manifest, 5)
+
+        assert [a.filename for a in ready] == ["FINANCE_3.csv", "FINANCE_2.csv"]
+        assert [a.filename for a in published] == ["FINANCE_1.csv"]
+
+    def test_find_published_hash(self):
+        manifest = {"files": {}}
+        digest = hashlib.sha256(b"a,b\n1,2\n").hexdigest()
+        record_published(manifest, make_attr("FINANCE_1.csv", 8), digest)
+
+        assert find_published_hash(manifest, digest) == "FINANCE_1.csv"
+        assert (
+            find_published_hash(manifest, hashlib.sha256(b"other").hexdigest()) is None
+        )
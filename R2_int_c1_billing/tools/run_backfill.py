@@ -0,0 +1,116 @@
+"""
+Reprocesses historical raw Landmark files across a process pool, one file
+per worker, with the billing_backfill engine from the shared layer:
+
+    PYTHONPATH=functions/billing_common python tools/run_backfill.py \
+        s3://billing-bucket/raw/FINANCE_202405 --output out/ --workers 8
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from billing_backfill import ROWS_PER_CHUNK, backfill_file, list_sources, load_auth
+
+logger = logging.getLogger("Billing Backfill")
+logger.setLevel(logging.INFO)
+
+
+def run_backfill(sources, options, workers=None):
+    """
+    Function to reprocess (path, size) sources across a process pool,
+    logging progress and throughput as each file finishes. A file that
+    fails is logged and listed under "failed_files"; the others carry on.
+    Returns the totals.
+    """
+    workers = workers or os.cpu_count()
+    total_bytes = sum(size for _, size in sources)
+    totals = {
+        "files": 0,
+        "bytes": 0,
+        "chunks": 0,
+        "rows": 0,
+        "rejected": 0,
+        "failed_posts": 0,
+    }
+    failed_files = []
+    start_time = time.perf_counter()
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(backfill_file, path, options): path for path, _ in sources
+        }
+        for future in as_completed(futures):
+            try:
+                stats = future.result()
+            except Exception as e:
+                logger.error(f"Could not reprocess {futures[future]}: {e}")
+                failed_files.append({"path": futures[future], "error": str(e)})
+                continue
+            totals["files"] += 1
+            for key in ("bytes", "chunks", "rows", "rejected", "failed_posts"):
+                totals[key] += stats[key]
+            elapsed = max(time.perf_counter() - start_time, 0.001)
+            logger.info(
+                f"[{totals['files']}/{len(sources)}] {stats['file_name']}: "
+                f"{stats['rows']} rows, {stats['rejected']} rejected in {stats['seconds']:.1f}s | "
+                f"{totals['bytes'] / total_bytes * 100 if total_bytes else 100:.0f}% done, "
+                f"{totals['rows'] / elapsed:.0f} rows/s, "
+                f"{totals['bytes'] / (1024 * 1024) / elapsed:.2f} MB/s"
+            )
+
+    totals["seconds"] = round(time.perf_counter() - start_time, 1)
+    totals["failed_files"] = failed_files
+    if failed_files:
+        logger.error(
+            f"{len(failed_files)} of {len(sources)} file(s) failed: "
+            + ", ".join(failure["path"] for failure in failed_files)
+        )
+    return totals
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Reprocess raw Landmark billing files")
+    parser.add_argument("source", help="local directory, file or s3://bucket/prefix")
+    parser.add_argument(
+        "--output", help="local directory or s3://bucket/prefix for envelopes"
+    )
+    parser.add_argument("--endpoint", help="TechOne SOAP URL to post envelopes to")
+    parser.add_argument("--soap-action", dest="soap_action")
+    parser.add_argument("--token", default=os.environ.get("TECHONE_TOKEN"))
+    parser.add_argument(
+        "--soap-secret", dest="soap_secret", help="secret with the SOAP Auth details"
+    )
+    parser.add_argument("--workers", type=int, help="defaults to all cores")
+    parser.add_argument(
+        "--rows-per-chunk", dest="rows_per_chunk", type=int, default=ROWS_PER_CHUNK
+    )
+    args = parser.parse_args(argv)
+    if not args.output and not args.endpoint:
+        parser.error("give --output, --endpoint or both")
+    if args.output and not args.output.startswith("s3://"):
+        os.makedirs(args.output, exist_ok=True)
+
+    logging.basicConfig(format="%(asctime)s %(message)s")
+    options = {
+        "output": args.output,
+        "endpoint": args.endpoint,
+        "soap_action": args.soap_action,
+        "token": args.token,
+        "auth": load_auth(args.soap_secret),
+        "rows_per_chunk": args.rows_per_chunk,
+    }
+    sources = list_sources(args.source)
+    logger.info(f"Reprocessing {len(sources)} file(s)")
+    totals = run_backfill(sources, options, args.workers)
+    print(json.dumps(totals, indent=2))
+    if totals["failed_files"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()